@@ -0,0 +1,28 @@
+# bench/_bootstrap.py
+# -*- coding: utf-8 -*-
+"""Variables mínimas para poder importar recharge_bot desde los benchmarks."""
+
+import logging
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_bot(supabase_url: str = "http://127.0.0.1:9", **env):
+    """Importa recharge_bot con un entorno de prueba (DATA_DIR temporal)."""
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    os.environ.update({
+        "TG_RECHARGE_BOT_TOKEN": "123:bench",
+        "ADMIN_CHAT_ID": "1",
+        "SUPABASE_URL": supabase_url,
+        "SUPABASE_API_KEY": "bench",
+        "YAPE_QR_URL": "https://example.com/qr.png",
+        "DATA_DIR": tempfile.mkdtemp(prefix="recargas-bench-"),
+        **env,
+    })
+    import recharge_bot
+    logging.getLogger("recargas").setLevel(logging.WARNING)
+    return recharge_bot
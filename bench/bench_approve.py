@@ -0,0 +1,244 @@
+# bench/bench_approve.py
+# -*- coding: utf-8 -*-
+"""
+Aprobaciones concurrentes contra el PostgREST falso (con aprobar_pago/aprobar_pagos
+emuladas): cientos de sb_approve_order() en paralelo, sobre el mismo pedido y sobre
+pedidos distintos repetidos (dobles toques, varios admins), más aprobaciones en lote
+que se cruzan con las individuales. Al final se comprueba que cada pedido se
+acreditó exactamente una vez: una sola respuesta con aplicado=true, una fila en
+creditos_historial y el saldo del usuario igual a la suma de sus pedidos.
+
+Además se aprueban pedidos ya rechazados o vencidos (no deben acreditarse) y se
+cruzan rechazos con aprobaciones del mismo pedido: cada uno termina aprobado y
+acreditado una vez, o rechazado y sin créditos.
+
+Ojo: las funciones SQL se emulan en Python bajo un lock del servidor falso, así que
+esto valida el bot y las reglas de las funciones, no la concurrencia de Postgres.
+
+Con --error-rate una fracción de las llamadas responde 503; los pedidos que no se
+aprobaron se reintentan hasta que todos queden aprobados.
+
+Uso:
+    python bench/bench_approve.py [--calls 500] [--orders 100] [--error-rate 0.1]
+                                  [--latency-ms 5]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _bootstrap import load_bot  # noqa: E402
+from fake_postgrest import FakePostgrest, install_recargas_rpcs  # noqa: E402
+
+USERS = 20
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--calls", type=int, default=500, help="llamadas por escenario")
+    p.add_argument("--orders", type=int, default=100, help="pedidos distintos del segundo escenario")
+    p.add_argument("--error-rate", type=float, default=0.0)
+    p.add_argument("--latency-ms", type=float, default=5)
+    return p.parse_args()
+
+
+def seed_orders(pg, prefix: str, n: int, status: str = "pendiente") -> dict:
+    """Crea n pedidos con ese status -> {order_id: (user_id, qty)}."""
+    orders = {}
+    for i in range(n):
+        oid = f"{prefix}-{i}"
+        uid, qty = str(1000 + i % USERS), 10 + i % 7
+        pg.tables.setdefault("pagos", []).append(
+            {"id": oid, "user_id": uid, "qty": qty, "status": status})
+        orders[oid] = (uid, qty)
+    return orders
+
+
+async def approve_all(bot, calls: list) -> tuple:
+    """Lanza todas las llamadas a la vez -> (aplicados por pedido, fallidas, segundos)."""
+    applied, failed = Counter(), 0
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*(fn() for fn in calls))
+    for res in results:
+        if res is None:
+            failed += 1
+        for oid in res or ():
+            applied[oid] += 1
+    return applied, failed, time.perf_counter() - t0
+
+
+def single(bot, oid, uid, qty):
+    async def call():
+        res = await bot.sb_approve_order(oid, int(uid), qty)
+        if res is None:
+            return None
+        return [oid] if res.get("aplicado") else []
+    return call
+
+
+def reject(bot, oid):
+    async def call():
+        res = await bot.sb_patch("pagos", {"id": oid, "status": "pendiente"}, {"status": "rechazado"})
+        return None if res is None else []
+    return call
+
+
+def bulk(bot, ids):
+    async def call():
+        done, failed = await bot.sb_approve_orders(ids)
+        return None if failed else [r["order_id"] for r in done]
+    return call
+
+
+async def scenario(bot, pg, name: str, orders: dict, make_calls) -> bool:
+    calls = make_calls()
+    applied, failed, secs = await approve_all(bot, calls)
+    rounds = 1
+    # lo que falló por 503 se reintenta (como haría el admin) hasta aprobar todo
+    while True:
+        status = {r["id"]: r["status"] for r in pg.tables["pagos"]}
+        pending = [oid for oid in orders if status[oid] == "pendiente"]
+        if not pending:
+            break
+        rounds += 1
+        more, f, _ = await approve_all(bot, [single(bot, oid, *orders[oid]) for oid in pending])
+        applied.update(more)
+        failed += f
+
+    problems = []
+    for oid in orders:
+        if applied[oid] != 1:
+            problems.append(f"{oid}: aplicado {applied[oid]} veces")
+    print(f"{name:<34}{len(calls):>7}{len(orders):>8}{failed:>8}{rounds:>7}{secs * 1000:>9.0f} ms"
+          f"{'  OK' if not problems else '  FALLA'}")
+    for p in problems[:10]:
+        print("    " + p)
+    return not problems
+
+
+async def not_pending(bot, pg, name: str, orders: dict) -> bool:
+    """Aprobar pedidos rechazados o vencidos (varias veces) no debe acreditar nada."""
+    calls = [single(bot, oid, *orders[oid]) for oid in orders for _ in range(3)]
+    applied, failed, secs = await approve_all(bot, calls)
+    status = {r["id"]: r["status"] for r in pg.tables["pagos"]}
+    problems = [f"{oid}: aplicado {applied[oid]} veces" for oid in orders if applied[oid]]
+    problems += [f"{oid}: quedó {status[oid]}" for oid in orders if status[oid] == "aprobado"]
+    print(f"{name:<34}{len(calls):>7}{len(orders):>8}{failed:>8}{1:>7}{secs * 1000:>9.0f} ms"
+          f"{'  OK' if not problems else '  FALLA'}")
+    for p in problems[:10]:
+        print("    " + p)
+    return not problems
+
+
+async def reject_vs_approve(bot, pg, name: str, orders: dict, rnd) -> tuple:
+    """Rechazos y aprobaciones del mismo pedido a la vez -> (ok, pedidos aprobados)."""
+    calls = [single(bot, oid, *orders[oid]) for oid in orders for _ in range(2)]
+    calls += [reject(bot, oid) for oid in orders]
+    rnd.shuffle(calls)
+    applied, failed, secs = await approve_all(bot, calls)
+    status = {r["id"]: r["status"] for r in pg.tables["pagos"]}
+    problems = []
+    for oid in orders:
+        want = 1 if status[oid] == "aprobado" else 0
+        if status[oid] not in ("aprobado", "rechazado") and not failed:
+            problems.append(f"{oid}: quedó {status[oid]}")
+        if applied[oid] != want:
+            problems.append(f"{oid}: {status[oid]} y aplicado {applied[oid]} veces")
+    print(f"{name:<34}{len(calls):>7}{len(orders):>8}{failed:>8}{1:>7}{secs * 1000:>9.0f} ms"
+          f"{'  OK' if not problems else '  FALLA'}")
+    for p in problems[:10]:
+        print("    " + p)
+    return not problems, [oid for oid in orders if status[oid] == "aprobado"]
+
+
+def check_balances(pg, expected: Counter) -> bool:
+    ok = True
+    balances = {str(u["telegram_id"]): int(u.get("creditos") or 0) for u in pg.tables.get("usuarios", [])}
+    for uid, total in expected.items():
+        if balances.get(uid, 0) != total:
+            print(f"    usuario {uid}: saldo {balances.get(uid, 0)}, esperado {total}")
+            ok = False
+    hist = len(pg.tables.get("creditos_historial", []))
+    n_orders = sum(1 for r in pg.tables["pagos"] if r["status"] == "aprobado")
+    if hist != n_orders:
+        print(f"    creditos_historial tiene {hist} filas para {n_orders} pedidos aprobados")
+        ok = False
+    return ok
+
+
+async def main_async(args, bot, pg):
+    rnd = random.Random(7)
+    print(f"{'escenario':<34}{'llamadas':>7}{'pedidos':>8}{'fallas':>8}{'rondas':>7}{'tiempo':>12}")
+    ok = True
+    expected = Counter()
+
+    # 1. el mismo pedido aprobado por todos a la vez
+    same = seed_orders(pg, "mismo", 1)
+    oid, (uid, qty) = next(iter(same.items()))
+    ok &= await scenario(bot, pg, "mismo pedido", same,
+                         lambda: [single(bot, oid, uid, qty) for _ in range(args.calls)])
+    expected[uid] += qty
+
+    # 2. pedidos distintos, cada uno varias veces, en orden aleatorio
+    many = seed_orders(pg, "distintos", args.orders)
+    calls = [oid for oid in many for _ in range(max(1, args.calls // args.orders))]
+    rnd.shuffle(calls)
+    ok &= await scenario(bot, pg, "pedidos distintos (repetidos)", many,
+                         lambda: [single(bot, o, *many[o]) for o in calls])
+    for uid, qty in many.values():
+        expected[uid] += qty
+
+    # 3. lotes de /pendientes cruzados con aprobaciones individuales
+    mixed = seed_orders(pg, "mixto", args.orders)
+    ids = list(mixed)
+
+    def mixed_calls():
+        out = [single(bot, o, *mixed[o]) for o in ids for _ in range(2)]
+        for _ in range(max(1, args.calls // 50)):
+            out.append(bulk(bot, rnd.sample(ids, min(len(ids), 30))))
+        rnd.shuffle(out)
+        return out
+    ok &= await scenario(bot, pg, "lotes + individuales", mixed, mixed_calls)
+    for uid, qty in mixed.values():
+        expected[uid] += qty
+
+    # 4. pedidos rechazados y vencidos: aprobar_pago no los acredita
+    for status in ("rechazado", "expirado"):
+        ok &= await not_pending(bot, pg, f"pedidos {status}s", seed_orders(pg, status, args.orders // 4, status))
+
+    # 5. rechazo y aprobación cruzados sobre el mismo pedido
+    raced = seed_orders(pg, "cruce", args.orders)
+    race_ok, approved = await reject_vs_approve(bot, pg, "rechazo vs aprobación", raced, rnd)
+    ok &= race_ok
+    for oid in approved:
+        uid, qty = raced[oid]
+        expected[uid] += qty
+
+    ok &= check_balances(pg, expected)
+    await bot.sb_close()
+    return ok
+
+
+def main():
+    args = parse_args()
+    pg = install_recargas_rpcs(FakePostgrest(latency=args.latency_ms / 1000).start())
+    pg.error_rate = args.error_rate
+    bot = load_bot(pg.url)
+    logging.getLogger("recargas").setLevel(logging.ERROR)   # los 503 inyectados ya se cuentan
+    try:
+        ok = asyncio.run(main_async(args, bot, pg))
+    finally:
+        pg.stop()
+    print("cada pedido acreditado exactamente una vez" if ok else "hubo pedidos acreditados de más o de menos")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+# bench/bench_coord.py
+# -*- coding: utf-8 -*-
+"""
+Coordinación entre réplicas contra el PostgREST falso (con las tablas y funciones de
+sql/coordinacion.sql emuladas) y contra SQLite:
+
+  claves    N réplicas reclaman el mismo update_id a la vez: una sola lo gana; tras
+            release_update se puede volver a reclamar; prune_updates borra las viejas
+  lease     un solo dueño a la vez, renovación, traspaso al soltarlo y al vencer
+  sesiones  SupabasePersistence (bot_sesiones): escritura en lote, carga solo de las
+            sesiones propias, lectura de una sesión ajena al primer update (cambio
+            de REPLICA_COUNT) y borrado
+  caché     /replica/invalidate: la réplica dueña suelta la fila de user_cache
+
+Sale con código 1 si algo no se cumple. Se mide también el costo por operación.
+
+Uso:
+    python bench/bench_coord.py [--replicas 8] [--updates 200] [--latency-ms 2]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _bootstrap import load_bot  # noqa: E402
+from fake_postgrest import FakePostgrest, install_coord_rpcs  # noqa: E402
+
+SECRET = "bench-secret"
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--replicas", type=int, default=8, help="réplicas que compiten por cada update")
+    p.add_argument("--updates", type=int, default=200)
+    p.add_argument("--latency-ms", type=float, default=2)
+    return p.parse_args()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Checks:
+    def __init__(self):
+        self.failed = 0
+
+    def __call__(self, ok: bool, what: str):
+        print(f"  {'OK   ' if ok else 'FALLA'} {what}")
+        self.failed += not ok
+
+
+async def check_claims(name, coords, args, check):
+    t0 = time.perf_counter()
+    wins = 0
+    for update_id in range(1, args.updates + 1):
+        got = await asyncio.gather(*(c.claim_update(update_id) for c in coords))
+        wins += sum(got) == 1
+    ms = (time.perf_counter() - t0) * 1000 / (args.updates * len(coords))
+    check(wins == args.updates, f"{name}: {wins}/{args.updates} updates con un solo dueño ({ms:.2f} ms por claim)")
+    await coords[0].release_update(1)
+    check(await coords[1].claim_update(1), f"{name}: release_update deja reclamarlo otra vez")
+    check(not await coords[2].claim_update(1), f"{name}: y solo una vez")
+    n = await coords[0].prune_updates(0)
+    check(n == args.updates, f"{name}: prune_updates borró {n} claves")
+    check(await coords[0].claim_update(2), f"{name}: tras prune la clave está libre")
+
+
+async def check_lease(name, a, b, check):
+    check(await a.acquire_lease("jobs", "A", 30), f"{name}: A toma el lease libre")
+    check(not await b.acquire_lease("jobs", "B", 30), f"{name}: B no lo toma mientras es de A")
+    check(await a.acquire_lease("jobs", "A", 30), f"{name}: A lo renueva")
+    await a.release_lease("jobs", "A")
+    check(await b.acquire_lease("jobs", "B", 0.2), f"{name}: B lo toma cuando A lo suelta")
+    check(not await a.acquire_lease("jobs", "A", 30), f"{name}: A no lo toma antes de que venza")
+    await asyncio.sleep(0.3)
+    check(await a.acquire_lease("jobs", "A", 30), f"{name}: A lo toma cuando vence el de B")
+    await a.release_lease("jobs", "A")
+
+
+async def check_sessions(bot, pg, check):
+    store = bot.state_store
+    check(isinstance(store, bot.SupabasePersistence), "COORD_BACKEND=supabase guarda el estado en bot_sesiones")
+    # 0 y 2 son de la réplica 0; 1 y 3 de la 1
+    for uid in range(4):
+        await store.update_user_data(uid, {"order": {"id": f"p{uid}"}, "await_proof": True})
+    await store.update_user_data(0, {"order": {"id": "p0b"}})
+    await store.flush()
+    rows = {r["user_id"]: r for r in pg.tables.get("bot_sesiones", [])}
+    check(len(rows) == 4 and rows[0]["data"] == {"order": {"id": "p0b"}},
+          f"se escribieron {len(rows)} sesiones con el último estado de cada una")
+    check([rows[u]["replica"] for u in range(4)] == [0, 1, 0, 1], "cada fila lleva su réplica dueña")
+
+    fresh = bot.SupabasePersistence(5)
+    loaded = await fresh.get_user_data()
+    check(sorted(loaded) == [0, 2], f"al arrancar la réplica 0 carga solo las suyas ({sorted(loaded)})")
+
+    # usuario 1: su sesión la escribió la réplica 1 (antes de cambiar REPLICA_COUNT)
+    ud = {}
+    n0 = pg.calls
+    await fresh.refresh_user_data(1, ud)
+    await fresh.refresh_user_data(1, ud)
+    check(ud == {"order": {"id": "p1"}, "await_proof": True} and pg.calls - n0 == 1,
+          f"la sesión ajena se lee una sola vez al primer update ({pg.calls - n0} lecturas)")
+    n0 = pg.calls
+    await fresh.refresh_user_data(0, loaded[0])
+    check(pg.calls == n0, "las sesiones cargadas al arrancar no se vuelven a leer")
+
+    await fresh.drop_user_data(2)
+    await fresh.flush()
+    check(2 not in {r["user_id"] for r in pg.tables["bot_sesiones"]}, "drop_user_data borra la fila")
+
+
+async def check_invalidate(bot, check):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET, bot.REPLICA_HEADER: "1"}
+    body = json.dumps({"user_ids": ["3"]}).encode()
+    bot.user_cache.put("3", {"telegram_id": "3", "creditos": 1})
+    status, _, _ = await bot.http_dispatch("POST", bot.INVALIDATE_PATH, {}, {**headers, bot.REPLICA_HEADER: ""}, body)
+    check(status == 404, f"/replica/invalidate sin cabecera de réplica -> {status}")
+    status, _, _ = await bot.http_dispatch("POST", bot.INVALIDATE_PATH, {}, {**headers, "X-Telegram-Bot-Api-Secret-Token": "x"}, body)
+    check(status == 403, f"/replica/invalidate con secreto incorrecto -> {status}")
+    status, _, _ = await bot.http_dispatch("POST", bot.INVALIDATE_PATH, {}, {**headers, "X-Telegram-Bot-Api-Secret-Token": "clavé"}, body)
+    check(status == 403, f"/replica/invalidate con secreto no ASCII -> {status}")
+    status, _, _ = await bot.http_dispatch("POST", bot.INVALIDATE_PATH, {}, headers, body)
+    check(status == 200 and bot.user_cache._lookup("3")[0] is False, "la réplica dueña suelta la fila cacheada")
+
+    # ida y vuelta real: la "réplica 1" es este mismo proceso
+    errors = []
+    count_error = bot.count_error
+    bot.count_error = errors.append
+    server = await bot.start_http_server(int(bot.REPLICA_URLS[1].rsplit(":", 1)[1]))
+    try:
+        bot.user_cache.put("5", {"telegram_id": "5", "creditos": 1})
+        await bot.invalidate_users([5, "5"])
+    finally:
+        bot.count_error = count_error
+        server.close()
+        await server.wait_closed()
+        await bot.close_peers()
+    check(not errors and bot.user_cache._lookup("5")[0] is False, "invalidate_users avisa a la réplica dueña por HTTP")
+
+
+async def main_async(args, bot, pg):
+    check = Checks()
+    tmp = tempfile.mkdtemp(prefix="recargas-coord-")
+
+    print("SupabaseCoordinator (bot_updates, tomar_lease/soltar_lease)")
+    coords = [bot.SupabaseCoordinator() for _ in range(args.replicas)]
+    await check_claims("supabase", coords, args, check)
+    await check_lease("supabase", coords[0], coords[1], check)
+
+    print("SQLiteCoordinator (una conexión por réplica)")
+    coords = [bot.SQLiteCoordinator(os.path.join(tmp, "coord.sqlite3")) for _ in range(args.replicas)]
+    await check_claims("sqlite", coords, args, check)
+    await check_lease("sqlite", coords[0], coords[1], check)
+    for c in coords:
+        c.close()
+
+    print("Sesiones en Supabase")
+    await check_sessions(bot, pg, check)
+
+    print("Invalidación de user_cache entre réplicas")
+    await check_invalidate(bot, check)
+
+    await bot.sb_close()
+    return check.failed
+
+
+def main():
+    args = parse_args()
+    pg = install_coord_rpcs(FakePostgrest(latency=args.latency_ms / 1000).start())
+    port = free_port()
+    bot = load_bot(
+        pg.url, COORD_BACKEND="supabase", BOT_MODE="webhook", WEBHOOK_URL="https://example.com",
+        WEBHOOK_SECRET=SECRET, REPLICA_COUNT="2", REPLICA_INDEX="0",
+        REPLICA_URLS=f"http://127.0.0.1:9,http://127.0.0.1:{port}",
+    )
+    try:
+        failed = asyncio.run(main_async(args, bot, pg))
+    finally:
+        pg.stop()
+    print("coordinación OK" if not failed else f"{failed} comprobaciones fallaron")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+# bench/bench_e2e.py
+# -*- coding: utf-8 -*-
+"""
+Prueba de carga de punta a punta: el bot real (Application, handlers, outbox,
+persistencia…) contra un Bot API falso (fake_telegram) y un PostgREST falso
+(fake_postgrest, con aprobar_pago emulado). Cada usuario simulado recorre
+
+    /start -> Recargar -> cantidad -> captura -> el admin aprueba
+
+y se mide cuánto tarda el bot en contestar cada paso (desde que el update entra en
+la cola hasta que el bot le escribe al chat), el throughput en pedidos por segundo y
+las llamadas HTTP por pedido a cada servicio.
+
+Cada corrida se agrega a bench/results/e2e.jsonl con el commit; si hay una corrida
+anterior con los mismos parámetros se comparan y se marcan las regresiones.
+
+Uso:
+    python bench/bench_e2e.py [--users 2000] [--concurrency 100]
+                              [--pg-latency-ms 5] [--tg-latency-ms 5]
+                              [--tolerance 0.25] [--check]
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from telegram import Update
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _bootstrap import ROOT, load_bot  # noqa: E402
+from fake_postgrest import FakePostgrest, install_recargas_rpcs  # noqa: E402
+from fake_telegram import FakeTelegram  # noqa: E402
+
+ADMIN_ID = 1
+STEPS = ("start", "recargar", "cantidad", "captura", "aprobar")
+RESULTS_PATH = os.path.join(ROOT, "bench", "results", "e2e.jsonl")
+PROOF_IMAGES = 64
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--users", type=int, default=2000)
+    p.add_argument("--concurrency", type=int, default=100, help="usuarios recorriendo el flujo a la vez")
+    p.add_argument("--qty", type=int, default=5)
+    p.add_argument("--pg-latency-ms", type=float, default=5)
+    p.add_argument("--tg-latency-ms", type=float, default=5)
+    p.add_argument("--timeout", type=float, default=30, help="segundos máximos por paso")
+    p.add_argument("--tolerance", type=float, default=0.25, help="empeoramiento tolerado vs. la corrida anterior")
+    p.add_argument("--check", action="store_true", help="sale con código 1 si hay regresión")
+    p.add_argument("--no-save", action="store_true")
+    return p.parse_args()
+
+
+def proof_images(n: int):
+    """Capturas distintas (ruido) para que el índice de duplicados no las confunda."""
+    from PIL import Image
+
+    out = []
+    for i in range(n):
+        rnd = random.Random(i)
+        img = Image.new("L", (64, 64))
+        img.putdata([rnd.randrange(256) for _ in range(64 * 64)])
+        buf = io.BytesIO()
+        img.save(buf, "PNG")
+        out.append(buf.getvalue())
+    return out
+
+
+def pct(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def git_commit():
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                             capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--", "recharge_bot.py"], cwd=ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return rev + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "desconocido"
+
+
+class Harness:
+    """Inyecta updates en la Application y espera la respuesta del bot en cada chat."""
+
+    def __init__(self, bot, tg: FakeTelegram, args):
+        self.bot = bot
+        self.tg = tg
+        self.args = args
+        self.loop = asyncio.get_running_loop()
+        self.inbox = defaultdict(asyncio.Queue)   # chat_id -> (método, params, resultado)
+        self.approvals = {}                       # user_id -> Future((callback_data, mensaje admin))
+        self.latency = {s: [] for s in STEPS}
+        self.failures = defaultdict(int)
+        self._ids = 0
+        tg.on_call = lambda m, p, r: self.loop.call_soon_threadsafe(self._route, m, p, r)
+
+    def _route(self, method, params, result):
+        try:
+            chat = int(params.get("chat_id") or 0)
+        except (TypeError, ValueError):
+            return
+        if chat == ADMIN_ID and method == "sendPhoto":
+            for row in (params.get("reply_markup") or {}).get("inline_keyboard", []):
+                for btn in row:
+                    data = btn.get("callback_data") or ""
+                    if data.startswith("approve:"):
+                        fut = self.approvals.get(int(data.split(":")[2]))
+                        if fut and not fut.done():
+                            fut.set_result((data, result))
+            return
+        inbox = self.inbox.get(chat)
+        if inbox is not None:
+            inbox.put_nowait((method, params, result))
+
+    def _next_id(self):
+        self._ids += 1
+        return self._ids
+
+    def _user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"u{uid}"}
+
+    def message(self, uid, **fields):
+        return {
+            "update_id": self._next_id(),
+            "message": {
+                "message_id": self._next_id(),
+                "date": int(time.time()),
+                "chat": {"id": uid, "type": "private"},
+                "from": self._user(uid),
+                **fields,
+            },
+        }
+
+    def callback(self, uid, data, message):
+        return {
+            "update_id": self._next_id(),
+            "callback_query": {
+                "id": str(self._next_id()),
+                "from": self._user(uid),
+                "chat_instance": str(uid),
+                "data": data,
+                "message": message,
+            },
+        }
+
+    async def step(self, name, chat, update, expect):
+        """Encola el update y espera la primera respuesta al chat que cumpla `expect`."""
+        inbox = self.inbox[chat]
+        t0 = time.perf_counter()
+        await self.bot.app_tg.update_queue.put(Update.de_json(update, self.bot.app_tg.bot))
+        deadline = t0 + self.args.timeout
+        while True:
+            method, params, result = await asyncio.wait_for(inbox.get(), deadline - time.perf_counter())
+            if expect(method, params):
+                self.latency[name].append(time.perf_counter() - t0)
+                return result
+
+    async def user_flow(self, uid):
+        # un paso de menú puede llegar como mensaje nuevo o editando el del botón
+        text = lambda m, p: m in ("sendMessage", "editMessageText") and p.get("text")   # noqa: E731
+        step = None
+        try:
+            step = "start"
+            msg = await self.step(step, uid, self.message(
+                uid, text="/start", entities=[{"type": "bot_command", "offset": 0, "length": 6}]),
+                lambda m, p: text(m, p) and "reply_markup" in p)
+
+            step = "recargar"
+            await self.step(step, uid, self.callback(uid, "recargar", msg),
+                            lambda m, p: text(m, p) and "cuentas" in p["text"])
+
+            step = "cantidad"
+            await self.step(step, uid, self.message(uid, text=str(self.args.qty)),
+                            lambda m, p: m == "sendPhoto" or (text(m, p) and "Yape" in p["text"]))
+
+            step = "captura"
+            approval = self.approvals[uid] = self.loop.create_future()
+            file_id = f"proof-{uid % PROOF_IMAGES}"
+            photo = [{"file_id": file_id, "file_unique_id": file_id, "width": 64, "height": 64}]
+            await self.step(step, uid, self.message(uid, photo=photo),
+                            lambda m, p: text(m, p) and "Captura recibida" in p["text"])
+
+            step = "aprobar"
+            data, admin_msg = await asyncio.wait_for(approval, self.args.timeout)
+            await self.step(step, uid, self.callback(ADMIN_ID, data, admin_msg),
+                            lambda m, p: text(m, p) and "Pago verificado" in p["text"])
+            return True
+        except asyncio.TimeoutError:
+            self.failures[step] += 1
+            return False
+        finally:
+            self.approvals.pop(uid, None)
+            self.inbox.pop(uid, None)
+
+
+async def run(args):
+    pg = install_recargas_rpcs(FakePostgrest(latency=args.pg_latency_ms / 1000)).start()
+    tg = FakeTelegram(latency=args.tg_latency_ms / 1000).start()
+    for i, data in enumerate(proof_images(PROOF_IMAGES)):
+        tg.files[f"proof-{i}"] = data
+
+    bot = load_bot(
+        pg.url,
+        TG_API_BASE_URL=tg.url,
+        ADMIN_CHAT_ID=str(ADMIN_ID),
+        # sin los límites de Telegram: medimos al bot, no al token bucket
+        TG_GLOBAL_RATE="1000000",
+        TG_CHAT_RATE="1000000",
+        TG_GROUP_RATE="1000000",
+    )
+    app = bot.build_app()
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+
+    h = Harness(bot, tg, args)
+    sem = asyncio.Semaphore(args.concurrency)
+    base_uid = 10_000
+
+    async def one(uid):
+        async with sem:
+            return await h.user_flow(uid)
+
+    tg.calls.clear()
+    pg.calls = 0
+    t0 = time.perf_counter()
+    ok = await asyncio.gather(*(one(base_uid + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - t0
+
+    await app.stop()
+    await app.shutdown()
+    await app.post_shutdown(app)
+    tg.stop()
+    pg.stop()
+
+    orders = sum(ok)
+    per_order = lambda n: round(n / orders, 2) if orders else None   # noqa: E731
+    return {
+        "commit": git_commit(),
+        "at": datetime.now().isoformat(timespec="seconds"),
+        "params": {
+            "users": args.users,
+            "concurrency": args.concurrency,
+            "qty": args.qty,
+            "pg_latency_ms": args.pg_latency_ms,
+            "tg_latency_ms": args.tg_latency_ms,
+        },
+        "orders": orders,
+        "failures": dict(h.failures),
+        "elapsed_s": round(elapsed, 3),
+        "orders_per_s": round(orders / elapsed, 2),
+        "steps_ms": {
+            s: {f"p{int(p * 100)}": round(pct(v, p) * 1000, 1) if v else None for p in (0.5, 0.95, 0.99)}
+            for s, v in h.latency.items()
+        },
+        "http_per_order": {
+            "telegram": per_order(sum(tg.calls.values())),
+            "supabase": per_order(pg.calls),
+            "telegram_by_method": {m: per_order(n) for m, n in sorted(tg.calls.items())},
+        },
+    }
+
+
+def load_previous(params):
+    try:
+        with open(RESULTS_PATH, encoding="utf-8") as f:
+            runs = [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        return None
+    same = [r for r in runs if r.get("params") == params]
+    return same[-1] if same else None
+
+
+def compare(cur, prev, tolerance):
+    """Lista de regresiones (texto) respecto de la corrida anterior."""
+    out = []
+    if prev["orders_per_s"] and cur["orders_per_s"] < prev["orders_per_s"] * (1 - tolerance):
+        out.append(f"throughput {prev['orders_per_s']} -> {cur['orders_per_s']} pedidos/s")
+    for s in STEPS:
+        a, b = prev["steps_ms"].get(s, {}).get("p99"), cur["steps_ms"][s]["p99"]
+        if a and b and b > a * (1 + tolerance):
+            out.append(f"p99 {s} {a} -> {b} ms")
+    for svc in ("telegram", "supabase"):
+        a, b = prev["http_per_order"].get(svc), cur["http_per_order"][svc]
+        if a and b and b > a * 1.05:   # el outbox agrupa distinto en cada corrida
+            out.append(f"llamadas a {svc} por pedido {a} -> {b}")
+    return out
+
+
+def report(res, prev):
+    p = res["params"]
+    print(f"{p['users']} usuarios, {p['concurrency']} a la vez, latencia PostgREST "
+          f"{p['pg_latency_ms']} ms / Telegram {p['tg_latency_ms']} ms  [{res['commit']}]")
+    print(f"pedidos aprobados: {res['orders']}  en {res['elapsed_s']} s  -> {res['orders_per_s']} pedidos/s")
+    if res["failures"]:
+        print(f"sin respuesta a tiempo: {res['failures']}")
+    print(f"{'paso':10s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s} {'p99 antes':>10s}")
+    for s in STEPS:
+        q = res["steps_ms"][s]
+        before = prev["steps_ms"].get(s, {}).get("p99") if prev else None
+        print(f"{s:10s} {q['p50'] or '-':>9} {q['p95'] or '-':>9} {q['p99'] or '-':>9} {before or '-':>10}")
+    hp = res["http_per_order"]
+    print(f"HTTP por pedido: Telegram {hp['telegram']}  Supabase {hp['supabase']}")
+    print("  " + "  ".join(f"{m}={n}" for m, n in hp["telegram_by_method"].items()))
+
+
+def main():
+    args = parse_args()
+    res = asyncio.run(run(args))
+    prev = load_previous(res["params"])
+    report(res, prev)
+    regressions = compare(res, prev, args.tolerance) if prev else []
+    if prev:
+        print(f"comparado con {prev['commit']} ({prev['at']}): "
+              + ("; ".join(regressions) if regressions else "sin regresiones"))
+    if not args.no_save:
+        os.makedirs(os.path.dirname(RESULTS_PATH), exist_ok=True)
+        with open(RESULTS_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(res, ensure_ascii=False) + "\n")
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
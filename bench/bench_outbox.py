@@ -0,0 +1,149 @@
+# bench/bench_outbox.py
+# -*- coding: utf-8 -*-
+"""
+Outbox contra el PostgREST falso: se encola un backlog (inserts en 'pagos' y patch
+sobre esas filas) y se mide cuánto tarda en vaciarse, cuántas peticiones HTTP hace,
+el peor retraso del event loop mientras tanto (escritura del journal incluida) y el
+tamaño del journal.
+
+También se mandan N marcas de captura (_mark_proof_received) con y sin la función
+marcar_comprobantes instalada: con ella van en lotes por RPC, sin ella un PATCH
+por pedido.
+
+Después se simula un corte: se encola otro backlog, se detiene el worker a mitad de
+camino sin drenar y otra instancia relee el journal. Deben quedar pendientes
+exactamente las entradas no enviadas, y al terminar cada fila debe estar una vez
+en la tabla con su patch aplicado.
+
+Uso:
+    python bench/bench_outbox.py [--rows 10000] [--latency-ms 2]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _bootstrap import load_bot  # noqa: E402
+from fake_postgrest import FakePostgrest, install_recargas_rpcs  # noqa: E402
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--rows", type=int, default=10000)
+    p.add_argument("--latency-ms", type=float, default=2)
+    return p.parse_args()
+
+
+async def loop_lag(stop: asyncio.Event, out: list):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        t = loop.time()
+        await asyncio.sleep(0.005)
+        out.append(loop.time() - t - 0.005)
+
+
+def enqueue(bot, box, prefix: str, n: int):
+    for i in range(n):
+        box.put("pagos", {"id": f"{prefix}{i}", "user_id": str(i % 50), "qty": 1, "status": "pendiente"},
+                on_conflict="id")
+    for i in range(n):
+        box.put("pagos", {"id": f"{prefix}{i}", "status": "visto"}, on_conflict="id", op="patch")
+
+
+async def backlog(bot, pg, path: str, n: int) -> bool:
+    box = bot.SupabaseOutbox(path, 2 * n, bot.OUTBOX_BATCH, 0.01)
+    box.start()
+    enqueue(bot, box, "b", n)
+    calls0 = pg.calls
+    lags, stop = [], asyncio.Event()
+    ticker = asyncio.create_task(loop_lag(stop, lags))
+    t0 = time.perf_counter()
+    ok = await box.drain(timeout=600)
+    secs = time.perf_counter() - t0
+    stop.set()
+    await ticker
+    size = os.path.getsize(path)
+    await box.stop()
+    rows = [r for r in pg.tables.get("pagos", []) if r["id"].startswith("b")]
+    good = ok and len(rows) == n and all(r["status"] == "visto" for r in rows)
+    print(f"backlog de {n} inserts + {n} patch: {secs:.2f} s, {pg.calls - calls0} peticiones, "
+          f"lag máx {max(lags) * 1000:.1f} ms, journal al final {size} B  {'OK' if good else 'FALLA'}")
+    return good
+
+
+async def crash_replay(bot, pg, path: str, n: int) -> bool:
+    box = bot.SupabaseOutbox(path, 2 * n, bot.OUTBOX_BATCH, 0.01)
+    box.start()
+    enqueue(bot, box, "c", n)
+    box._wakeup.set()
+    box._flush_now.set()
+    while box._done < n // 2:     # a mitad de camino...
+        await asyncio.sleep(0.001)
+    box._task.cancel()            # ...se corta la luz (sin drain ni stop)
+    await asyncio.gather(box._task, return_exceptions=True)
+    box._journal.close()
+    left = len(box)
+
+    again = bot.SupabaseOutbox(path, 2 * n, bot.OUTBOX_BATCH, 0.01)
+    again.start()
+    replayed = len(again)
+    ok = await again.drain(timeout=600)
+    await again.stop()
+    rows = [r for r in pg.tables["pagos"] if r["id"].startswith("c")]
+    good = ok and replayed == left and len(rows) == n and all(r["status"] == "visto" for r in rows)
+    print(f"corte a mitad: {left} pendientes, {replayed} releídas del journal, "
+          f"{len(rows)} filas al final  {'OK' if good else 'FALLA'}")
+    return good
+
+
+async def proof_marks(bot, pg, path: str, n: int, rpc: bool) -> bool:
+    prefix = f"m{int(rpc)}-"
+    pg.tables.setdefault("pagos", []).extend(
+        {"id": f"{prefix}{i}", "user_id": "1", "qty": 1, "status": "pendiente"} for i in range(n))
+    if not rpc:
+        pg.rpcs.pop("marcar_comprobantes", None)
+    box = bot.SupabaseOutbox(path, 2 * n, bot.OUTBOX_BATCH, 0.01)
+    box.start()
+    bot.outbox = box
+    await bot.check_proof_mark_rpc()
+    calls0 = pg.calls
+    t0 = time.perf_counter()
+    await asyncio.gather(*(bot._mark_proof_received(f"{prefix}{i}", f"file-{i}") for i in range(n)))
+    ok = await box.drain(timeout=600)
+    secs = time.perf_counter() - t0
+    await box.stop()
+    rows = [r for r in pg.tables["pagos"] if r["id"].startswith(prefix)]
+    good = ok and all(r.get("comprobante_file_id") == f"file-{r['id'][len(prefix):]}" for r in rows)
+    print(f"{n} marcas de captura {'con marcar_comprobantes' if rpc else 'sin la función (PATCH)'}: "
+          f"{secs:.2f} s, {pg.calls - calls0} peticiones  {'OK' if good else 'FALLA'}")
+    return good
+
+
+async def main_async(args, bot, pg):
+    path = os.path.join(tempfile.mkdtemp(prefix="recargas-outbox-"), "outbox.jsonl")
+    ok = await backlog(bot, pg, path, args.rows)
+    ok &= await proof_marks(bot, pg, path, args.rows, rpc=True)
+    ok &= await proof_marks(bot, pg, path, min(args.rows, 500), rpc=False)
+    ok &= await crash_replay(bot, pg, path, args.rows)
+    await bot.sb_close()
+    return ok
+
+
+def main():
+    args = parse_args()
+    pg = install_recargas_rpcs(FakePostgrest(latency=args.latency_ms / 1000).start())
+    bot = load_bot(pg.url)
+    try:
+        ok = asyncio.run(main_async(args, bot, pg))
+    finally:
+        pg.stop()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
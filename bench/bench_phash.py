@@ -0,0 +1,246 @@
+# bench/bench_phash.py
+# -*- coding: utf-8 -*-
+"""
+Comprobantes duplicados (check_duplicate_proof + ProofHashIndex) con capturas de la
+misma plantilla, como las de Yape: fondo, tarjeta y textos iguales; solo cambian el
+monto, la hora y el número de operación.
+
+  distintos   N pagos legítimos, cada uno con su captura: ninguno debe marcarse
+  reenvíos    las primeras capturas vuelven a llegar en otros pedidos como
+              reenvío (mismo file_unique_id), mismo archivo subido otra vez (mismos
+              bytes) y recomprimida/redimensionada
+  variados    lo mismo con fotos de vouchers sin plantilla común, donde el
+              parecido perceptual (PROOF_PHASH=1) sí detecta las recomprimidas
+  búsqueda    latencia de lookup() con índices de 10k/100k hashes agrupados
+              alrededor de los de la plantilla (el peor caso del multi-hash) y
+              aleatorios
+
+Se corre en modo exacto (por defecto) y con PROOF_PHASH=1. Sale con código 1 si en
+modo exacto se marca algún pago legítimo, si algún reenvío o archivo repetido no
+se detecta, o si una búsqueda supera --max-lookup-ms.
+
+Uso:
+    python bench/bench_phash.py [--receipts 40] [--entries 10000,100000] [--queries 2000]
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _bootstrap import load_bot  # noqa: E402
+
+bot = None
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--receipts", type=int, default=40, help="capturas distintas de la plantilla")
+    p.add_argument("--entries", default="10000,100000", help="tamaños del índice para medir búsquedas")
+    p.add_argument("--queries", type=int, default=2000)
+    p.add_argument("--max-lookup-ms", type=float, default=5.0, help="peor búsqueda aceptada")
+    return p.parse_args()
+
+
+def font(size: int):
+    from PIL import ImageFont
+    try:
+        return ImageFont.load_default(size=size)   # FreeType (Pillow >= 10.1)
+    except (TypeError, OSError):
+        return ImageFont.load_default()
+
+
+def template_receipt(seed: int) -> bytes:
+    """Captura 1080x2340 de la plantilla: mismo monto y nombre, cambian hora y operación."""
+    from PIL import Image, ImageDraw
+    rnd = random.Random(seed)
+    im = Image.new("RGB", (1080, 2340), (116, 44, 148))
+    d = ImageDraw.Draw(im)
+    d.text((40, 20), f"{rnd.randint(0, 23):02d}:{rnd.randint(0, 59):02d}", fill=(255, 255, 255), font=font(28))
+    d.rounded_rectangle((60, 400, 1020, 1700), 40, fill=(255, 255, 255))
+    lines = [
+        ("¡Yapeaste!", 40), ("S/ 25", 64), ("Juan Perez Q.", 40),
+        (f"17 oct. 2026 - {rnd.randint(1, 12):02d}:{rnd.randint(0, 59):02d} pm", 28),
+        ("Nro. de operación", 28), (f"{rnd.randint(0, 99_999_999):08d}", 40),
+    ]
+    y = 460
+    for text, size in lines:
+        d.text((540, y), text, fill=(40, 20, 60), font=font(size), anchor="mt")
+        y += size + 60
+    buf = io.BytesIO()
+    im.save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+
+def varied_receipt(seed: int) -> bytes:
+    """Foto de un voucher cualquiera: colores y formas distintos en cada una."""
+    from PIL import Image, ImageDraw
+    rnd = random.Random(10_000 + seed)
+    color = lambda: tuple(rnd.randrange(256) for _ in range(3))  # noqa: E731
+    im = Image.new("RGB", (1080, 1440), color())
+    d = ImageDraw.Draw(im)
+    for _ in range(8):
+        x, y = rnd.randrange(900), rnd.randrange(1200)
+        d.rectangle((x, y, x + rnd.randint(80, 500), y + rnd.randint(80, 500)), fill=color())
+    d.text((100, 100), f"S/ {rnd.randint(10, 999)}", fill=color(), font=font(64))
+    buf = io.BytesIO()
+    im.save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+
+def recompress(data: bytes) -> bytes:
+    """La misma captura reenviada como imagen nueva: otro tamaño y otra calidad."""
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as im:
+        im = im.convert("RGB").resize((720, 1560))
+        buf = io.BytesIO()
+        im.save(buf, format="JPEG", quality=60)
+    return buf.getvalue()
+
+
+class FakeFile:
+    def __init__(self, data: bytes):
+        self.data = data
+
+    async def download_as_bytearray(self):
+        return bytearray(self.data)
+
+
+class FakePhoto:
+    def __init__(self, data: bytes, unique_id: str):
+        self.data = data
+        self.file_unique_id = unique_id
+
+    async def get_file(self):
+        return FakeFile(self.data)
+
+
+def use_index(phash: bool):
+    path = os.path.join(tempfile.mkdtemp(prefix="recargas-phash-"), "proof_hashes.txt")
+    bot.PROOF_PHASH = phash
+    bot.proof_index = bot.ProofHashIndex(
+        path, bot.PROOF_DUP_DISTANCE, phash, bot.PROOF_DUP_MAX_CANDIDATES, bot.PROOF_DUP_MAX_MATCHES,
+    )
+    bot.proof_index.load()
+    return bot.proof_index
+
+
+async def run_mode(phash: bool, images: list, copies: list) -> dict:
+    idx = use_index(phash)
+    flagged = 0
+    for i, data in enumerate(images):
+        flagged += await bot.check_duplicate_proof(FakePhoto(data, f"u{i}"), f"o{i}") is not None
+    found = {"reenvío": 0, "mismo archivo": 0, "recomprimida": 0}
+    for i, data in enumerate(copies):
+        cases = {
+            "reenvío": FakePhoto(images[i], f"u{i}"),
+            "mismo archivo": FakePhoto(images[i], f"u{i}-otra"),
+            "recomprimida": FakePhoto(data, f"u{i}-rec"),
+        }
+        for kind, photo in cases.items():
+            dup = await bot.check_duplicate_proof(photo, f"o{i}-{kind}")
+            found[kind] += dup is not None and dup[0] == f"o{i}"
+    idx.close()
+    return {"flagged": flagged, **found}
+
+
+def lookup_latency(idx, queries: list) -> list:
+    lat = []
+    for h in queries:
+        t = time.perf_counter()
+        idx.lookup(h)
+        lat.append(time.perf_counter() - t)
+    lat.sort()
+    return lat
+
+
+def fmt(lat: list) -> str:
+    p = lambda x: lat[min(len(lat) - 1, int(len(lat) * x))] * 1e6  # noqa: E731
+    return f"p50 {p(0.50):.1f} µs · p99 {p(0.99):.1f} µs · máx {lat[-1] * 1e6:.1f} µs"
+
+
+def flip_bits(h: int, n: int) -> int:
+    for b in random.sample(range(64), n):
+        h ^= 1 << b
+    return h
+
+
+def main():
+    global bot
+    args = parse_args()
+    bot = load_bot()
+    random.seed(1)
+    failed = 0
+
+    t0 = time.perf_counter()
+    images = [template_receipt(s) for s in range(args.receipts)]
+    copies = [recompress(d) for d in images[: max(1, args.receipts // 4)]]
+    print(f"{len(images)} capturas de la plantilla generadas en {time.perf_counter() - t0:.1f}s")
+
+    hashes = [bot.dhash(d) for d in images]
+    dists = sorted((a ^ b).bit_count() for i, a in enumerate(hashes) for b in hashes[i + 1:])
+    own = sorted((bot.dhash(c) ^ hashes[i]).bit_count() for i, c in enumerate(copies))
+    print(f"dHash entre pagos distintos: mín {dists[0]} · mediana {statistics.median(dists)} bits; "
+          f"misma captura recomprimida: hasta {own[-1]} bits")
+
+    for phash in (False, True):
+        res = asyncio.run(run_mode(phash, images, copies))
+        name = "PROOF_PHASH=1" if phash else "exacto"
+        n = len(copies)
+        print(f"{name}: pagos legítimos marcados {res['flagged']}/{len(images)} · "
+              f"reenvíos {res['reenvío']}/{n} · mismo archivo {res['mismo archivo']}/{n} · "
+              f"recomprimidas {res['recomprimida']}/{n}")
+        if not phash and res["flagged"]:
+            print("  FALLA: el modo exacto marcó pagos legítimos")
+            failed += 1
+        if phash and res["flagged"] > bot.PROOF_DUP_MAX_MATCHES:
+            print(f"  FALLA: con la plantilla se marcaron más de {bot.PROOF_DUP_MAX_MATCHES} pagos legítimos")
+            failed += 1
+        if res["reenvío"] < n or res["mismo archivo"] < n:
+            print("  FALLA: no se detectó un reenvío o un archivo repetido")
+            failed += 1
+
+    varied = [varied_receipt(s) for s in range(args.receipts)]
+    res = asyncio.run(run_mode(True, varied, [recompress(d) for d in varied[:len(copies)]]))
+    print(f"PROOF_PHASH=1 sin plantilla: pagos legítimos marcados {res['flagged']}/{len(varied)} · "
+          f"recomprimidas {res['recomprimida']}/{len(copies)}")
+
+    for size in (int(x) for x in args.entries.split(",") if x):
+        for kind in ("agrupados", "aleatorios"):
+            idx = bot.ProofHashIndex("", bot.PROOF_DUP_DISTANCE, True,
+                                     bot.PROOF_DUP_MAX_CANDIDATES, bot.PROOF_DUP_MAX_MATCHES)
+            if kind == "agrupados":
+                stored = [flip_bits(random.choice(hashes), random.randint(0, 2)) for _ in range(size)]
+                queries = [random.choice(hashes) for _ in range(args.queries)]
+            else:
+                stored = [random.getrandbits(64) for _ in range(size)]
+                queries = [flip_bits(random.choice(stored), random.randint(0, bot.PROOF_DUP_DISTANCE))
+                           for _ in range(args.queries)]
+            for i, h in enumerate(stored):
+                idx._index(h, f"o{i}")
+            lat = lookup_latency(idx, queries)
+            print(f"búsqueda con {size} hashes {kind}: {fmt(lat)}")
+            if lat[-1] * 1000 > args.max_lookup_ms:
+                print(f"  FALLA: búsqueda de {lat[-1] * 1000:.1f} ms (> {args.max_lookup_ms} ms)")
+                failed += 1
+
+    times = []
+    for data in images[:20]:
+        t = time.perf_counter()
+        bot.dhash(data)
+        times.append(time.perf_counter() - t)
+    print(f"dHash de una captura 1080x2340 ({len(images[0]) // 1024} KB): {statistics.median(times) * 1000:.1f} ms")
+
+    print("comprobantes OK" if not failed else f"{failed} comprobaciones fallaron")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
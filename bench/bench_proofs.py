@@ -0,0 +1,208 @@
+# bench/bench_proofs.py
+# -*- coding: utf-8 -*-
+"""
+Benchmark del archivo de comprobantes: un lote de capturas de muestra servidas por
+el Bot API falso pasa por stage_proof() + archive_proof() (descarga por partes,
+dHash + miniatura WebP en el pool, movida al archivo o subida al Storage falso, y
+patch de 'pagos' en el PostgREST falso) en los modos PROOF_ARCHIVE=disk y bucket,
+con distintas combinaciones de concurrencia de descargas y procesos del pool.
+
+Por combinación se mide el throughput (capturas/s), la latencia p50/p95 por captura,
+el peor retraso del event loop mientras corre el lote (lo que notaría un handler) y
+el crecimiento del RSS máximo del proceso. Las filas "hilos" usan un ThreadPool en
+lugar de procesos, para comparar.
+
+Antes se comprueba que el pool se recupera si un proceso muere: el trabajo que lo
+mató y el que corría al lado se reintentan en un pool nuevo (sale con código 1 si no).
+
+Uso:
+    python bench/bench_proofs.py [--images 200] [--modes disk,bucket]
+                                 [--concurrency 1,4,8] [--workers 1,2,4]
+                                 [--tg-latency-ms 20]
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _bootstrap import load_bot  # noqa: E402
+from fake_postgrest import FakePostgrest  # noqa: E402
+from fake_telegram import FakeTelegram  # noqa: E402
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--images", type=int, default=200)
+    p.add_argument("--modes", default="disk,bucket", help="valores de PROOF_ARCHIVE")
+    p.add_argument("--concurrency", default="1,4,8", help="valores de PROOF_ARCHIVE_CONCURRENCY")
+    p.add_argument("--workers", default="1,2,4", help="valores de PROOF_WORKERS")
+    p.add_argument("--tg-latency-ms", type=float, default=20)
+    return p.parse_args()
+
+
+def sample_screenshot(seed: int) -> bytes:
+    """Imagen de 1080x2340 parecida a una captura de Yape (distinta por semilla)."""
+    from PIL import Image, ImageDraw
+    rnd = random.Random(seed)
+    im = Image.new("RGB", (1080, 2340), (116, 44, 148))
+    d = ImageDraw.Draw(im)
+    d.rectangle((60, 400, 1020, 1500), fill=(255, 255, 255))
+    for i in range(12):
+        d.text((120, 460 + i * 80), f"Yape S/ {rnd.randint(10, 999)}.00  op {rnd.random():.8f}", fill=(0, 0, 0))
+    buf = io.BytesIO()
+    im.save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+
+def die_once(marker: str) -> int:
+    """En un proceso del pool: la primera vez mata al proceso; al reintentar devuelve su pid."""
+    if not os.path.exists(marker):
+        open(marker, "w").close()
+        os._exit(1)
+    return os.getpid()
+
+
+async def check_broken_pool(bot) -> bool:
+    await bot.close_proof_archive()
+    bot.PROOF_WORKERS = 2
+    first = bot._proof_get_pool()
+    marker = os.path.join(tempfile.mkdtemp(prefix="recargas-pool-"), "murio")
+    try:
+        results = await asyncio.gather(
+            bot._proof_submit(time.sleep, 0.5),
+            bot._proof_submit(die_once, marker),
+        )
+        after = await bot._proof_submit(abs, -3)
+        ok = os.path.exists(marker) and isinstance(results[1], int) and after == 3 and bot._proof_pool is not first
+    except BrokenProcessPool:
+        ok = False
+    print(f"pool roto: un proceso muere y los trabajos se reintentan en un pool nuevo  {'OK' if ok else 'FALLA'}")
+    await bot.close_proof_archive()
+    return ok
+
+
+def maxrss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def loop_lag(stop: asyncio.Event, out: list):
+    """Peor retraso de un sleep de 5 ms mientras corre el lote."""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        t = loop.time()
+        await asyncio.sleep(0.005)
+        out.append(loop.time() - t - 0.005)
+
+
+async def run_batch(bot, photos, concurrency: int, workers: int, threads: bool) -> dict:
+    await bot.close_proof_archive()
+    bot.PROOF_ARCHIVE_CONCURRENCY = concurrency
+    bot.PROOF_WORKERS = workers
+    bot._archive_get_client()
+    if threads:
+        bot._proof_pool = ThreadPoolExecutor(workers)
+    else:
+        # los procesos del pool arrancan con el primer trabajo: que no cuenten en la medición
+        await asyncio.gather(*(bot._proof_submit(time.sleep, 0.05) for _ in range(workers)))
+
+    lat = []
+
+    async def one(i, photo):
+        t = time.perf_counter()
+        order_id = f"b{concurrency}{workers}{int(threads)}-{i}"
+        staged = asyncio.ensure_future(bot.stage_proof(photo, order_id))
+        ok = await bot.archive_proof(order_id, staged)
+        lat.append(time.perf_counter() - t)
+        return ok
+
+    lags, stop = [], asyncio.Event()
+    ticker = asyncio.create_task(loop_lag(stop, lags))
+    rss0 = maxrss_mb()
+    t0 = time.perf_counter()
+    ok = sum(await asyncio.gather(*(one(i, p) for i, p in enumerate(photos))))
+    wall = time.perf_counter() - t0
+    stop.set()
+    await ticker
+    lat.sort()
+    return {
+        "ok": ok,
+        "rate": len(photos) / wall,
+        "p50": statistics.median(lat) * 1000,
+        "p95": lat[int(len(lat) * 0.95) - 1] * 1000,
+        "lag": max(lags) * 1000,
+        "rss": maxrss_mb() - rss0,
+    }
+
+
+async def main_async(args, bot, pg, photos):
+    ok = await check_broken_pool(bot)
+    app = bot.build_app()
+    await app.initialize()
+    for p in photos:
+        p.set_bot(app.bot)
+    print(f"{'modo':<8}{'pool':<9}{'conc':>5}{'procs':>6}{'capt/s':>9}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'lag máx':>10}{'ΔRSS':>9}")
+    for mode in [m.strip() for m in args.modes.split(",") if m.strip()]:
+        bot.PROOF_ARCHIVE = mode
+        for threads in (False, True):
+            for workers in [int(x) for x in args.workers.split(",")]:
+                for conc in [int(x) for x in args.concurrency.split(",")]:
+                    r = await run_batch(bot, photos, conc, workers, threads)
+                    print(f"{mode:<8}{'hilos' if threads else 'procesos':<9}{conc:>5}{workers:>6}{r['rate']:>9.1f}"
+                          f"{r['p50']:>9.1f}{r['p95']:>9.1f}{r['lag']:>8.1f}ms{r['rss']:>6.1f} MB"
+                          + ("" if r["ok"] == len(photos) else f"  ({len(photos) - r['ok']} no archivadas)"))
+        if mode == "bucket":
+            print(f"bucket: {len(pg.objects)} objetos en el Storage falso")
+    leftovers = os.listdir(bot._PROOF_TMP) if os.path.isdir(bot._PROOF_TMP) else []
+    if leftovers:
+        print(f"quedaron {len(leftovers)} archivos en {bot._PROOF_TMP}")
+    await bot.close_proof_archive()
+    await app.shutdown()
+    return ok
+
+
+def main():
+    args = parse_args()
+    from telegram import PhotoSize
+
+    tg = FakeTelegram(latency=args.tg_latency_ms / 1000).start()
+    pg = FakePostgrest().start()
+    archive_dir = tempfile.mkdtemp(prefix="recargas-archivo-")
+    bot = load_bot(pg.url, TG_API_BASE_URL=tg.url, PROOF_ARCHIVE="disk", PROOF_ARCHIVE_DIR=archive_dir)
+    # las filas de 'pagos' a enlazar (el patch de archive_proof debe encontrar cada pedido)
+    pg.tables["pagos"] = []
+
+    images = [sample_screenshot(i) for i in range(args.images)]
+    photos = []
+    for i, data in enumerate(images):
+        tg.files[f"proof-{i}"] = data
+        photos.append(PhotoSize(f"proof-{i}", f"u{i}", 1080, 2340, file_size=len(data)))
+    print(f"{len(images)} capturas 1080x2340, {statistics.mean(map(len, images)) / 1024:.0f} KB de media; "
+          f"latencia Bot API {args.tg_latency_ms:.0f} ms; {os.cpu_count()} CPUs")
+    try:
+        ok = asyncio.run(main_async(args, bot, pg, photos))
+        thumbs = [os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(archive_dir)
+                  for f in fs if f.endswith(".webp")]
+        if thumbs:
+            print(f"miniaturas WebP {bot.PROOF_THUMB_SIZE}px: {statistics.mean(thumbs) / 1024:.1f} KB de media")
+    finally:
+        tg.stop()
+        pg.stop()
+        shutil.rmtree(archive_dir, ignore_errors=True)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# bench/bench_resilience.py
+# -*- coding: utf-8 -*-
+"""
+Latencia de get_user_terms (lo que espera un handler para cotizar) con Supabase
+degradado, usando las fallas inyectables de FakePostgrest:
+
+    cola lenta  -> slow_rate de las respuestas tarda slow_latency
+    errores     -> error_rate de las respuestas son 503
+    caído       -> todas son 503 (el circuito debería abrirse)
+
+Cada escenario corre dos veces en procesos separados: con la capa de resiliencia
+(hedge, reintentos, circuito, stale-while-revalidate) y con ella apagada (una sola
+llamada con SB_TIMEOUT, como antes).
+
+Uso:
+    python bench/bench_resilience.py [llamadas]
+"""
+
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+N = int(os.environ.get("BENCH_N") or (sys.argv[1] if len(sys.argv) == 2 else 400))
+USERS = 200
+
+SCENARIOS = {
+    "cola lenta": {"slow_rate": 0.05, "slow_latency": 3.0},
+    "errores 30%": {"error_rate": 0.3},
+    "caído": {"error_rate": 1.0},
+}
+
+PLAIN = {
+    "SB_TIMEOUT": "5",
+    "SB_READ_BUDGET": "5",
+    "SB_HEDGE_AFTER": "0",
+    "SB_READ_RETRIES": "0",
+    "SB_BREAKER_MIN_CALLS": "1000000",
+    "USER_CACHE_STALE": "0",
+}
+RESILIENT = {"SB_TIMEOUT": "5", "SB_READ_BUDGET": "2", "SB_HEDGE_AFTER": "0.2"}
+
+
+def pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def child(scenario: str):
+    from _bootstrap import load_bot
+    from fake_postgrest import FakePostgrest
+
+    fake = FakePostgrest(latency=0.005).start()
+    fake.tables["usuarios"] = [
+        {"telegram_id": str(i), "username": f"u{i}", "creditos": 5, "cuentas_asignadas": i % 20}
+        for i in range(USERS)
+    ]
+    bot = load_bot(fake.url, USER_CACHE_TTL="0.05", METRICS_ENABLED="0")
+
+    async def run():
+        # calienta el cache con Supabase sano; luego se degrada
+        await asyncio.gather(*(bot.get_user_terms(i) for i in range(USERS)))
+        await asyncio.sleep(0.1)   # todas las filas quedan vencidas (TTL 50 ms)
+        for k, v in SCENARIOS[scenario].items():
+            setattr(fake, k, v)
+        lat, fails = [], 0
+
+        async def one(i):
+            nonlocal fails
+            t0 = time.perf_counter()
+            try:
+                await bot.get_user_terms(i % USERS)
+            except bot.SupabaseUnavailable:
+                fails += 1
+            lat.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        for start in range(0, N, 50):
+            if os.environ.get("BENCH_COLD"):
+                bot.user_cache._data.clear()   # sin respaldo: mide el circuito y los reintentos
+            await asyncio.gather(*(one(i) for i in range(start, start + 50)))
+        elapsed = time.perf_counter() - t0
+        await bot.sb_close()
+        return lat, fails, elapsed
+
+    lat, fails, elapsed = asyncio.run(run())
+    print(f"{pct(lat, 0.5) * 1000:.1f} {pct(lat, 0.99) * 1000:.1f} {fails} {elapsed:.2f} {fake.calls}")
+    fake.stop()
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "--child":
+        return child(sys.argv[2])
+    print(f"{N} cotizaciones por escenario, {USERS} usuarios")
+    print(f"{'escenario':12s} {'modo':11s} {'cache':6s} {'p50 ms':>8s} {'p99 ms':>8s} {'fallos':>7s} {'total s':>8s} {'HTTP':>6s}")
+    for scenario in SCENARIOS:
+        for cold in (False, True):
+            for name, env in (("sin capa", PLAIN), ("resiliente", RESILIENT)):
+                out = subprocess.run(
+                    [sys.executable, __file__, "--child", scenario],
+                    env={**os.environ, **env, "BENCH_COLD": "1" if cold else "", "BENCH_N": str(N)},
+                    capture_output=True, text=True, check=True,
+                ).stdout.split()
+                p50, p99, fails, total, calls = out[-5:]
+                print(f"{scenario:12s} {name:11s} {'frío' if cold else 'tibio':6s} "
+                      f"{p50:>8s} {p99:>8s} {fails:>7s} {total:>8s} {calls:>6s}")
+
+
+if __name__ == "__main__":
+    main()
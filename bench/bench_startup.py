@@ -0,0 +1,157 @@
+# bench/bench_startup.py
+# -*- coding: utf-8 -*-
+"""
+Arranque y memoria del proceso completo (python recharge_bot.py) en modo polling,
+contra el Bot API falso y el PostgREST falso. Por cada corrida se mide:
+
+  health  ms hasta el primer 200 de /health
+  listo   ms hasta el primer getUpdates (el bot ya atiende)
+  rss     memoria residente (VmRSS) con el bot listo, en MB
+  apagado ms desde SIGTERM hasta que el proceso termina
+
+Con --rev se mide también el recharge_bot.py de otro commit (por ejemplo el
+anterior a un cambio) para comparar antes/después en la misma máquina.
+
+Uso:
+    python bench/bench_startup.py [--runs 5] [--modes asyncio,flask] [--rev HEAD~1]
+"""
+
+import argparse
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _bootstrap import ROOT  # noqa: E402
+from fake_postgrest import FakePostgrest  # noqa: E402
+from fake_telegram import FakeTelegram  # noqa: E402
+
+
+class ReadyTelegram(FakeTelegram):
+    """Avisa con un Event cuando llega el primer getUpdates."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ready = threading.Event()
+        self.ready_at = None
+        self.server.handle_error = lambda *a: None   # el getUpdates pendiente al matar el bot
+
+    def dispatch(self, method, params):
+        if method == "getUpdates" and not self.ready.is_set():
+            self.ready_at = time.perf_counter()
+            self.ready.set()
+        return super().dispatch(method, params)
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--modes", default="asyncio,flask", help="valores de HTTP_SERVER a medir")
+    p.add_argument("--rev", help="commit con el que comparar (git show REV:recharge_bot.py)")
+    p.add_argument("--timeout", type=float, default=30)
+    return p.parse_args()
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _rss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _health_ok(port: int) -> bool:
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1) as r:
+            return r.status == 200
+    except OSError:
+        return False
+
+
+def run_once(script: str, mode: str, timeout: float) -> dict:
+    tg = ReadyTelegram().start()
+    pg = FakePostgrest().start()
+    port = _free_port()
+    env = {
+        **os.environ,
+        "TG_RECHARGE_BOT_TOKEN": "123:bench",
+        "ADMIN_CHAT_ID": "1",
+        "SUPABASE_URL": pg.url,
+        "SUPABASE_API_KEY": "bench",
+        "YAPE_QR_URL": "https://example.com/qr.png",
+        "DATA_DIR": tempfile.mkdtemp(prefix="recargas-startup-"),
+        "TG_API_BASE_URL": tg.url,
+        "BOT_MODE": "polling",
+        "HTTP_SERVER": mode,
+        "PORT": str(port),
+    }
+    t0 = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, script], env=env, cwd=os.path.dirname(script),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    out = {}
+    try:
+        while not _health_ok(port):
+            if proc.poll() is not None or time.perf_counter() - t0 > timeout:
+                raise RuntimeError(proc.stderr.read().decode(errors="replace")[-2000:] or "sin /health")
+            time.sleep(0.005)
+        out["health"] = (time.perf_counter() - t0) * 1000
+        if not tg.ready.wait(timeout):
+            raise RuntimeError("el bot nunca pidió getUpdates")
+        out["listo"] = (tg.ready_at - t0) * 1000
+        time.sleep(0.2)   # que termine post_init/start antes de medir memoria
+        out["rss"] = _rss_mb(proc.pid)
+        t_stop = time.perf_counter()
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+        out["apagado"] = (time.perf_counter() - t_stop) * 1000
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        tg.stop()
+        pg.stop()
+    return out
+
+
+def measure(label: str, script: str, mode: str, args) -> None:
+    runs = [run_once(script, mode, args.timeout) for _ in range(args.runs)]
+    med = {k: statistics.median(r[k] for r in runs) for k in runs[0]}
+    print(f"{label:<22}{mode:<9}"
+          f"{med['health']:>9.0f} ms{med['listo']:>9.0f} ms{med['rss']:>8.1f} MB{med['apagado']:>9.0f} ms")
+
+
+def main():
+    args = parse_args()
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    print(f"{'versión':<22}{'HTTP':<9}{'health':>12}{'listo':>12}{'rss':>11}{'apagado':>12}   (mediana de {args.runs})")
+    for mode in modes:
+        measure("árbol actual", os.path.join(ROOT, "recharge_bot.py"), mode, args)
+    if args.rev:
+        tmp = tempfile.mkdtemp(prefix="recargas-rev-")
+        script = os.path.join(tmp, "recharge_bot.py")
+        with open(script, "wb") as f:
+            f.write(subprocess.check_output(["git", "show", f"{args.rev}:recharge_bot.py"], cwd=ROOT))
+        # antes de HTTP_SERVER solo existía Flask: una sola fila
+        measure(args.rev, script, "flask", args)
+
+
+if __name__ == "__main__":
+    main()
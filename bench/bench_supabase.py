@@ -0,0 +1,83 @@
+# bench/bench_supabase.py
+# -*- coding: utf-8 -*-
+"""
+Compara el acceso a Supabase antiguo (requests síncrono, una conexión TLS/TCP
+nueva por llamada y bloqueando el event loop) contra el cliente async con pool.
+
+Uso:
+    python bench/bench_supabase.py [llamadas] [latencia_ms]
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _bootstrap import load_bot  # noqa: E402
+from fake_postgrest import FakePostgrest  # noqa: E402
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+LATENCY = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.02
+
+fake = FakePostgrest(latency=LATENCY).start()
+fake.tables["usuarios"] = [
+    {"telegram_id": str(i), "username": f"u{i}", "creditos": 5, "cuentas_asignadas": i % 20}
+    for i in range(1000)
+]
+
+bot = load_bot(fake.url)
+
+
+async def old_style():
+    """Como antes: una llamada bloqueante tras otra, sin Session."""
+    for i in range(N):
+        r = httpx.get(
+            f"{fake.url}/rest/v1/usuarios",
+            params={"select": "*", "telegram_id": f"eq.{i % 1000}"},
+            headers=bot.SB_HEADERS,
+            timeout=10,
+        )
+        r.raise_for_status()
+
+
+async def new_style():
+    await asyncio.gather(*(bot.sb_get_user(i % 1000) for i in range(N)))
+    await bot.sb_close()
+
+
+async def loop_lag(coro):
+    """Mide el peor retraso del event loop mientras corre `coro`."""
+    worst = 0.0
+    done = False
+
+    async def probe():
+        nonlocal worst
+        while not done:
+            t = time.perf_counter()
+            await asyncio.sleep(0.005)
+            worst = max(worst, time.perf_counter() - t - 0.005)
+
+    p = asyncio.create_task(probe())
+    await asyncio.sleep(0)
+    t0 = time.perf_counter()
+    await coro
+    elapsed = time.perf_counter() - t0
+    done = True
+    await p
+    return elapsed, worst
+
+
+def main():
+    for name, fn in (("requests-like (sync, sin pool)", old_style), ("httpx async + pool", new_style)):
+        elapsed, lag = asyncio.run(loop_lag(fn()))
+        print(f"{name:32s} {N} llamadas en {elapsed:6.2f}s  "
+              f"({N / elapsed:7.1f} req/s)  lag máx. del loop {lag * 1000:7.1f} ms")
+    fake.stop()
+
+
+if __name__ == "__main__":
+    main()
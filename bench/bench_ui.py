@@ -0,0 +1,186 @@
+# bench/bench_ui.py
+# -*- coding: utf-8 -*-
+"""
+Costo por update de la navegación del menú: /start y los botones Recargar, Mis
+créditos, Ayuda y Cancelar, procesados uno a uno con Application.process_update()
+contra el Bot API y el PostgREST falsos (en otro proceso, para no contar su memoria).
+
+Por paso se mide:
+  llamadas  llamadas a la API de Telegram por update
+  pico KB   memoria transitoria máxima por update (tracemalloc, pico - base)
+  bloques   bloques de memoria vivos que deja cada update (tracemalloc)
+  µs        tiempo de CPU por update (sin tracemalloc)
+
+Se corre para el árbol actual con UI_EDIT_IN_PLACE=1 y =0 y, con --rev, para el
+recharge_bot.py de otro commit (antes/después).
+
+Uso:
+    python bench/bench_ui.py [--updates 300] [--rev HEAD~1]
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _bootstrap import ROOT, load_bot  # noqa: E402
+
+STEPS = ("start", "recargar", "saldo", "ayuda", "cancel")
+BASE_UID = 50_000
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--updates", type=int, default=300, help="updates por paso")
+    p.add_argument("--rev", help="commit con el que comparar (git show REV:recharge_bot.py)")
+    p.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    p.add_argument("--script-dir", default=ROOT, help=argparse.SUPPRESS)
+    return p.parse_args()
+
+
+def _serve_fakes(urls):
+    from fake_postgrest import FakePostgrest
+    from fake_telegram import FakeTelegram
+    tg = FakeTelegram().start()
+    pg = FakePostgrest().start()
+    urls.put((tg.url, pg.url))
+    while True:
+        time.sleep(3600)
+
+
+class Updates:
+    """Fábrica de updates en JSON (mensajes y pulsaciones sobre el mensaje del menú)."""
+
+    def __init__(self):
+        self._ids = 0
+
+    def _next(self):
+        self._ids += 1
+        return self._ids
+
+    def _user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"u{uid}"}
+
+    def start(self, uid):
+        return {"update_id": self._next(), "message": {
+            "message_id": self._next(), "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"}, "from": self._user(uid),
+            "text": "/start", "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        }}
+
+    def button(self, uid, data):
+        menu = {
+            "message_id": self._next(), "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": {"id": 123, "is_bot": True, "first_name": "Bench"},
+            "text": "menú",
+        }
+        return {"update_id": self._next(), "callback_query": {
+            "id": str(self._next()), "from": self._user(uid), "chat_instance": str(uid),
+            "data": data, "message": menu,
+        }}
+
+
+async def worker(args):
+    ctx = multiprocessing.get_context("fork")
+    urls = ctx.Queue()
+    fakes = ctx.Process(target=_serve_fakes, args=(urls,), daemon=True)
+    fakes.start()
+    tg_url, pg_url = urls.get(timeout=10)
+
+    if args.script_dir != ROOT:
+        sys.path[:0] = [args.script_dir, ROOT]   # que load_bot importe el de --rev
+    bot = load_bot(pg_url, TG_API_BASE_URL=tg_url,
+                   TG_GLOBAL_RATE="1000000", TG_CHAT_RATE="1000000", TG_GROUP_RATE="1000000")
+    app = bot.build_app() if hasattr(bot, "build_app") else bot.app_tg
+    await app.initialize()
+
+    calls = [0]
+
+    async def count(request):
+        calls[0] += 1
+    app.bot.request._client.event_hooks["request"].append(count)
+
+    from telegram import Update
+    make = Updates()
+
+    def batch(step):
+        uids = range(BASE_UID, BASE_UID + args.updates)
+        raw = [make.start(u) if step == "start" else make.button(u, step) for u in uids]
+        return [Update.de_json(r, app.bot) for r in raw]
+
+    # calentamiento: cache de usuarios, QR, imports perezosos de PTB
+    for step in STEPS:
+        for u in batch(step)[:20]:
+            await app.process_update(u)
+
+    out = {}
+    for step in STEPS:
+        updates = batch(step)
+        c0, t0 = calls[0], time.process_time()
+        for u in updates:
+            await app.process_update(u)
+        cpu = (time.process_time() - t0) / len(updates)
+        n_calls = (calls[0] - c0) / len(updates)
+
+        updates = batch(step)
+        tracemalloc.start()
+        peaks = []
+        blocks0 = len(tracemalloc.take_snapshot().traces)
+        for u in updates:
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            await app.process_update(u)
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+        blocks = (len(tracemalloc.take_snapshot().traces) - blocks0) / len(updates)
+        tracemalloc.stop()
+        peaks.sort()
+        out[step] = {
+            "calls": n_calls,
+            "peak_kb": peaks[len(peaks) // 2] / 1024,
+            "blocks": blocks,
+            "cpu_us": cpu * 1e6,
+        }
+    await app.shutdown()
+    fakes.kill()
+    print(json.dumps(out))
+
+
+def run_variant(label, args, script_dir=ROOT, **env):
+    cmd = [sys.executable, os.path.abspath(__file__), "--worker",
+           "--updates", str(args.updates), "--script-dir", script_dir]
+    res = subprocess.run(cmd, env={**os.environ, **env}, capture_output=True, text=True)
+    if res.returncode != 0:
+        raise SystemExit(f"{label}: falló\n{res.stderr[-2000:]}")
+    data = json.loads(res.stdout.strip().splitlines()[-1])
+    for step in STEPS:
+        r = data[step]
+        print(f"{label:<20}{step:<10}{r['calls']:>9.2f}{r['peak_kb']:>10.1f}{r['blocks']:>9.1f}{r['cpu_us']:>9.0f}")
+    return data
+
+
+def main():
+    args = parse_args()
+    if args.worker:
+        asyncio.run(worker(args))
+        return
+    print(f"{'versión':<20}{'paso':<10}{'llamadas':>9}{'pico KB':>10}{'bloques':>9}{'µs':>9}   ({args.updates} updates por paso)")
+    run_variant("árbol actual", args, UI_EDIT_IN_PLACE="1")
+    run_variant("UI_EDIT_IN_PLACE=0", args, UI_EDIT_IN_PLACE="0")
+    if args.rev:
+        tmp = tempfile.mkdtemp(prefix="recargas-rev-")
+        with open(os.path.join(tmp, "recharge_bot.py"), "wb") as f:
+            f.write(subprocess.check_output(["git", "show", f"{args.rev}:recharge_bot.py"], cwd=ROOT))
+        run_variant(args.rev, args, script_dir=tmp)
+
+
+if __name__ == "__main__":
+    main()
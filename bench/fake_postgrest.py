@@ -0,0 +1,335 @@
+# bench/fake_postgrest.py
+# -*- coding: utf-8 -*-
+"""
+Servidor PostgREST de mentira (solo stdlib) para benchmarks locales.
+
+Guarda las tablas en memoria y entiende el subconjunto de la API que usa el bot:
+filtros eq./in./gt./gte./lt./lte./is. (y not.), and=(...), select, order, limit/offset, cabecera
+Range (Range-Unit: items), inserts (objeto o
+array), upsert con on_conflict + resolution=ignore-duplicates o merge-duplicates,
+PATCH, DELETE y /rpc/<fn>. `defaults` completa columnas al insertar (como un
+default de Postgres, p. ej. created_at).
+También acepta subidas a Supabase Storage (POST /storage/v1/object/<bucket>/<ruta>),
+que quedan en `objects`.
+Permite inyectar latencia para simular la red hacia Supabase y fallas: una fracción
+de respuestas 503 (error_rate) y una cola de respuestas lentas (slow_rate, slow_latency).
+"""
+
+import functools
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+
+def _coerce(v):
+    return str(v) if v is not None else None
+
+
+@functools.lru_cache(maxsize=256)
+def _in_list(val: str) -> frozenset:
+    return frozenset(x.strip().strip('"') for x in val.strip("()").split(","))
+
+
+def _match(row: dict, col: str, expr: str) -> bool:
+    op, _, val = expr.partition(".")
+    if op == "not":
+        return not _match(row, col, val)
+    cur = _coerce(row.get(col))
+    if op == "eq":
+        return cur == val
+    if op == "neq":
+        return cur != val
+    if op == "in":
+        return cur in _in_list(val)
+    if op in ("gt", "gte", "lt", "lte"):
+        if cur is None:
+            return False
+        try:
+            a, b = float(cur), float(val)
+        except ValueError:
+            a, b = cur, val
+        return {"gt": a > b, "gte": a >= b, "lt": a < b, "lte": a <= b}[op]
+    if op == "is":
+        return (cur is None) == (val == "null")
+    return True
+
+
+class FakePostgrest:
+    """Levanta el servidor en un hilo; `url` apunta a la raíz (sin /rest/v1)."""
+
+    def __init__(self, latency: float = 0.0, host: str = "127.0.0.1", port: int = 0):
+        self.latency = latency
+        self.error_rate = 0.0     # fracción de peticiones que responden 503
+        self.slow_rate = 0.0      # fracción de peticiones que tardan slow_latency extra
+        self.slow_latency = 0.0
+        self.tables = {}
+        self.rpcs = {}
+        self.defaults = {}        # tabla -> fn() -> {columna: valor} para los inserts
+        self.objects = {}         # "<bucket>/<ruta>" -> (content-type, bytes) de Storage
+        self.calls = 0
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True   # cabeceras y cuerpo van en dos write(): sin esto, ~40 ms de ACK diferido
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, payload=None):
+                body = b"" if payload is None else json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _body(self):
+                n = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(n)) if n else None
+
+            def _handle(self, method):
+                parts = urlsplit(self.path)
+                query = parse_qsl(parts.query, keep_blank_values=True)
+                path = parts.path
+                if path.startswith("/storage/v1/object/") and method == "POST":
+                    return self._storage_put(path[len("/storage/v1/object/"):])
+                if not path.startswith("/rest/v1/"):
+                    return self._reply(404, {"message": "not found"})
+                name = path[len("/rest/v1/"):]
+                body = self._body() if method in ("POST", "PATCH") else None
+                with fake.lock:
+                    fake.calls += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if fake.slow_rate and random.random() < fake.slow_rate:
+                    time.sleep(fake.slow_latency)
+                if fake.error_rate and random.random() < fake.error_rate:
+                    return self._reply(503, {"message": "fallo inyectado"})
+                with fake.lock:
+                    status, payload = fake.dispatch(method, name, query, body, self.headers)
+                self._reply(status, payload)
+
+            def _storage_put(self, key):
+                # Supabase Storage: POST /storage/v1/object/<bucket>/<ruta> con el archivo crudo
+                n = int(self.headers.get("Content-Length") or 0)
+                data = self.rfile.read(n)
+                with fake.lock:
+                    fake.calls += 1
+                    fake.objects[key] = (self.headers.get("Content-Type", ""), data)
+                self._reply(200, {"Key": key})
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def do_PATCH(self):
+                self._handle("PATCH")
+
+            def do_DELETE(self):
+                self._handle("DELETE")
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # ---- lógica de tablas ----
+
+    def dispatch(self, method, name, query, body, headers):
+        if name.startswith("rpc/"):
+            fn = self.rpcs.get(name[4:])
+            if fn is None:
+                return 404, {"message": f"rpc {name} no existe"}
+            return 200, fn(self, body or {})
+
+        table = self.tables.setdefault(name, [])
+        filters = []
+        for k, v in query:
+            if k in ("select", "order", "limit", "offset", "on_conflict"):
+                continue
+            if k == "and":
+                # and=(col.op.val,col.op.val) sin anidar
+                for cond in v.strip("()").split(","):
+                    col, _, expr = cond.partition(".")
+                    filters.append((col, expr))
+            else:
+                filters.append((k, v))
+        opts = dict(query)
+        rows = [r for r in table if all(_match(r, k, v) for k, v in filters)]
+
+        if method == "GET":
+            if "order" in opts:
+                for key in reversed(opts["order"].split(",")):
+                    col, _, direction = key.partition(".")
+                    rows.sort(key=lambda r: (r.get(col) is None, r.get(col)), reverse=direction.startswith("desc"))
+            off = int(opts.get("offset", 0))
+            rows = rows[off:]
+            if "limit" in opts:
+                rows = rows[: int(opts["limit"])]
+            rng = headers.get("Range")
+            if rng:
+                lo, _, hi = rng.partition("-")
+                rows = rows[int(lo): int(hi) + 1 if hi else None]
+            return 200, rows
+
+        if method == "POST":
+            new_rows = body if isinstance(body, list) else [body]
+            conflict = opts.get("on_conflict")
+            prefer = headers.get("Prefer") or ""
+            defaults = self.defaults.get(name)
+            index = {_coerce(r.get(conflict)): r for r in table} if conflict else {}
+            out = []
+            for row in new_rows:
+                old = index.get(_coerce(row.get(conflict))) if conflict else None
+                if old:
+                    if "ignore-duplicates" in prefer:
+                        continue
+                    if "merge-duplicates" in prefer:
+                        old.update(row)
+                        out.append(dict(old))
+                        continue
+                    return 409, {"message": "duplicate key"}
+                row = {**(defaults() if defaults else {}), **row}
+                table.append(row)
+                if conflict:
+                    index[_coerce(row.get(conflict))] = row
+                out.append(dict(row))
+            return 201, out
+
+        if method == "PATCH":
+            for r in rows:
+                r.update(body or {})
+            return 200, [dict(r) for r in rows]
+
+        if method == "DELETE":
+            gone = {id(r) for r in rows}
+            table[:] = [r for r in table if id(r) not in gone]
+            return 200, rows
+
+        return 405, {"message": "method not allowed"}
+
+
+# ---- funciones SQL de sql/ emuladas (se registran con install_recargas_rpcs) ----
+
+def _credit(fake, user_id: str, qty: int) -> int:
+    users = fake.tables.setdefault("usuarios", [])
+    for u in users:
+        if _coerce(u.get("telegram_id")) == user_id:
+            u["creditos"] = int(u.get("creditos") or 0) + qty
+            break
+    else:
+        u = {"telegram_id": user_id, "creditos": qty, "cuentas_asignadas": 0}
+        users.append(u)
+    fake.tables.setdefault("creditos_historial", []).append(
+        {"usuario_id": user_id, "delta": qty, "motivo": "recarga_aprobada", "hecho_por": "admin"})
+    return u["creditos"]
+
+
+def _balance(fake, user_id: str) -> int:
+    for u in fake.tables.get("usuarios", []):
+        if _coerce(u.get("telegram_id")) == user_id:
+            return int(u.get("creditos") or 0)
+    return 0
+
+
+def aprobar_pago(fake, args):
+    """Como sql/aprobar_pago.sql: solo acredita pedidos pendientes (idempotente por order_id)."""
+    order_id, user_id, qty = str(args["p_order_id"]), str(args["p_user_id"]), int(args["p_qty"])
+    pagos = fake.tables.setdefault("pagos", [])
+    row = next((p for p in pagos if _coerce(p.get("id")) == order_id), None)
+    if row is None:
+        row = {"id": order_id, "user_id": user_id, "qty": qty, "status": "pendiente"}
+        pagos.append(row)
+    if row.get("status") != "pendiente":
+        return {"aplicado": False, "order_id": order_id, "user_id": user_id,
+                "qty": 0, "creditos": _balance(fake, user_id), "status": row.get("status")}
+    row["status"] = "aprobado"
+    qty = int(row.get("qty") or qty)
+    user_id = _coerce(row.get("user_id")) or user_id
+    return {"aplicado": True, "order_id": order_id, "user_id": user_id,
+            "qty": qty, "creditos": _credit(fake, user_id, qty), "status": "aprobado"}
+
+
+def aprobar_pagos(fake, args):
+    """Como sql/aprobar_pagos.sql: solo los pedidos aún pendientes."""
+    out = []
+    wanted = {str(x) for x in args["p_order_ids"]}
+    for row in fake.tables.get("pagos", []):
+        if _coerce(row.get("id")) in wanted and row.get("status") == "pendiente":
+            row["status"] = "aprobado"
+            user_id, qty = _coerce(row.get("user_id")), int(row.get("qty") or 0)
+            _credit(fake, user_id, qty)
+            out.append({"order_id": row["id"], "user_id": user_id, "qty": qty})
+    for item in out:
+        item["creditos"] = _balance(fake, item["user_id"])   # saldo final, como el join con 'saldos'
+    return out
+
+
+def marcar_comprobantes(fake, args):
+    """Como sql/pagos_comprobante.sql: aplica cada marca a su pedido."""
+    by_id = {_coerce(r.get("id")): r for r in fake.tables.get("pagos", [])}
+    for m in args.get("p_filas") or []:
+        row = by_id.get(_coerce(m["id"]))
+        if row is not None:
+            row.update(comprobante_file_id=m.get("comprobante_file_id"), comprobante_at=m.get("comprobante_at"))
+    return None
+
+
+def install_recargas_rpcs(fake):
+    fake.rpcs.update({"aprobar_pago": aprobar_pago, "aprobar_pagos": aprobar_pagos,
+                      "marcar_comprobantes": marcar_comprobantes})
+    return fake
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def tomar_lease(fake, args):
+    """Como tomar_lease de sql/coordinacion.sql: libre, vencido o ya de p_holder."""
+    name, holder = args["p_nombre"], args["p_holder"]
+    now = datetime.now(timezone.utc)
+    leases = fake.tables.setdefault("bot_leases", [])
+    row = next((r for r in leases if r["nombre"] == name), None)
+    expira = (now + timedelta(seconds=float(args["p_ttl"]))).isoformat()
+    if row is None:
+        leases.append({"nombre": name, "holder": holder, "expira": expira})
+        return True
+    if row["holder"] == holder or datetime.fromisoformat(row["expira"]) < now:
+        row.update(holder=holder, expira=expira)
+        return True
+    return False
+
+
+def soltar_lease(fake, args):
+    leases = fake.tables.setdefault("bot_leases", [])
+    leases[:] = [r for r in leases if not (r["nombre"] == args["p_nombre"] and r["holder"] == args["p_holder"])]
+    return None
+
+
+def install_coord_rpcs(fake):
+    """Tablas y funciones de sql/coordinacion.sql (COORD_BACKEND=supabase)."""
+    fake.rpcs.update({"tomar_lease": tomar_lease, "soltar_lease": soltar_lease})
+    fake.defaults["bot_updates"] = lambda: {"created_at": _now_iso()}
+    fake.defaults["bot_sesiones"] = lambda: {"updated_at": _now_iso()}
+    return fake
@@ -0,0 +1,176 @@
+# bench/fake_telegram.py
+# -*- coding: utf-8 -*-
+"""
+Servidor Bot API de mentira (solo stdlib) para benchmarks de punta a punta.
+
+Responde a POST /bot<token>/<método> con lo mínimo que python-telegram-bot necesita
+(getMe, sendMessage, sendPhoto, edit*, deleteMessage, answerCallbackQuery, getFile…)
+y sirve los archivos en GET /file/bot<token>/<ruta>. Acepta parámetros como JSON,
+form-urlencoded o multipart. Cada llamada se cuenta por método y se pasa a `on_call`
+(desde el hilo del servidor) para que el benchmark sepa qué le respondió el bot a
+cada chat.
+"""
+
+import json
+import threading
+import time
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+BOT_USER = {
+    "id": 123,
+    "is_bot": True,
+    "first_name": "Bench",
+    "username": "bench_bot",
+    "can_join_groups": False,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False,
+}
+
+
+def _parse_params(content_type: str, body: bytes) -> dict:
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    if content_type.startswith("multipart/form-data"):
+        msg = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        out = {}
+        for part in msg.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            payload = part.get_payload(decode=True)
+            out[name] = payload if part.get_filename() else payload.decode()
+        return out
+    return dict(parse_qsl(body.decode(), keep_blank_values=True))
+
+
+def _maybe_json(v):
+    if isinstance(v, str) and v[:1] in ("{", "["):
+        try:
+            return json.loads(v)
+        except ValueError:
+            pass
+    return v
+
+
+class FakeTelegram:
+    """Levanta el servidor en un hilo; `url` va en TG_API_BASE_URL."""
+
+    def __init__(self, latency: float = 0.0, host: str = "127.0.0.1", port: int = 0):
+        self.latency = latency
+        self.files = {}          # file_path -> bytes (para getFile + descarga)
+        self.calls = Counter()   # método -> llamadas
+        self.on_call = None      # fn(método, params, resultado) desde el hilo del servidor
+        self.lock = threading.Lock()
+        self._next_id = 1000
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True   # cabeceras y cuerpo van en dos write(): sin esto, ~40 ms de ACK diferido
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body: bytes, ctype="application/json"):
+                self.send_response(status)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                path = urlsplit(self.path).path
+                # /file/bot<token>/<ruta>
+                if path.startswith("/file/bot"):
+                    file_path = path.split("/", 3)[3]
+                    data = fake.files.get(file_path)
+                    if data is not None:
+                        with fake.lock:
+                            fake.calls["download"] += 1
+                        return self._send(200, data, "application/octet-stream")
+                self._send(404, b"")
+
+            def do_POST(self):
+                path = urlsplit(self.path).path
+                if not path.startswith("/bot"):
+                    return self._send(404, b"")
+                method = path.rsplit("/", 1)[-1]
+                n = int(self.headers.get("Content-Length") or 0)
+                params = _parse_params(self.headers.get("Content-Type", ""), self.rfile.read(n))
+                params = {k: _maybe_json(v) for k, v in params.items()}
+                if fake.latency:
+                    time.sleep(fake.latency)
+                result = fake.dispatch(method, params)
+                if fake.on_call:
+                    fake.on_call(method, params, result)
+                self._send(200, json.dumps({"ok": True, "result": result}).encode())
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def new_id(self) -> int:
+        with self.lock:
+            self._next_id += 1
+            return self._next_id
+
+    # ---- métodos de la Bot API ----
+
+    def _message(self, params: dict, **extra) -> dict:
+        msg = {
+            "message_id": int(params.get("message_id") or self.new_id()),
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id") or 0), "type": "private"},
+            "from": BOT_USER,
+        }
+        for key in ("text", "caption"):
+            if key in params:
+                msg[key] = params[key]
+        if isinstance(params.get("reply_markup"), dict):
+            msg["reply_markup"] = params["reply_markup"]
+        msg.update(extra)
+        return msg
+
+    def dispatch(self, method: str, params: dict):
+        with self.lock:
+            self.calls[method] += 1
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "editMessageText"):
+            return self._message(params)
+        if method in ("sendPhoto", "editMessageCaption", "editMessageReplyMarkup"):
+            n = self.new_id()
+            photo = [{"file_id": f"photo-{n}", "file_unique_id": f"u{n}", "width": 640, "height": 640}]
+            return self._message(params, photo=photo)
+        if method == "getFile":
+            file_id = params.get("file_id", "")
+            return {
+                "file_id": file_id,
+                "file_unique_id": f"u-{file_id}",
+                "file_size": len(self.files.get(file_id, b"")),
+                "file_path": file_id,
+            }
+        if method == "getUpdates":
+            # long polling vacío: el primero marca "bot listo" en bench_startup.py
+            time.sleep(min(float(params.get("timeout") or 0), 0.5))
+            return []
+        # deleteMessage, answerCallbackQuery, setWebhook, deleteWebhook, ...
+        return True
@@ -0,0 +1,11 @@
+# main.py
+# -*- coding: utf-8 -*-
+"""
+Punto de entrada del bot (ver Procfile). Los procesos del pool de comprobantes
+(forkserver/spawn) importan el script principal como __mp_main__: este no hace nada
+al importarse, así que cargan solo proof_worker y no vuelven a ejecutar el bot.
+"""
+
+if __name__ == "__main__":
+    import recharge_bot
+    recharge_bot.main()
@@ -0,0 +1,27 @@
+# proof_worker.py
+# -*- coding: utf-8 -*-
+"""
+Trabajo de Pillow para el archivo de comprobantes, aparte de recharge_bot.py para
+que los procesos del pool (forkserver/spawn) lo importen sin cargar ni arrancar
+el bot. Solo depende de Pillow.
+"""
+
+def dhash_image(im) -> int:
+    """dHash de una imagen PIL ya abierta."""
+    from PIL import Image
+    px = list(im.convert("L").resize((9, 8), Image.Resampling.BILINEAR).getdata())
+    h = 0
+    for row in range(8):
+        base = row * 9
+        for col in range(8):
+            h = (h << 1) | (px[base + col] > px[base + col + 1])
+    return h
+
+def proof_digest(src: str, thumb: str, size: int, quality: int) -> int:
+    """En un proceso del pool: abre la captura una vez -> dHash, y deja la miniatura en `thumb`."""
+    from PIL import Image
+    with Image.open(src) as im:
+        h = dhash_image(im)
+        im.thumbnail((size, size))
+        im.convert("RGB").save(thumb, "WEBP", quality=quality)
+    return h
@@ -1,39 +1,186 @@
 # recharge_bot.py
 # -*- coding: utf-8 -*-
 
+import time
+_T_START = time.perf_counter()   # para medir el arranque (ver serve_asyncio)
+
 import os
 import io
+import csv
+import hmac
+import functools
+import itertools
 import uuid
 import json
-import time
+import copy
+import hashlib
+import queue
+import atexit
+import contextvars
 import logging
+import logging.handlers
+import sqlite3
 import threading
+import random
 import asyncio
-from datetime import datetime
+import signal
+import sys
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlsplit
 
-import requests
-from flask import Flask, request
+import httpx
 
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
 )
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram.ext import (
     Application,
+    BasePersistence,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     ContextTypes,
+    PersistenceInput,
     filters,
 )
 
+from proof_worker import dhash_image, proof_digest
+
 # ============ LOGGING ============
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s"
+# Quien loguea (el loop del bot) no escribe en stderr: deja el registro en una cola
+# acotada y un hilo (QueueListener) lo formatea y lo escribe. Si el destino se atasca
+# y la cola se llena, se descartan líneas (y luego se avisa cuántas) en vez de frenar
+# el loop. LOG_FORMAT=json emite una línea JSON por registro con los campos de
+# contexto (order_id, user_id, handler, duration_ms). Por encima de LOG_SAMPLE_ABOVE
+# líneas por segundo, INFO/DEBUG pasan con probabilidad LOG_SAMPLE_RATE; WARNING o
+# más siempre pasan.
+LOG_LEVEL        = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT       = os.getenv("LOG_FORMAT", "text").strip().lower()   # text | json
+LOG_QUEUE_SIZE   = int(os.getenv("LOG_QUEUE_SIZE", "10000"))          # registros en vuelo
+LOG_SAMPLE_ABOVE = int(os.getenv("LOG_SAMPLE_ABOVE", "200"))          # líneas/s sin muestreo (0 = nunca muestrear)
+LOG_SAMPLE_RATE  = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))         # fracción de INFO/DEBUG que pasa después
+
+LOG_FIELDS = ("order_id", "user_id", "handler", "duration_ms")
+_log_ctx = contextvars.ContextVar("log_ctx", default={})
+
+def bind_log(**fields):
+    """Campos de contexto para los logs de la tarea actual (cada update corre en su tarea)."""
+    _log_ctx.set({**_log_ctx.get(), **fields})
+
+class _JsonFormatter(logging.Formatter):
+    default_time_format = "%Y-%m-%dT%H:%M:%S"
+    default_msec_format = "%s.%03d"
+
+    def format(self, record):
+        out = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in LOG_FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                out[key] = value
+        if record.exc_text:
+            out["exc"] = record.exc_text
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+class _SamplingFilter(logging.Filter):
+    """Deja pasar `per_sec` registros por segundo y luego muestrea INFO/DEBUG."""
+
+    def __init__(self, per_sec: int, rate: float):
+        super().__init__()
+        self.per_sec = per_sec
+        self.rate = rate
+        self.sampled_out = 0
+        self._second = 0
+        self._count = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        second = int(record.created)
+        if second != self._second:
+            self._second, self._count = second, 0
+        self._count += 1
+        if self._count <= self.per_sec or random.random() < self.rate:
+            return True
+        self.sampled_out += 1
+        return False
+
+class _DropQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que nunca bloquea: con la cola llena cuenta la línea y la descarta."""
+
+    _exc_formatter = logging.Formatter()
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0    # total, para /metrics
+        self._unreported = 0
+
+    def prepare(self, record):
+        # en el hilo que loguea solo se resuelve lo que no puede esperar (args, traza y
+        # contexto); el formato final lo hace el listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        for key, value in _log_ctx.get().items():
+            record.__dict__.setdefault(key, value)   # el extra= explícito gana
+        return record
+
+    def enqueue(self, record):
+        if self._unreported:
+            notice = logging.LogRecord(
+                log.name, logging.WARNING, __file__, 0,
+                "Logs: se descartaron %d líneas (cola llena)", (self._unreported,), None,
+            )
+            try:
+                self.queue.put_nowait(notice)
+                self._unreported = 0
+            except queue.Full:
+                pass
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self._unreported += 1
+
+class _LogListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)   # al salir sí esperamos: que se escriba lo pendiente
+
+_log_queue = queue.Queue(LOG_QUEUE_SIZE)
+_log_sink = logging.StreamHandler()
+_log_sink.setFormatter(
+    _JsonFormatter() if LOG_FORMAT == "json"
+    else logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
 )
+_log_handler = _DropQueueHandler(_log_queue)
+_log_sampler = _SamplingFilter(LOG_SAMPLE_ABOVE, LOG_SAMPLE_RATE) if LOG_SAMPLE_ABOVE > 0 else None
+if _log_sampler:
+    _log_handler.addFilter(_log_sampler)
+logging.basicConfig(level=LOG_LEVEL, handlers=[_log_handler])
+_log_listener = _LogListener(_log_queue, _log_sink)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 log = logging.getLogger("recargas")
+# httpx registra cada petición (Telegram y Supabase) en INFO; solo queremos avisos
+logging.getLogger("httpx").setLevel(logging.WARNING)
+# APScheduler (JobQueue) anuncia cada ejecución de job en INFO
+logging.getLogger("apscheduler").setLevel(logging.WARNING)
 
 # ============ ENV ============
 
@@ -44,6 +191,33 @@ PRICE_PER_CREDIT = float(os.getenv("PRICE_PER_CREDIT", "1"))
 SUPABASE_URL     = os.getenv("SUPABASE_URL", "").rstrip("/")
 SUPABASE_KEY     = os.getenv("SUPABASE_API_KEY", "")
 YAPE_QR_URL      = os.getenv("YAPE_QR_URL", "")
+YAPE_QR_PAYLOAD  = os.getenv("YAPE_QR_PAYLOAD", "")   # opcional: QR generado (ver "QR de Yape")
+# --- Modo de ingesta de updates ---
+# BOT_MODE=polling (por defecto) o webhook. En webhook Telegram hace POST a
+# WEBHOOK_URL + WEBHOOK_PATH y validamos la cabecera con WEBHOOK_SECRET.
+BOT_MODE          = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL       = os.getenv("WEBHOOK_URL", "").rstrip("/")      # ej: https://mi-app.herokuapp.com
+WEBHOOK_PATH      = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET    = os.getenv("WEBHOOK_SECRET", "")
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))   # updates pendientes (en cola o en curso) antes de responder 503
+# --- Réplicas (ver "Réplicas") ---
+# REPLICA_URLS: URL interna de cada réplica, en orden de índice (ej: http://10.0.0.2:8080)
+REPLICA_COUNT    = int(os.getenv("REPLICA_COUNT", "1"))
+REPLICA_INDEX    = int(os.getenv("REPLICA_INDEX", "0"))
+REPLICA_URLS     = [u.strip().rstrip("/") for u in os.getenv("REPLICA_URLS", "").split(",") if u.strip()]
+REPLICA_ID       = os.getenv("REPLICA_ID", f"r{REPLICA_INDEX}-{os.getpid()}")   # dueño del lease
+COORD_BACKEND    = os.getenv("COORD_BACKEND", "sqlite").strip().lower()        # sqlite | supabase
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "30"))                  # segundos
+# --- Procesamiento concurrente de updates ---
+BOT_CONCURRENCY   = int(os.getenv("BOT_CONCURRENCY", "32"))   # updates de clientes en paralelo
+ADMIN_CONCURRENCY = int(os.getenv("ADMIN_CONCURRENCY", "4"))  # carril propio del chat admin
+# --- Límites de envío a Telegram (mensajes por segundo) ---
+TG_GLOBAL_RATE          = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_CHAT_RATE            = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_GROUP_RATE           = float(os.getenv("TG_GROUP_RATE", str(20 / 60)))
+TG_MAX_RETRIES          = int(os.getenv("TG_MAX_RETRIES", "3"))
+TG_LOW_PRIORITY_RESERVE = float(os.getenv("TG_LOW_PRIORITY_RESERVE", "5"))
+TG_API_BASE_URL         = os.getenv("TG_API_BASE_URL", "").rstrip("/")   # opcional: Bot API local o de pruebas
 # --- Límites de compra ---
 MIN_QTY = 2           # compra mínima en cuentas
 # MAX_QTY = 100       # (opcional) tope máximo
@@ -90,15 +264,148 @@ def _parse_price_tiers(env_value: str):
 
 PRICE_TIERS = _parse_price_tiers(PRICE_TIERS_ENV)
 
-
-if not all([TG_BOT_TOKEN, ADMIN_CHAT_ID, SUPABASE_URL, SUPABASE_KEY, YAPE_QR_URL]):
+def _compile_tiers(price_tiers, min_qty_tiers):
+    """
+    Une PRICE_TIERS y MIN_QTY_TIERS en una sola tabla ordenada por cuentas_asignadas:
+    ([desde, ...], [(precio, minimo), ...]) para resolver ambos con un bisect.
+    """
+    keys = sorted({k for k, _ in price_tiers} | {k for k, _ in min_qty_tiers})
+    values = []
+    for k in keys:
+        price = price_tiers[0][1]
+        for min_asg, p in price_tiers:
+            if k >= min_asg:
+                price = p
+        min_qty = min_qty_tiers[0][1]
+        for min_asg, q in min_qty_tiers:
+            if k >= min_asg:
+                min_qty = q
+        values.append((price, max(1, min_qty)))
+    return keys, values
+
+# Tramos vigentes: (versión, [desde, ...], [(precio, mínimo), ...]). La versión 0 son
+# los del entorno; la tabla 'tramos' los reemplaza en caliente (ver "Tramos").
+TIERS = (0, *_compile_tiers(PRICE_TIERS, MIN_QTY_TIERS))
+
+def tier_for(asignadas: int):
+    """(precio, mínimo, versión de tramos) para una cantidad de cuentas_asignadas. O(log n), sin locks."""
+    version, keys, values = TIERS   # una sola lectura: la tupla nunca se modifica
+    price, min_qty = values[max(bisect_right(keys, asignadas) - 1, 0)]
+    return price, min_qty, version
+
+
+if not all([TG_BOT_TOKEN, ADMIN_CHAT_ID, SUPABASE_URL, SUPABASE_KEY, YAPE_QR_URL or YAPE_QR_PAYLOAD]):
     raise SystemExit(
         "Faltan variables: TG_RECHARGE_BOT_TOKEN, ADMIN_CHAT_ID, SUPABASE_URL, "
-        "SUPABASE_API_KEY, YAPE_QR_URL"
+        "SUPABASE_API_KEY, YAPE_QR_URL (o YAPE_QR_PAYLOAD)"
     )
 
-log.info("Recargas %s iniciando…", BRAND_NAME)
+if BOT_MODE not in ("polling", "webhook"):
+    raise SystemExit(f"BOT_MODE inválido: {BOT_MODE!r} (usa polling o webhook)")
+if BOT_MODE == "webhook" and not (WEBHOOK_URL and WEBHOOK_SECRET):
+    raise SystemExit("BOT_MODE=webhook requiere WEBHOOK_URL y WEBHOOK_SECRET")
+if COORD_BACKEND not in ("sqlite", "supabase"):
+    raise SystemExit(f"COORD_BACKEND inválido: {COORD_BACKEND!r} (usa sqlite o supabase)")
+if REPLICA_COUNT > 1:
+    if BOT_MODE != "webhook":
+        raise SystemExit("REPLICA_COUNT > 1 requiere BOT_MODE=webhook (getUpdates admite un solo consumidor)")
+    if not 0 <= REPLICA_INDEX < REPLICA_COUNT or len(REPLICA_URLS) != REPLICA_COUNT:
+        raise SystemExit("REPLICA_INDEX debe estar en 0..REPLICA_COUNT-1 y REPLICA_URLS tener REPLICA_COUNT URLs")
+
+def replica_path(path: str) -> str:
+    """Con varias réplicas, los archivos propios de cada una llevan sufijo .r<índice>."""
+    if REPLICA_COUNT == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.r{REPLICA_INDEX}{ext}"
+
+log.info("Recargas %s iniciando (modo %s)…", BRAND_NAME, BOT_MODE)
+if REPLICA_COUNT > 1:
+    log.info("Réplica %d de %d (%s, coordinador %s)", REPLICA_INDEX, REPLICA_COUNT, REPLICA_ID, COORD_BACKEND)
 log.info("YAPE_QR_URL: %s", "definido" if YAPE_QR_URL else "no definido")
+log.info("YAPE_QR_PAYLOAD: %s", "definido" if YAPE_QR_PAYLOAD else "no definido")
+
+# ============ Métricas (Prometheus) ============
+# /metrics en el servidor HTTP. Con METRICS_ENABLED=0 (o sin prometheus_client) los
+# decoradores devuelven la función original y los contadores no hacen nada.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_TOKEN   = os.getenv("METRICS_TOKEN", "")   # opcional: exige "Authorization: Bearer <token>"
+
+if METRICS_ENABLED:
+    try:
+        import prometheus_client as prom
+    except ImportError:
+        log.warning("prometheus_client no está instalado: métricas desactivadas")
+        METRICS_ENABLED = False
+
+if METRICS_ENABLED:
+    HANDLER_SECONDS = prom.Histogram(
+        "recargas_handler_seconds", "Duración de cada handler de Telegram", ["handler"])
+    SUPABASE_SECONDS = prom.Histogram(
+        "recargas_supabase_seconds", "Duración de llamadas a Supabase", ["table", "verb"])
+    TELEGRAM_SECONDS = prom.Histogram(
+        "recargas_telegram_seconds", "Duración de llamadas a la API de Telegram", ["method"])
+    ORDERS_TOTAL = prom.Counter(
+        "recargas_orders_total", "Pedidos por cambio de estado", ["status"])
+    ERRORS_TOTAL = prom.Counter(
+        "recargas_errors_total", "Errores capturados (antes silenciados)", ["where"])
+    UPDATE_QUEUE_DEPTH = prom.Gauge(
+        "recargas_update_queue_depth", "Updates pendientes: en la cola de la Application o en curso")
+    OUTBOX_DEPTH = prom.Gauge(
+        "recargas_outbox_depth", "Filas esperando en el outbox")
+    SUPABASE_CIRCUIT_OPEN = prom.Gauge(
+        "recargas_supabase_circuit_open", "1 si el circuito hacia Supabase está abierto")
+    LOG_DISCARDED = prom.Gauge(
+        "recargas_log_discarded", "Líneas de log no escritas (cola llena o muestreo)", ["reason"])
+    LOG_DISCARDED.labels("queue_full").set_function(lambda: _log_handler.dropped)
+    if _log_sampler:
+        LOG_DISCARDED.labels("sampled").set_function(lambda: _log_sampler.sampled_out)
+
+def _handler_log_ctx(args) -> dict:
+    """user_id del update que atiende un handler (contexto de log)."""
+    update = args[0] if args else None
+    user = getattr(update, "effective_user", None)
+    return {"user_id": user.id} if user else {}
+
+def instrument_handler(fn):
+    """
+    Decorador: histograma de duración y contador de excepciones por handler. Con
+    LOG_FORMAT=json además fija handler/user_id como contexto de log y registra la
+    duración de cada llamada.
+    """
+    structured = LOG_FORMAT == "json"
+    if not METRICS_ENABLED and not structured:
+        return fn
+    name = fn.__name__
+    hist = HANDLER_SECONDS.labels(name) if METRICS_ENABLED else None
+    errors = ERRORS_TOTAL.labels(f"handler:{name}") if METRICS_ENABLED else None
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        token = _log_ctx.set({"handler": name, **_handler_log_ctx(args)}) if structured else None
+        try:
+            return await fn(*args, **kwargs)
+        except Exception:
+            if errors:
+                errors.inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - t0
+            if hist:
+                hist.observe(elapsed)
+            if token:
+                log.info("handler %s", name, extra={"duration_ms": round(elapsed * 1000, 1)})
+                _log_ctx.reset(token)
+    return wrapper
+
+def count_error(where: str):
+    if METRICS_ENABLED:
+        ERRORS_TOTAL.labels(where).inc()
+
+def count_order(status: str, n: int = 1):
+    if METRICS_ENABLED:
+        ORDERS_TOTAL.labels(status).inc(n)
 
 # ============ Supabase (REST) ============
 
@@ -108,138 +415,1516 @@ SB_HEADERS = {
     "Content-Type": "application/json",
 }
 
-def sb_get_user(telegram_id: int):
-    """Trae info del usuario desde 'usuarios' incluyendo cuentas_asignadas."""
-    return sb_select_one(
-        "usuarios",
-        {"telegram_id": str(telegram_id)},
-        "telegram_id, username, creditos, cuentas_asignadas"
-    )
-
-def get_price_for_user(telegram_id: int) -> float:
+# --- Pool de conexiones hacia PostgREST ---
+# Un solo cliente httpx.AsyncClient por proceso: conexiones keep-alive reutilizadas,
+# HTTP/2 si está instalado 'h2' y el servidor lo soporta, y un semáforo que limita
+# cuántas llamadas simultáneas hacemos a Supabase.
+SB_TIMEOUT         = float(os.getenv("SB_TIMEOUT", "10"))          # segundos por llamada
+SB_MAX_CONNECTIONS = int(os.getenv("SB_MAX_CONNECTIONS", "20"))    # tamaño del pool
+SB_MAX_CONCURRENCY = int(os.getenv("SB_MAX_CONCURRENCY", "10"))    # llamadas en vuelo
+SB_HTTP2           = os.getenv("SB_HTTP2", "1") == "1"
+# --- Resiliencia (ver "Circuito y lecturas") ---
+SB_READ_BUDGET      = float(os.getenv("SB_READ_BUDGET", "4"))       # segundos por lectura, reintentos incluidos
+SB_HEDGE_AFTER      = float(os.getenv("SB_HEDGE_AFTER", "0.5"))     # 2ª lectura si la 1ª tarda más (0 = no)
+SB_READ_RETRIES     = int(os.getenv("SB_READ_RETRIES", "2"))        # reintentos de lecturas fallidas
+SB_RETRY_BASE       = float(os.getenv("SB_RETRY_BASE", "0.2"))      # segundos; backoff exponencial con jitter
+SB_BREAKER_RATIO     = float(os.getenv("SB_BREAKER_RATIO", "0.5"))    # fracción de fallos en la ventana que abre el circuito
+SB_BREAKER_MIN_CALLS = int(os.getenv("SB_BREAKER_MIN_CALLS", "20"))   # llamadas en la ventana antes de evaluar
+SB_BREAKER_WINDOW    = float(os.getenv("SB_BREAKER_WINDOW", "10"))    # segundos de la ventana móvil
+SB_BREAKER_COOLDOWN  = float(os.getenv("SB_BREAKER_COOLDOWN", "15"))  # segundos abierto antes de probar
+
+_sb_client = None
+_sb_sem = None
+
+def _sb_get_client() -> httpx.AsyncClient:
+    """Crea (una sola vez) el cliente async con pool keep-alive."""
+    global _sb_client, _sb_sem
+    if _sb_client is None:
+        http2 = SB_HTTP2
+        if http2:
+            try:
+                import h2  # noqa: F401  (extra opcional de httpx)
+            except ImportError:
+                http2 = False
+        _sb_client = httpx.AsyncClient(
+            base_url=f"{SUPABASE_URL}/rest/v1",
+            headers=SB_HEADERS,
+            http2=http2,
+            timeout=httpx.Timeout(SB_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=SB_MAX_CONNECTIONS,
+                max_keepalive_connections=SB_MAX_CONNECTIONS,
+                keepalive_expiry=60,
+            ),
+        )
+        _sb_sem = asyncio.Semaphore(SB_MAX_CONCURRENCY)
+    return _sb_client
+
+async def sb_close():
+    """Cierra el pool (se llama al apagar la Application)."""
+    global _sb_client
+    if _sb_client is not None:
+        await _sb_client.aclose()
+        _sb_client = None
+
+# --- Circuito y lecturas ---
+# Si Supabase está caído no tiene sentido que cada handler espere SB_TIMEOUT: cuando
+# en los últimos SB_BREAKER_WINDOW segundos hubo al menos SB_BREAKER_MIN_CALLS
+# llamadas y SB_BREAKER_RATIO de ellas fallaron (red, timeout o 5xx), el circuito se
+# abre y las llamadas fallan al instante con SupabaseUnavailable; pasado
+# SB_BREAKER_COOLDOWN se deja pasar una sola llamada de prueba. Se mide la proporción
+# de fallos y no una racha: con muchas llamadas en paralelo, unos pocos errores
+# intercalados no deben abrirlo. La petición duplicada del hedge no cuenta como
+# llamada. Las lecturas (GET) además se cubren con un hedge (segunda petición si la
+# primera tarda más de SB_HEDGE_AFTER) y reintentos con backoff+jitter, todo dentro
+# de SB_READ_BUDGET. Las escrituras no se reintentan aquí.
+
+class SupabaseUnavailable(Exception):
+    """Supabase no respondió (o el circuito está abierto)."""
+
+class CircuitBreaker:
+    """Cerrado -> abierto si falla `ratio` de la ventana móvil -> una prueba tras el enfriamiento."""
+
+    def __init__(self, ratio: float, min_calls: int, window: float, cooldown: float):
+        self.ratio = ratio
+        self.min_calls = max(1, min_calls)
+        self.window = window
+        self.cooldown = cooldown
+        self._calls = deque()    # (monotonic, falló) de las llamadas de la ventana
+        self._fails = 0
+        self._opened_at = None   # monotonic; None = cerrado
+        self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        if self._opened_at is None:
+            return True
+        if self._probing or time.monotonic() - self._opened_at < self.cooldown:
+            return False
+        self._probing = True   # medio abierto: pasa solo esta
+        return True
+
+    def record(self, ok, probe: bool = False):
+        """
+        ok=True éxito, False caída, None cancelada (no cuenta). `probe`: la llamada
+        entró con el circuito abierto, es la de prueba.
+        """
+        now = time.monotonic()
+        if probe:
+            self._probing = False
+            if ok:
+                log.info("Supabase: circuito cerrado")
+                self._opened_at = None
+                self._calls.clear()
+                self._fails = 0
+            elif ok is not None:
+                self._opened_at = now
+            return
+        if ok is None or self._opened_at is not None:
+            return   # cancelada, o empezó antes de abrirse: ya no cuenta
+        self._calls.append((now, not ok))
+        self._fails += not ok
+        while now - self._calls[0][0] > self.window:
+            self._fails -= self._calls.popleft()[1]
+        if len(self._calls) >= self.min_calls and self._fails >= self.ratio * len(self._calls):
+            log.warning("Supabase: circuito abierto (%d de %d llamadas fallidas en %.0f s)",
+                        self._fails, len(self._calls), self.window)
+            count_error("supabase_circuit")
+            self._opened_at = now
+
+sb_breaker = CircuitBreaker(SB_BREAKER_RATIO, SB_BREAKER_MIN_CALLS, SB_BREAKER_WINDOW, SB_BREAKER_COOLDOWN)
+
+if METRICS_ENABLED:
+    SUPABASE_CIRCUIT_OPEN.set_function(lambda: 1 if sb_breaker.is_open else 0)
+
+def _is_outage(e: Exception) -> bool:
+    """Errores que indican Supabase caído o saturado (los 4xx son culpa nuestra)."""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code >= 500 or e.response.status_code == 429
+    return isinstance(e, (httpx.TransportError, SupabaseUnavailable))
+
+async def _sb_call(method: str, table: str, *, params=None, json=None, headers=None, timeout=None,
+                   hedge: bool = False):
+    """Un intento HTTP contra PostgREST, pasando por el circuito (`hedge`: duplicado, no cuenta)."""
+    probe = sb_breaker.is_open
+    if not sb_breaker.allow():
+        raise SupabaseUnavailable("circuito abierto")
+    client = _sb_get_client()
+    t0 = time.perf_counter() if METRICS_ENABLED else 0.0
+    ok = None
+    try:
+        async with _sb_sem:
+            r = await client.request(
+                method,
+                f"/{table}",
+                params=params,
+                json=json,
+                headers=headers,
+                timeout=timeout if timeout is not None else SB_TIMEOUT,
+            )
+        r.raise_for_status()
+        ok = True
+    except Exception as e:
+        ok = not _is_outage(e)
+        count_error("supabase")
+        raise
+    finally:
+        if probe or not hedge:
+            sb_breaker.record(ok, probe)
+        if METRICS_ENABLED:
+            SUPABASE_SECONDS.labels(table, method).observe(time.perf_counter() - t0)
+    return r.json() if r.content else None
+
+async def _sb_hedged(method: str, table: str, kw: dict, budget: float):
+    """Lanza una segunda lectura si la primera no contestó en SB_HEDGE_AFTER; gana la primera que responda bien."""
+    tasks = [asyncio.ensure_future(_sb_call(method, table, timeout=budget, **kw))]
+    try:
+        if 0 < SB_HEDGE_AFTER < budget:
+            done, _ = await asyncio.wait(tasks, timeout=SB_HEDGE_AFTER)
+            if not done and not sb_breaker.is_open:
+                tasks.append(asyncio.ensure_future(
+                    _sb_call(method, table, timeout=budget - SB_HEDGE_AFTER, hedge=True, **kw)))
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if t.exception() is None:
+                    return t.result()
+                error = error or t.exception()
+        raise error
+    finally:
+        for t in tasks:
+            if not t.done():
+                t.cancel()
+
+async def _sb_request(method: str, table: str, *, params=None, json=None, headers=None, timeout=None):
     """
-    Determina el precio según cuántas 'cuentas_asignadas' tiene el usuario.
-    Usa los tramos definidos en PRICE_TIERS.
+    Hace la llamada HTTP a PostgREST; lanza excepción si falla.
+    Los GET usan hedge y reintentos dentro del presupuesto (timeout o SB_READ_BUDGET).
     """
-    u = sb_get_user(telegram_id)
-    asignadas = int((u or {}).get("cuentas_asignadas") or 0)
+    kw = {"params": params, "json": json, "headers": headers}
+    if method != "GET":
+        return await _sb_call(method, table, timeout=timeout, **kw)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + (timeout if timeout is not None else SB_READ_BUDGET)
+    attempt = 0
+    while True:
+        try:
+            return await _sb_hedged(method, table, kw, deadline - loop.time())
+        except Exception as e:
+            if isinstance(e, SupabaseUnavailable) or not _is_outage(e) or attempt >= SB_READ_RETRIES:
+                raise
+            # backoff exponencial con jitter completo, sin pasarnos del presupuesto
+            delay = random.uniform(0, SB_RETRY_BASE * (2 ** attempt))
+            if loop.time() + delay + 0.05 >= deadline:
+                raise
+            attempt += 1
+            await asyncio.sleep(delay)
+
+# --- Cache de perfiles de 'usuarios' ---
+# Un mensaje de cantidad necesitaba la misma fila 2-3 veces (precio, mínimo, botón
+# "recargar"). Guardamos la fila por telegram_id con TTL y expulsión LRU; se invalida
+# al cambiar créditos. Pasado el TTL la fila sigue sirviendo hasta USER_CACHE_STALE
+# (stale-while-revalidate): se devuelve al instante y se refresca en segundo plano, y
+# si Supabase no responde es mejor que cotizar con el tramo base.
+USER_CACHE_TTL   = float(os.getenv("USER_CACHE_TTL", "30"))     # segundos
+USER_CACHE_STALE = float(os.getenv("USER_CACHE_STALE", "600"))  # segundos extra como respaldo
+USER_CACHE_SIZE  = int(os.getenv("USER_CACHE_SIZE", "5000"))    # usuarios en memoria
+USER_COLUMNS    = "telegram_id, username, creditos, cuentas_asignadas"
+
+class _UserCache:
+    """LRU con TTL y respaldo vencido. Guarda también 'no existe' (fila None) para no re-consultar."""
+
+    def __init__(self, ttl: float, stale: float, maxsize: int):
+        self.ttl = ttl
+        self.stale = stale
+        self.maxsize = maxsize
+        self._data = OrderedDict()   # telegram_id -> (fresca_hasta, usable_hasta, fila | None)
+        self._inflight = {}          # telegram_id -> Future (una consulta a la vez)
+
+    def _lookup(self, key: str):
+        """(hit, fresca, fila) incluyendo filas vencidas aún usables."""
+        item = self._data.get(key)
+        if item is None:
+            return False, False, None
+        fresh_until, usable_until, row = item
+        now = time.monotonic()
+        if usable_until < now:
+            del self._data[key]
+            return False, False, None
+        self._data.move_to_end(key)
+        return True, fresh_until >= now, row
+
+    def put(self, key: str, row):
+        now = time.monotonic()
+        self._data[key] = (now + self.ttl, now + self.ttl + self.stale, row)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: str):
+        self._data.pop(key, None)
+
+    def _fetch_once(self, key: str, fetch):
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(fetch(key))
+            self._inflight[key] = fut
+            fut.add_done_callback(functools.partial(self._done, key))
+        return fut
+
+    def _done(self, key: str, fut):
+        self._inflight.pop(key, None)
+        if not fut.cancelled():
+            fut.exception()   # revalidación en segundo plano: que no quede "never retrieved"
+
+    async def get_or_fetch(self, key: str, fetch):
+        """
+        Devuelve la fila cacheada o la trae con fetch(key), una consulta por usuario a la vez.
+        Una fila vencida se devuelve igual y se refresca en segundo plano; si no hay
+        nada cacheado y fetch falla, la excepción sube al llamador.
+        """
+        hit, fresh, row = self._lookup(key)
+        if hit:
+            if not fresh:
+                self._fetch_once(key, fetch)   # revalida sin hacer esperar al usuario
+            return row
+        return await asyncio.shield(self._fetch_once(key, fetch))
+
+user_cache = _UserCache(USER_CACHE_TTL, USER_CACHE_STALE, USER_CACHE_SIZE)
+
+async def _sb_fetch_user(key: str):
+    try:
+        data = await _sb_request(
+            "GET", "usuarios",
+            params={"select": USER_COLUMNS, "telegram_id": f"eq.{key}", "limit": "1"},
+        )
+    except Exception as e:
+        log.warning("Supabase select_one usuarios error: %s", e)
+        raise SupabaseUnavailable(str(e)) from e   # no se cachea: el próximo intento vuelve a consultar
+    row = data[0] if data else None
+    user_cache.put(key, row)
+    return row
 
-    price = PRICE_TIERS[0][1]  # precio base
-    for min_asg, p in PRICE_TIERS:
-        if asignadas >= min_asg:
-            price = p
-        else:
-            break
-    return price
+async def sb_get_user(telegram_id: int):
+    """
+    Trae info del usuario desde 'usuarios' incluyendo cuentas_asignadas (con cache).
+    Lanza SupabaseUnavailable si no hay respuesta ni copia en cache.
+    """
+    return await user_cache.get_or_fetch(str(telegram_id), _sb_fetch_user)
 
-def get_min_qty_for_user(telegram_id: int) -> int:
-    """Devuelve el mínimo de compra según cuentas_asignadas usando MIN_QTY_TIERS."""
-    u = sb_get_user(telegram_id)
+async def get_user_terms(telegram_id: int):
+    """
+    (precio por cuenta, compra mínima, versión de tramos) según las cuentas_asignadas
+    del usuario. Lanza SupabaseUnavailable en vez de cotizar con el tramo base.
+    """
+    u = await sb_get_user(telegram_id)
     asignadas = int((u or {}).get("cuentas_asignadas") or 0)
+    return tier_for(asignadas)
 
-    min_qty = MIN_QTY_TIERS[0][1]
-    for min_asg, q in MIN_QTY_TIERS:
-        if asignadas >= min_asg:
-            min_qty = q
-        else:
-            break
-    return max(1, min_qty)
-
-def sb_select_one(table: str, filters: dict, columns: str = "*"):
-    """GET /rest/v1/{table}?col=eq.value&select=*  -> dict | None"""
-    params = {"select": columns}
-    for k, v in filters.items():
-        params[k] = f"eq.{v}"
+async def sb_select(table: str, params: dict, timeout=None):
+    """GET /rest/v1/{table} con parámetros PostgREST ya armados -> list | None"""
     try:
-        r = requests.get(f"{SUPABASE_URL}/rest/v1/{table}", headers=SB_HEADERS, params=params, timeout=10)
-        r.raise_for_status()
-        data = r.json()
-        return data[0] if data else None
+        return await _sb_request("GET", table, params=params, timeout=timeout)
     except Exception as e:
-        log.warning("Supabase select_one %s error: %s", table, e)
+        log.warning("Supabase select %s error: %s", table, e)
         return None
 
-def sb_insert(table: str, row: dict):
+async def sb_iter(table: str, params: dict, key: str = "id", page: int = 1000):
+    """
+    Recorre una tabla completa por páginas (keyset sobre `key`, que debe ser único),
+    sin cargarla entera en memoria. Lanza excepción si una página falla.
+    """
+    last = None
+    while True:
+        p = {**params, "order": f"{key}.asc"}
+        if last is not None:
+            p[key] = f"gt.{last}"
+        rows = await _sb_request(
+            "GET", table, params=p,
+            headers={"Range-Unit": "items", "Range": f"0-{page - 1}"},
+        )
+        for row in rows:
+            yield row
+        if len(rows) < page:
+            return
+        last = rows[-1][key]
+
+async def sb_insert(table: str, row: dict, timeout=None):
     try:
-        r = requests.post(
-            f"{SUPABASE_URL}/rest/v1/{table}",
-            headers={**SB_HEADERS, "Prefer": "return=representation"},
+        return await _sb_request(
+            "POST",
+            table,
+            headers={"Prefer": "return=representation"},
             json=row,
-            timeout=10,
+            timeout=timeout,
         )
-        r.raise_for_status()
-        return r.json()
     except Exception as e:
         log.warning("Supabase insert %s error: %s", table, e)
         return None
 
-def sb_patch(table: str, filters: dict, patch: dict):
+async def sb_patch(table: str, filters: dict, patch: dict, timeout=None):
+    """PATCH con filtros eq (o in. si el valor es una lista) -> filas modificadas | None"""
     params = {}
     for k, v in filters.items():
-        params[k] = f"eq.{v}"
+        params[k] = f"in.({','.join(map(str, v))})" if isinstance(v, (list, tuple)) else f"eq.{v}"
     try:
-        r = requests.patch(
-            f"{SUPABASE_URL}/rest/v1/{table}",
-            headers={**SB_HEADERS, "Prefer": "return=representation"},
+        return await _sb_request(
+            "PATCH",
+            table,
+            headers={"Prefer": "return=representation"},
             params=params,
             json=patch,
-            timeout=10,
+            timeout=timeout,
         )
-        r.raise_for_status()
-        return r.json()
     except Exception as e:
         log.warning("Supabase patch %s error: %s", table, e)
         return None
 
-def sb_add_credits(telegram_id: int, to_add: int) -> int:
-    """Suma créditos al usuario; retorna nuevo total (o el anterior si falla)."""
-    user = sb_select_one("usuarios", {"telegram_id": str(telegram_id)}, "creditos,telegram_id")
-    current = int(user["creditos"]) if (user and user.get("creditos") is not None) else 0
-    new_total = current + int(to_add)
+async def sb_rpc(fn: str, args: dict, timeout=None):
+    """POST /rest/v1/rpc/{fn}  -> respuesta JSON | None"""
+    try:
+        return await _sb_request("POST", f"rpc/{fn}", json=args, timeout=timeout)
+    except Exception as e:
+        log.warning("Supabase rpc %s error: %s", fn, e)
+        return None
 
-    if user:
-        sb_patch("usuarios", {"telegram_id": str(telegram_id)}, {"creditos": new_total})
-    else:
-        sb_insert("usuarios", {"telegram_id": str(telegram_id), "creditos": new_total})
+async def sb_approve_order(order_id: str, telegram_id: int, qty: int):
+    """
+    Aprueba el pedido en un solo round trip (función SQL aprobar_pago, ver sql/):
+    marca pagos.status, suma créditos, escribe historial y devuelve el saldo.
+    Solo acredita pedidos pendientes; idempotente por order_id.
+    -> {"aplicado", "creditos", "status", ...} | None si falló.
+    """
+    res = await sb_rpc("aprobar_pago", {
+        "p_order_id": order_id,
+        "p_user_id": str(telegram_id),
+        "p_qty": int(qty),
+    })
+    await invalidate_users([telegram_id])
+    return res
+
+# ============ Tramos (precios y mínimos desde Supabase) ============
+# La tabla 'tramos' (sql/tramos.sql) reemplaza a PRICE_TIERS/MIN_QTY_TIERS sin
+# redeploy. Un trigger sube tramos_version en cada cambio; cada TIERS_CHECK_INTERVAL
+# leemos solo la versión y recargamos la tabla si cambió (o si pasó TIERS_TTL). La
+# tabla compilada se publica reemplazando la tupla TIERS entera, así que tier_for()
+# sigue siendo un bisect sin locks. Si Supabase no responde o la tabla está vacía se
+# quedan los tramos que había (al arrancar, los del entorno). Apagado por defecto:
+# TIERS_FROM_DB=1 solo después de correr sql/tramos.sql.
+TIERS_FROM_DB        = os.getenv("TIERS_FROM_DB", "0") == "1"
+TIERS_CHECK_INTERVAL = float(os.getenv("TIERS_CHECK_INTERVAL", "30"))   # segundos entre chequeos de versión
+TIERS_TTL            = float(os.getenv("TIERS_TTL", "600"))             # recarga completa aunque no cambie
+QUOTE_TTL            = float(os.getenv("QUOTE_TTL", "1800"))            # segundos que vale el precio mostrado
+
+_tiers_loaded_at = 0.0   # monotonic de la última carga completa
+
+async def _tiers_version():
+    rows = await sb_select("tramos_version", {"select": "version", "limit": "1"})
+    return int(rows[0]["version"]) if rows else None
+
+async def refresh_tiers(force: bool = False) -> bool:
+    """Recarga los tramos si cambió la versión (o venció TIERS_TTL). True si se recargaron."""
+    global TIERS, _tiers_loaded_at
+    version = await _tiers_version()
+    if version is None:
+        return False   # sin respuesta o sin fila: seguimos con los tramos actuales
+    if not force and version == TIERS[0] and time.monotonic() - _tiers_loaded_at < TIERS_TTL:
+        return False
+    for _ in range(3):
+        rows = await sb_select("tramos", {"select": "desde,precio,minimo", "order": "desde.asc"})
+        if not rows:
+            log.warning("Tramos: la tabla 'tramos' está vacía o no respondió; sigo con la versión %s", TIERS[0])
+            return False
+        # si alguien editó la tabla mientras la leíamos, la versión ya no coincide: releer
+        latest = await _tiers_version()
+        if latest is None or latest == version:
+            break
+        version = latest
+    price_tiers = [(int(r["desde"]), float(r["precio"])) for r in rows if r.get("precio") is not None]
+    min_qty_tiers = [(int(r["desde"]), int(r["minimo"])) for r in rows if r.get("minimo") is not None]
+    keys, values = _compile_tiers(price_tiers or PRICE_TIERS, min_qty_tiers or MIN_QTY_TIERS)
+    changed = version != TIERS[0]
+    TIERS = (version, keys, values)   # una sola asignación: cada lector ve la tabla vieja o la nueva
+    _tiers_loaded_at = time.monotonic()
+    if changed:
+        log.info("Tramos: versión %d cargada (%d tramos)", version, len(keys))
+    return True
+
+async def refresh_tiers_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job: chequeo barato de versión de los tramos."""
+    await refresh_tiers()
+
+# ============ Estado de conversación (SQLite o Supabase) ============
+# UD_ORDER / UD_AWAIT_* vivían solo en memoria: un redeploy perdía los pedidos en
+# curso. Guardamos user_data en SQLite (WAL). PTB nos avisa cada
+# STATE_FLUSH_INTERVAL segundos qué usuarios tocaron algo; de esos escribimos solo
+# los que realmente cambiaron, todos en una transacción. Las sesiones sin actividad
+# por más de SESSION_TTL se eliminan (memoria y disco).
+# DATA_DIR debe estar en un volumen persistente para sobrevivir reinicios.
+# Con COORD_BACKEND=supabase el estado va a la tabla bot_sesiones (ver
+# sql/coordinacion.sql) en lugar de SQLite, para que réplicas en distintos hosts
+# compartan las sesiones; cada réplica carga al arrancar solo las suyas.
+
+DATA_DIR               = os.getenv("DATA_DIR", "data")
+STATE_DB_PATH          = os.getenv("STATE_DB_PATH", os.path.join(DATA_DIR, "state.sqlite3"))
+STATE_FLUSH_INTERVAL   = float(os.getenv("STATE_FLUSH_INTERVAL", "5"))        # segundos
+SESSION_TTL            = float(os.getenv("SESSION_TTL", str(3 * 24 * 3600)))  # segundos
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "600"))    # segundos
+
+class SQLitePersistence(BasePersistence):
+    """Persistencia de user_data en SQLite; bot_data/chat_data no se guardan."""
+
+    def __init__(self, path: str, update_interval: float):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self.source = path     # para el log de arranque
+        self.last_seen = {}    # user_id -> epoch de la última actividad
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._saved = {}       # user_id -> JSON ya escrito (para saltar lo que no cambió)
+        self._pending = {}     # user_id -> JSON | None (None = borrar)
+        self._writer = None
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS user_data ("
+                " user_id INTEGER PRIMARY KEY,"
+                " data TEXT NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            db.commit()
+            self._db = db
+        return self._db
+
+    def _load(self):
+        with self._db_lock:
+            return self._conn().execute("SELECT user_id, data, updated_at FROM user_data").fetchall()
+
+    def _load_one(self, user_id: int):
+        with self._db_lock:
+            return self._conn().execute(
+                "SELECT data, updated_at FROM user_data WHERE user_id = ?", (user_id,)
+            ).fetchone()
+
+    def _write(self, batch: dict):
+        now = time.time()
+        upserts = [(uid, blob, now) for uid, blob in batch.items() if blob is not None]
+        deletes = [(uid,) for uid, blob in batch.items() if blob is None]
+        with self._db_lock:
+            db = self._conn()
+            with db:
+                if upserts:
+                    db.executemany(
+                        "INSERT INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                        upserts,
+                    )
+                if deletes:
+                    db.executemany("DELETE FROM user_data WHERE user_id = ?", deletes)
+
+    async def _load_rows(self):
+        """-> [(user_id, JSON, epoch de la última escritura)]"""
+        return await asyncio.to_thread(self._load)
+
+    async def _store(self, batch: dict):
+        await asyncio.to_thread(self._write, batch)
+
+    def _schedule_write(self):
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.get_running_loop().create_task(self._write_pending())
+
+    async def _write_pending(self):
+        # un ciclo de PTB llama update_user_data por cada usuario; cedemos el turno
+        # para juntarlos a todos en la misma transacción
+        await asyncio.sleep(0)
+        while self._pending:
+            batch, self._pending = self._pending, {}
+            try:
+                await self._store(batch)
+            except Exception as e:
+                log.warning("Estado: no pude guardar %d sesiones: %s", len(batch), e)
+                count_error("state_flush")
+                self._pending = {**batch, **self._pending}
+                return
+            for uid, blob in batch.items():
+                if blob is None:
+                    self._saved.pop(uid, None)
+                else:
+                    self._saved[uid] = blob
+
+    async def get_user_data(self):
+        rows = await self._load_rows()
+        out = {}
+        for uid, blob, updated_at in rows:
+            out[uid] = json.loads(blob)
+            self._saved[uid] = blob
+            self.last_seen[uid] = updated_at
+        log.info("Estado: %d sesiones restauradas de %s", len(out), self.source)
+        return out
+
+    async def update_user_data(self, user_id: int, data: dict):
+        self.last_seen[user_id] = time.time()
+        blob = json.dumps(data, separators=(",", ":"), sort_keys=True) if data else None
+        if self._saved.get(user_id) == blob:
+            return
+        self._pending[user_id] = blob
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id: int):
+        self.last_seen.pop(user_id, None)
+        if user_id in self._saved or user_id in self._pending:
+            self._pending[user_id] = None
+            self._schedule_write()
+
+    async def flush(self):
+        if self._writer is not None:
+            await self._writer
+        if self._pending:
+            await self._write_pending()
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    # --- lo que no guardamos ---
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
 
-    # Historial (no bloqueante)
-    try:
-        sb_insert(
-            "creditos_historial",
-            {
-                "usuario_id": str(telegram_id),
-                "delta": int(to_add),
-                "motivo": "recarga_aprobada",
-                "hecho_por": "admin",
-            },
+    async def get_conversations(self, name: str):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        # con varias réplicas la fila es compartida: si otra la cambió (p. ej. tras
+        # cambiar REPLICA_COUNT), la traemos antes de atender el update
+        if REPLICA_COUNT == 1 or user_id in self._pending:
+            return
+        row = await asyncio.to_thread(self._load_one, user_id)
+        blob = row[0] if row else None
+        if blob == self._saved.get(user_id):
+            return
+        user_data.clear()
+        if blob is None:
+            self._saved.pop(user_id, None)
+            return
+        user_data.update(json.loads(blob))
+        self._saved[user_id] = blob
+        self.last_seen[user_id] = row[1]
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+class SupabasePersistence(SQLitePersistence):
+    """Lo mismo sobre la tabla bot_sesiones de Supabase (réplicas en varios hosts)."""
+
+    def __init__(self, update_interval: float):
+        super().__init__(path="", update_interval=update_interval)
+        self.source = "bot_sesiones"
+        self._known = set()    # user_ids cuya fila ya leímos o escribimos en este proceso
+
+    async def _load_rows(self):
+        rows = []
+        try:
+            async for r in sb_iter(
+                "bot_sesiones",
+                {"select": "user_id,data,updated_at", "replica": f"eq.{REPLICA_INDEX}"},
+                key="user_id",
+            ):
+                blob = json.dumps(r["data"], separators=(",", ":"), sort_keys=True)
+                rows.append((int(r["user_id"]), blob, datetime.fromisoformat(r["updated_at"]).timestamp()))
+        except Exception as e:
+            # se arranca igual: refresh_user_data trae cada sesión al primer update
+            log.warning("Estado: no pude cargar bot_sesiones: %s", e)
+            count_error("state_load")
+            return []
+        self._known.update(uid for uid, _, _ in rows)
+        return rows
+
+    async def _store(self, batch: dict):
+        now = datetime.now(timezone.utc).isoformat()
+        upserts = [
+            {"user_id": uid, "data": json.loads(blob), "replica": replica_for(uid), "updated_at": now}
+            for uid, blob in batch.items() if blob is not None
+        ]
+        deletes = [uid for uid, blob in batch.items() if blob is None]
+        if upserts:
+            await _sb_request(
+                "POST", "bot_sesiones",
+                params={"on_conflict": "user_id"},
+                headers={"Prefer": "resolution=merge-duplicates,return=minimal"},
+                json=upserts,
+            )
+        if deletes:
+            await _sb_request("DELETE", "bot_sesiones", params={"user_id": f"in.({','.join(map(str, deletes))})"})
+        self._known.update(batch)
+        self._known.difference_update(deletes)
+
+    async def refresh_user_data(self, user_id, user_data):
+        # Solo la réplica dueña escribe la fila de un usuario, así que basta leerla la
+        # primera vez que lo atendemos (no estaba entre las cargadas: otra réplica la
+        # escribió antes de cambiar REPLICA_COUNT, o la carga inicial falló). Si la
+        # lectura falla seguimos con lo que haya en memoria, que es lo más nuevo.
+        if user_id in self._known or user_id in self._pending:
+            return
+        try:
+            rows = await _sb_request(
+                "GET", "bot_sesiones",
+                params={"select": "data,updated_at", "user_id": f"eq.{user_id}", "limit": "1"},
+            )
+        except Exception as e:
+            log.warning("Estado: no pude leer la sesión de %s: %s", user_id, e)
+            count_error("state_load")
+            rows = None
+        self._known.add(user_id)
+        if not rows:
+            return
+        blob = json.dumps(rows[0]["data"], separators=(",", ":"), sort_keys=True)
+        user_data.clear()
+        user_data.update(json.loads(blob))
+        self._saved[user_id] = blob
+        self.last_seen[user_id] = datetime.fromisoformat(rows[0]["updated_at"]).timestamp()
+
+state_store = (
+    SupabasePersistence(STATE_FLUSH_INTERVAL) if COORD_BACKEND == "supabase"
+    else SQLitePersistence(STATE_DB_PATH, STATE_FLUSH_INTERVAL)
+)
+
+async def evict_idle_sessions(context: ContextTypes.DEFAULT_TYPE):
+    """Job: suelta las sesiones sin actividad desde hace más de SESSION_TTL."""
+    now = time.time()
+    cutoff = now - SESSION_TTL
+    dropped = 0
+    for uid in list(context.application.user_data):
+        if replica_for(uid) != REPLICA_INDEX:
+            continue   # la fila es compartida: la suelta la réplica dueña
+        seen = state_store.last_seen.setdefault(uid, now)   # recién creada: aún no pasó por flush
+        if seen < cutoff:
+            context.application.drop_user_data(uid)
+            dropped += 1
+    if dropped:
+        log.info("Estado: %d sesiones inactivas eliminadas", dropped)
+
+# ============ Réplicas (coordinación) ============
+# Con REPLICA_COUNT > 1 varias réplicas atienden el mismo bot (solo en webhook):
+#   - cada usuario tiene una réplica dueña (replica_for); la que recibe un update
+#     ajeno lo reenvía a REPLICA_URLS[dueña] y responde a Telegram con lo que diga esa,
+#   - el update_id se reclama en el coordinador antes de encolarlo (clave de
+#     idempotencia): los reintentos de Telegram o un reenvío repetido no se procesan
+#     dos veces,
+#   - un lease con TTL elige un líder; solo él corre los jobs globales (vencimientos,
+#     conciliación, limpieza de claves).
+# El coordinador es intercambiable: COORD_BACKEND=sqlite usa el STATE_DB_PATH
+# compartido (réplicas en un mismo host) y COORD_BACKEND=supabase usa las tablas de
+# sql/coordinacion.sql (varios hosts). Ambos exponen claim_update, release_update,
+# acquire_lease, release_lease y prune_updates. El mismo backend guarda el estado
+# de conversación (ver "Estado de conversación").
+# Para cambiar REPLICA_COUNT hay que reiniciar todas las réplicas: cada una lee la
+# sesión de sus usuarios nuevos desde el almacén compartido.
+# Lo que cambia el saldo de un usuario (aprobaciones del admin) corre en la réplica
+# del chat admin; la dueña del usuario recibe un aviso para soltar su fila cacheada
+# (invalidate_users).
+# La aprobación en sí ya es idempotente por order_id (aprobar_pago), así que un
+# reinicio a mitad de una aprobación no suma créditos dos veces.
+UPDATE_DEDUPE_TTL = float(os.getenv("UPDATE_DEDUPE_TTL", str(24 * 3600)))   # segundos
+REPLICA_HEADER    = "X-Replica-From"
+INVALIDATE_PATH   = "/replica/invalidate"
+
+def replica_for(user_id) -> int:
+    """Réplica dueña de un usuario (los updates sin usuario se quedan donde llegan)."""
+    if user_id is None:
+        return REPLICA_INDEX
+    return int(user_id) % REPLICA_COUNT
+
+def update_user_id(data: dict):
+    """Id del usuario de un update crudo (message.from, callback_query.from, poll_answer.user…)."""
+    for obj in data.values():
+        if isinstance(obj, dict):
+            who = obj.get("from") or obj.get("user") or obj.get("chat")
+            if isinstance(who, dict) and "id" in who:
+                return who["id"]
+    return None
+
+class SQLiteCoordinator:
+    """Claves de idempotencia y lease de líder en SQLite (réplicas en el mismo host)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db = None
+        self._db_lock = threading.Lock()
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # autocommit: cada sentencia es su propia transacción y otras réplicas
+            # esperan hasta 10 s si la base está tomada
+            db = sqlite3.connect(self.path, check_same_thread=False, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS processed_updates ("
+                " update_id INTEGER PRIMARY KEY,"
+                " replica TEXT NOT NULL,"
+                " at REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS leases ("
+                " name TEXT PRIMARY KEY,"
+                " holder TEXT NOT NULL,"
+                " expires_at REAL NOT NULL)"
+            )
+            self._db = db
+        return self._db
+
+    def _execute(self, sql: str, args=()) -> int:
+        with self._db_lock:
+            return self._conn().execute(sql, args).rowcount
+
+    def _acquire(self, name: str, holder: str, ttl: float) -> bool:
+        now = time.time()
+        with self._db_lock:
+            db = self._conn()
+            db.execute(
+                "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+                "WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+                (name, holder, now + ttl, now),
+            )
+            row = db.execute("SELECT holder FROM leases WHERE name = ?", (name,)).fetchone()
+        return row is not None and row[0] == holder
+
+    async def claim_update(self, update_id: int) -> bool:
+        """True si esta réplica es la primera en ver el update."""
+        n = await asyncio.to_thread(
+            self._execute,
+            "INSERT OR IGNORE INTO processed_updates (update_id, replica, at) VALUES (?, ?, ?)",
+            (update_id, REPLICA_ID, time.time()),
         )
-    except Exception:
+        return n == 1
+
+    async def release_update(self, update_id: int):
+        await asyncio.to_thread(self._execute, "DELETE FROM processed_updates WHERE update_id = ?", (update_id,))
+
+    async def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        return await asyncio.to_thread(self._acquire, name, holder, ttl)
+
+    async def release_lease(self, name: str, holder: str):
+        await asyncio.to_thread(self._execute, "DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+    async def prune_updates(self, older_than: float) -> int:
+        return await asyncio.to_thread(
+            self._execute, "DELETE FROM processed_updates WHERE at < ?", (time.time() - older_than,)
+        )
+
+    def close(self):
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+class SupabaseCoordinator:
+    """Lo mismo sobre Supabase (tablas bot_updates/bot_leases, ver sql/coordinacion.sql)."""
+
+    async def claim_update(self, update_id: int) -> bool:
+        # con ignore-duplicates PostgREST solo devuelve las filas que insertó
+        rows = await _sb_request(
+            "POST",
+            "bot_updates",
+            params={"on_conflict": "update_id"},
+            headers={"Prefer": "resolution=ignore-duplicates,return=representation"},
+            json={"update_id": update_id, "replica": REPLICA_ID},
+        )
+        return bool(rows)
+
+    async def release_update(self, update_id: int):
+        await _sb_request("DELETE", "bot_updates", params={"update_id": f"eq.{update_id}"})
+
+    async def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        res = await sb_rpc("tomar_lease", {"p_nombre": name, "p_holder": holder, "p_ttl": ttl})
+        return res is True
+
+    async def release_lease(self, name: str, holder: str):
+        await sb_rpc("soltar_lease", {"p_nombre": name, "p_holder": holder})
+
+    async def prune_updates(self, older_than: float) -> int:
+        cutoff = (datetime.utcnow() - timedelta(seconds=older_than)).isoformat()
+        rows = await _sb_request(
+            "DELETE", "bot_updates",
+            params={"created_at": f"lt.{cutoff}", "select": "update_id"},
+            headers={"Prefer": "return=representation"},
+        )
+        return len(rows or [])
+
+    def close(self):
         pass
 
-    return new_total
+class LeaderLease:
+    """Lease de líder renovado por un job; con una sola réplica siempre es líder."""
+
+    def __init__(self, name: str, holder: str, ttl: float):
+        self.name = name
+        self.holder = holder
+        self.ttl = ttl
+        self.is_leader = REPLICA_COUNT == 1
+
+    async def tick(self, context: ContextTypes.DEFAULT_TYPE = None):
+        """Job: toma o renueva el lease (cada ttl/3)."""
+        try:
+            got = await coordinator.acquire_lease(self.name, self.holder, self.ttl)
+        except Exception as e:
+            log.warning("Réplicas: no pude renovar el lease: %s", e)
+            count_error("lease")
+            got = False   # ante la duda dejamos de correr jobs globales
+        if got != self.is_leader:
+            log.info("Réplicas: %s %s el liderazgo", self.holder, "toma" if got else "pierde")
+        self.is_leader = got
+
+    async def release(self):
+        if REPLICA_COUNT == 1 or not self.is_leader:
+            return
+        self.is_leader = False
+        try:
+            await coordinator.release_lease(self.name, self.holder)
+        except Exception as e:
+            log.warning("Réplicas: no pude soltar el lease: %s", e)
+
+def leader_only(job):
+    """Decorador para jobs globales: en las réplicas que no son líder no hacen nada."""
+    @functools.wraps(job)
+    async def wrapper(context):
+        if not leader.is_leader:
+            return
+        return await job(context)
+    return wrapper
+
+@leader_only
+async def prune_processed_updates(context: ContextTypes.DEFAULT_TYPE):
+    """Job: borra las claves de idempotencia viejas (Telegram no reintenta tanto)."""
+    try:
+        n = await coordinator.prune_updates(UPDATE_DEDUPE_TTL)
+    except Exception as e:
+        log.warning("Réplicas: no pude limpiar updates procesados: %s", e)
+        count_error("prune_updates")
+        return
+    if n:
+        log.info("Réplicas: %d claves de update eliminadas", n)
+
+coordinator = SupabaseCoordinator() if COORD_BACKEND == "supabase" else SQLiteCoordinator(STATE_DB_PATH)
+leader = LeaderLease("jobs", REPLICA_ID, LEADER_LEASE_TTL)
+
+# cliente para hablar con las otras réplicas (se crea al primer uso)
+_peer_client = None
+
+def _peer_get_client() -> httpx.AsyncClient:
+    global _peer_client
+    if _peer_client is None:
+        _peer_client = httpx.AsyncClient(
+            timeout=5,
+            headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET, REPLICA_HEADER: str(REPLICA_INDEX)},
+        )
+    return _peer_client
+
+async def forward_update(data: dict, owner: int) -> int:
+    """Reenvía el update crudo a la réplica dueña -> status HTTP de su respuesta."""
+    r = await _peer_get_client().post(f"{REPLICA_URLS[owner]}{WEBHOOK_PATH}", json=data)
+    return r.status_code
+
+async def invalidate_users(user_ids):
+    """Suelta la fila cacheada de estos usuarios aquí y en sus réplicas dueñas."""
+    by_owner = {}
+    for uid in {str(u) for u in user_ids}:
+        user_cache.invalidate(uid)
+        owner = replica_for(uid)
+        if owner != REPLICA_INDEX:
+            by_owner.setdefault(owner, []).append(uid)
+    for owner, uids in by_owner.items():
+        try:
+            r = await _peer_get_client().post(f"{REPLICA_URLS[owner]}{INVALIDATE_PATH}", json={"user_ids": uids})
+            r.raise_for_status()
+        except Exception as e:
+            # la copia de la dueña vence sola en USER_CACHE_TTL
+            log.warning("Réplicas: no pude invalidar %d usuarios en la réplica %d: %s", len(uids), owner, e)
+            count_error("forward")
+
+async def close_peers():
+    global _peer_client
+    if _peer_client is not None:
+        await _peer_client.aclose()
+        _peer_client = None
+
+# ============ Outbox (escrituras diferidas a Supabase) ============
+# Escrituras que el usuario no necesita esperar (p. ej. el insert del pedido en
+# 'pagos' y la marca de su captura). Se encolan en memoria y en un journal local (OUTBOX_PATH); un worker las
+# manda en lotes (un POST con array por tabla, un PATCH con in.(...) para los patch
+# iguales) y reintenta con backoff si Supabase no responde. Si la cola está llena,
+# el llamador escribe en línea como antes.
+# El journal solo crece: cada lote enviado agrega una línea {"a": n} (las primeras n
+# entradas del archivo ya están en Supabase). Cada OUTBOX_COMPACT entradas enviadas
+# se reescribe con lo pendiente, en un hilo.
+OUTBOX_PATH           = os.getenv("OUTBOX_PATH", replica_path(os.path.join(DATA_DIR, "outbox.jsonl")))
+OUTBOX_MAX            = int(os.getenv("OUTBOX_MAX", "10000"))         # filas pendientes máximas
+OUTBOX_BATCH          = int(os.getenv("OUTBOX_BATCH", "200"))         # filas por POST
+OUTBOX_FLUSH_INTERVAL = float(os.getenv("OUTBOX_FLUSH_INTERVAL", "1"))  # segundos entre lotes
+OUTBOX_MAX_BACKOFF    = float(os.getenv("OUTBOX_MAX_BACKOFF", "60"))    # segundos
+OUTBOX_COMPACT        = int(os.getenv("OUTBOX_COMPACT", "5000"))      # entradas enviadas antes de compactar
+
+class SupabaseOutbox:
+    """Cola write-behind con journal en disco y envío por lotes."""
+
+    def __init__(self, path: str, maxsize: int, batch: int, interval: float):
+        self.path = path
+        self.maxsize = maxsize
+        self.batch = batch
+        self.interval = interval
+        self._rows = deque()    # (table, on_conflict, row, op, línea del journal)
+        self._queued = 0        # filas encoladas desde el arranque
+        self._done = 0          # filas ya enviadas (o descartadas)
+        self._acked = 0         # entradas del journal actual ya enviadas (las primeras)
+        self._wakeup = asyncio.Event()
+        self._flush_now = asyncio.Event()   # drain(): no esperar el intervalo
+        self._progress = asyncio.Event()    # se activa tras cada lote
+        self._task = None
+        self._journal = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _open_journal(self):
+        self._journal = open(self.path, "a", encoding="utf-8")
+
+    def _write_tmp(self, lines) -> str:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        return tmp
+
+    def _swap_journal(self, tmp: str, extra=()):
+        """Agrega `extra` a tmp y lo pone en lugar del journal (sin ceder el loop)."""
+        if extra:
+            with open(tmp, "a", encoding="utf-8") as f:
+                f.writelines(extra)
+        if self._journal:
+            self._journal.close()
+        os.replace(tmp, self.path)
+        self._acked = 0
+        self._open_journal()
+
+    def _ack(self):
+        self._journal.write(json.dumps({"a": self._acked}) + "\n")
+        self._journal.flush()
+
+    async def _compact(self):
+        """Reescribe el journal con lo pendiente; el archivo grande se escribe en un hilo."""
+        lines = [e[4] for e in self._rows]
+        tmp = await asyncio.to_thread(self._write_tmp, lines)
+        # lo encolado mientras tanto quedó en el journal viejo: va al final del nuevo
+        # (el worker no envía mientras compacta, así que nada salió de la cola)
+        self._swap_journal(tmp, [e[4] for e in itertools.islice(self._rows, len(lines), None)])
+
+    def _replay(self):
+        entries, acked = [], 0
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        e = json.loads(line)
+                        if "a" in e:
+                            acked = max(acked, int(e["a"]))
+                            continue
+                        entries.append((e["t"], e.get("c"), e["r"], e.get("o", "insert"), line))
+                    except (ValueError, KeyError, TypeError):
+                        continue   # línea cortada por un corte de energía
+        except OSError:
+            pass
+        self._rows.extend(entries[acked:])
+        self._queued += len(self._rows)
+        if self._rows:
+            log.info("Outbox: %d escrituras pendientes recuperadas del journal", len(self._rows))
+
+    @staticmethod
+    def _dump(table, conflict, row, op) -> str:
+        e = {"t": table, "c": conflict, "r": row}
+        if op != "insert":
+            e["o"] = op
+        return json.dumps(e, separators=(",", ":")) + "\n"
+
+    def put(self, table: str, row: dict, on_conflict: str = None, op: str = "insert") -> bool:
+        """
+        Encola una fila; False si la cola está llena (el llamador escribe en línea).
+        op="patch": actualiza la fila cuyo `on_conflict` coincide con el resto de
+        columnas; los patch seguidos con las mismas columnas y valores van en un solo
+        PATCH ?col=in.(...), en orden con lo demás (después del insert).
+        op="rpc": `table` es una función SQL que recibe las filas en p_filas (jsonb);
+        las seguidas con las mismas columnas van en una sola llamada.
+        """
+        if len(self._rows) >= self.maxsize or self._journal is None:
+            return False
+        line = self._dump(table, on_conflict, row, op)
+        self._journal.write(line)
+        self._journal.flush()
+        self._rows.append((table, on_conflict, row, op, line))
+        self._queued += 1
+        self._wakeup.set()
+        return True
+
+    def _next_batch(self):
+        """
+        Primeras filas consecutivas que van en una sola petición: misma tabla,
+        conflicto y columnas (POST), o mismos valores fuera de `on_conflict` (patch).
+        """
+        table, conflict, first, op, _ = self._rows[0]
+        if op == "patch":
+            body = {k: v for k, v in first.items() if k != conflict}
+            same = lambda r: r.keys() == first.keys() and all(r[k] == v for k, v in body.items())
+        else:
+            same = lambda r: r.keys() == first.keys()
+        n = 0
+        for t, c, r, o, _ in self._rows:
+            if n >= self.batch or t != table or c != conflict or o != op or not same(r):
+                break
+            n += 1
+        return table, conflict, [self._rows[i][2] for i in range(n)], op
+
+    async def _send(self, table, conflict, rows, op):
+        if op == "rpc":
+            await _sb_request("POST", f"rpc/{table}", json={"p_filas": rows}, headers={"Prefer": "return=minimal"})
+            return
+        if op == "patch":
+            keys = ",".join(str(r[conflict]) for r in rows)
+            await _sb_request("PATCH", table, params={conflict: f"in.({keys})"},
+                              json={k: v for k, v in rows[0].items() if k != conflict},
+                              headers={"Prefer": "return=minimal"})
+            return
+        params = {"on_conflict": conflict} if conflict else None
+        prefer = "return=minimal"
+        if conflict:
+            prefer += ",resolution=ignore-duplicates"   # reintentos idempotentes
+        await _sb_request("POST", table, params=params, json=rows, headers={"Prefer": prefer})
+
+    async def _run(self):
+        backoff = 1.0
+        while True:
+            if not self._rows:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                # juntamos lo que llegue en el intervalo en menos POSTs
+                try:
+                    await asyncio.wait_for(self._flush_now.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._flush_now.clear()
+            table, conflict, rows, op = self._next_batch()
+            try:
+                await self._send(table, conflict, rows, op)
+            except asyncio.CancelledError:
+                raise
+            except httpx.HTTPStatusError as e:
+                code = e.response.status_code
+                if 400 <= code < 500 and code not in (408, 429):
+                    # error permanente (columna inválida, etc.): no bloquear la cola
+                    log.error("Outbox: lote de %d filas a %s rechazado (%s): %s",
+                              len(rows), table, code, e.response.text[:200])
+                    count_error("outbox_dropped")
+                else:
+                    log.warning("Outbox: lote de %d filas a %s falló (%s); reintento en %.0fs",
+                                len(rows), table, code, backoff)
+                    await asyncio.sleep(backoff * random.uniform(0.5, 1.5))
+                    backoff = min(backoff * 2, OUTBOX_MAX_BACKOFF)
+                    continue
+            except Exception as e:
+                log.warning("Outbox: lote de %d filas a %s falló (%s); reintento en %.0fs",
+                            len(rows), table, e, backoff)
+                await asyncio.sleep(backoff * random.uniform(0.5, 1.5))
+                backoff = min(backoff * 2, OUTBOX_MAX_BACKOFF)
+                continue
+            backoff = 1.0
+            for _ in rows:
+                self._rows.popleft()
+            self._done += len(rows)
+            self._acked += len(rows)
+            self._progress.set()
+            if not self._rows:
+                self._journal.truncate(0)   # cola vacía: todo el journal ya se envió
+                self._acked = 0
+                continue
+            self._ack()
+            if self._acked >= OUTBOX_COMPACT:
+                try:
+                    await self._compact()
+                except OSError as e:
+                    log.warning("Outbox: no pude compactar el journal: %s", e)
+
+    async def drain(self, timeout: float = 5.0) -> bool:
+        """
+        Espera a que lo encolado hasta ahora esté en Supabase (True) o a que venza
+        timeout. Lo que entre después no cuenta: con tráfico constante la cola nunca
+        queda vacía y esperar a eso frenaba cada aprobación hasta el timeout.
+        """
+        target = self._queued
+        if self._done >= target:
+            return True
+        self._wakeup.set()
+        self._flush_now.set()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self._done < target:
+            self._progress.clear()
+            try:
+                await asyncio.wait_for(self._progress.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def start(self):
+        self._replay()
+        self._swap_journal(self._write_tmp([e[4] for e in self._rows]))
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        if self._rows:
+            self._wakeup.set()
+
+    async def stop(self, timeout: float = 10.0):
+        if self._task is None:
+            return
+        await self.drain(timeout)
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+        if self._rows:
+            log.warning("Outbox: %d filas quedan en el journal para el próximo arranque", len(self._rows))
+
+outbox = SupabaseOutbox(OUTBOX_PATH, OUTBOX_MAX, OUTBOX_BATCH, OUTBOX_FLUSH_INTERVAL)
 
 # ============ Telegram App ============
 
-app_tg = Application.builder().token(TG_BOT_TOKEN).build()
+class _TokenBucket:
+    """Cubeta de fichas: `rate` por segundo, ráfagas de hasta `capacity`."""
+
+    __slots__ = ("rate", "capacity", "tokens", "stamp", "paused_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+        self.paused_until = 0.0
+
+    def wait_time(self, now: float, reserve: float = 0.0) -> float:
+        """Segundos hasta que haya una ficha (sin consumirla)."""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        need = 1.0 + reserve
+        return 0.0 if self.tokens >= need else (need - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1.0
+
+    @property
+    def idle(self) -> bool:
+        return self.tokens >= self.capacity and self.paused_until < time.monotonic()
+
+class TokenBucketRateLimiter(BaseRateLimiter):
+    """
+    Control de flood para todo lo que envía el bot: tope global, por chat privado y
+    por grupo. Si Telegram responde 429 se respeta retry_after y se reintenta.
+    Los envíos con rate_limit_args={"priority": "low"} (difusiones) dejan libres
+    TG_LOW_PRIORITY_RESERVE fichas globales para las respuestas a usuarios.
+    """
+
+    _THROTTLED = ("send", "edit", "copy", "forward")
+
+    def __init__(self, global_rate: float, chat_rate: float, group_rate: float,
+                 max_retries: int, low_priority_reserve: float):
+        self.global_bucket = _TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.low_priority_reserve = low_priority_reserve
+        self._chats = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # olvidamos los chats que ya recuperaron todas sus fichas
+                self._chats = {k: b for k, b in self._chats.items() if not b.idle}
+            if isinstance(chat_id, str) or int(chat_id) < 0:   # grupo o canal: 20 por minuto
+                bucket = _TokenBucket(self.group_rate, 20.0)
+            else:                                              # privado: ~1/s con ráfagas de 3
+                bucket = _TokenBucket(self.chat_rate, max(1.0, self.chat_rate * 3))
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, chat_id, low: bool):
+        reserve = self.low_priority_reserve if low else 0.0
+        while True:
+            now = time.monotonic()
+            buckets = [(self.global_bucket, reserve)]
+            if chat_id is not None:
+                buckets.append((self._chat_bucket(chat_id), 0.0))
+            delay = max(b.wait_time(now, r) for b, r in buckets)
+            if delay <= 0:
+                for b, _ in buckets:
+                    b.take()
+                return
+            await asyncio.sleep(delay)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        throttled = endpoint.startswith(self._THROTTLED)
+        chat_id = data.get("chat_id") if throttled else None
+        low = isinstance(rate_limit_args, dict) and rate_limit_args.get("priority") == "low"
+        for attempt in range(self.max_retries + 1):
+            if throttled:
+                await self._acquire(chat_id, low)
+            t0 = time.perf_counter() if METRICS_ENABLED else 0.0
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                count_error("telegram_429")
+                if attempt >= self.max_retries:
+                    raise
+                delay = float(e.retry_after)
+                log.warning("Telegram 429 en %s (chat %s): espero %.0fs", endpoint, chat_id, delay)
+                bucket = self._chat_bucket(chat_id) if chat_id is not None else self.global_bucket
+                bucket.paused_until = time.monotonic() + delay
+                await asyncio.sleep(delay)
+            finally:
+                if METRICS_ENABLED:
+                    TELEGRAM_SECONDS.labels(endpoint).observe(time.perf_counter() - t0)
+
+class _PendingUpdateQueue(asyncio.Queue):
+    """update_queue de la Application que lleva la cuenta de LaneUpdateProcessor.pending."""
+
+    def __init__(self, processor: "LaneUpdateProcessor"):
+        super().__init__(maxsize=processor.max_pending)
+        self._proc = processor
+
+    def put_nowait(self, item):   # put() también pasa por aquí
+        super().put_nowait(item)
+        self._proc.pending += 1
+
+    async def get(self):
+        # PTB le crea una tarea a cada update apenas sale de la cola: no entregar más
+        # mientras ya haya max_pending en curso
+        p = self._proc
+        while p.in_flight >= p.max_pending:
+            p._room.clear()
+            await p._room.wait()
+        return await super().get()
+
+    def task_done(self):   # PTB lo llama al terminar cada update (o al descartarlo en stop)
+        super().task_done()
+        self._proc.pending -= 1
+        self._proc._room.set()
+
+class LaneUpdateProcessor(BaseUpdateProcessor):
+    """
+    Procesa updates de distintos usuarios en paralelo, pero los de un mismo usuario
+    y chat de uno en uno y en orden de llegada (así UD_AWAIT_QTY / UD_AWAIT_PROOF no se
+    pisan). El chat admin tiene su propio cupo para que las aprobaciones no esperen
+    detrás del tráfico de clientes; ahí los botones se ordenan por mensaje (la tarjeta
+    de un pedido, la lista de pendientes) y no por chat, o ADMIN_CONCURRENCY no
+    serviría de nada: todo lo pulsa el mismo admin en el mismo chat.
+
+    `pending` cuenta los updates encolados o en curso (de put() a task_done() en
+    `queue`, que va como update_queue de la Application); el webhook responde 503
+    cuando llega a `max_pending`.
+    """
+
+    def __init__(self, customer_limit: int, admin_limit: int, admin_chat_id: int, max_pending: int):
+        # PTB 20 saca cada update de la cola y le crea una tarea al instante, así que el
+        # tamaño de la cola no limita nada: el tope es `max_pending` (ver _PendingUpdateQueue).
+        # El semáforo de la clase base se toma antes de esperar el turno del usuario y
+        # nunca hay más de max_pending tareas, así que no debe bloquear.
+        self.max_pending = max(1, max_pending)
+        super().__init__(self.max_pending)
+        self.admin_chat_id = admin_chat_id
+        self._customer_sem = asyncio.Semaphore(max(1, customer_limit))
+        self._admin_sem = asyncio.Semaphore(max(1, admin_limit))
+        self._locks = {}   # clave -> [Lock, referencias]
+        self.pending = 0
+        self._room = asyncio.Event()
+        self.queue = _PendingUpdateQueue(self)
+
+    @property
+    def in_flight(self) -> int:
+        """Updates que ya salieron de la cola y no terminaron."""
+        return self.pending - self.queue.qsize()
+
+    def _acquire_ref(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _release_ref(self, key):
+        entry = self._locks[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[key]
+
+    async def do_process_update(self, update, coroutine):
+        chat_id = user_id = None
+        if isinstance(update, Update):
+            chat_id = update.effective_chat.id if update.effective_chat else None
+            user_id = update.effective_user.id if update.effective_user else None
+        if chat_id is not None and chat_id == self.admin_chat_id:
+            lane = self._admin_sem
+            q = update.callback_query
+            if q is not None and q.message is not None:
+                keys = [("msg", chat_id, q.message.message_id)]
+            else:
+                keys = [("chat", chat_id)]
+        else:
+            lane = self._customer_sem
+            # siempre chat antes que usuario: orden fijo, sin interbloqueos
+            keys = [k for k in (("chat", chat_id), ("user", user_id)) if k[1] is not None]
+
+        locks = [self._acquire_ref(k) for k in keys]
+        held = []
+        try:
+            for lock in locks:
+                await lock.acquire()
+                held.append(lock)
+            async with lane:
+                await coroutine
+        finally:
+            for lock in reversed(held):
+                lock.release()
+            for k in keys:
+                self._release_ref(k)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+async def _post_init(application: Application):
+    global _bot_loop
+    _bot_loop = asyncio.get_running_loop()   # para los hilos de waitress (HTTP_SERVER=flask)
+    outbox.start()
+    await check_proof_column()
+    await check_proof_mark_rpc()
+    if TIERS_FROM_DB:
+        await refresh_tiers(force=True)
+    if PROOF_CHECK:
+        await asyncio.to_thread(proof_index.load)
+    broadcaster.resume(application.bot)
+
+async def _post_shutdown(application: Application):
+    global _bot_loop
+    _bot_loop = None
+    await broadcaster.stop()
+    await leader.release()
+    await close_peers()
+    await outbox.stop()
+    proof_index.close()
+    await close_proof_archive()
+    coordinator.close()
+    await sb_close()
+
+# La Application se construye en build_app() y no al importar: crea los clientes
+# HTTP de PTB (contextos TLS incluidos) y así el servidor HTTP puede responder antes.
+app_tg = None
+
+def build_app() -> Application:
+    """Construye la Application (una sola vez) y registra handlers y jobs."""
+    global app_tg
+    if app_tg is not None:
+        return app_tg
+    processor = LaneUpdateProcessor(BOT_CONCURRENCY, ADMIN_CONCURRENCY, ADMIN_CHAT_ID, UPDATE_QUEUE_SIZE)
+    builder = (
+        Application.builder()
+        .token(TG_BOT_TOKEN)
+        .update_queue(processor.queue)
+        .concurrent_updates(processor)
+        .rate_limiter(TokenBucketRateLimiter(
+            TG_GLOBAL_RATE, TG_CHAT_RATE, TG_GROUP_RATE, TG_MAX_RETRIES, TG_LOW_PRIORITY_RESERVE
+        ))
+        .persistence(state_store)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+    )
+    if TG_API_BASE_URL:
+        # servidor Bot API propio (o el falso de bench/): mismas rutas que api.telegram.org
+        builder.base_url(f"{TG_API_BASE_URL}/bot").base_file_url(f"{TG_API_BASE_URL}/file/bot")
+    app_tg = builder.build()
+    if METRICS_ENABLED:
+        UPDATE_QUEUE_DEPTH.set_function(lambda: processor.pending)
+        OUTBOX_DEPTH.set_function(lambda: len(outbox))
+    register_handlers()
+    register_jobs()
+    return app_tg
 
 # Keys de user_data
 UD_AWAIT_QTY   = "await_qty"
 UD_ORDER       = "order"         # dict con {id, qty, amount}
+UD_QUOTE       = "quote"         # {price, min, v, at}: precio mostrado al pulsar Recargar
 UD_AWAIT_PROOF = "await_proof"
 
 # ========= Helpers de UI =========
 
-def kb_home():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("💳 Recargar", callback_data="recargar")],
-        [InlineKeyboardButton("💼 Mis créditos", callback_data="saldo")],
-        [InlineKeyboardButton("❓ Ayuda", callback_data="ayuda")],
-    ])
-
-def kb_cancel():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("❌ Cancelar solicitud", callback_data="cancel")],
-    ])
+# Supabase no respondió y no hay copia en cache: mejor decirlo que cotizar mal
+SB_DOWN_TEXT = "⚠️ No pude consultar tu cuenta en este momento. Intenta de nuevo en unos minutos."
+
+# Teclados y textos fijos se arman una sola vez (los objetos de PTB son inmutables y
+# se pueden compartir entre updates); los textos con datos del pedido son plantillas
+# (.format de una constante) para que todo el copy quede junto.
+KB_HOME = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💳 Recargar", callback_data="recargar")],
+    [InlineKeyboardButton("💼 Mis créditos", callback_data="saldo")],
+    [InlineKeyboardButton("❓ Ayuda", callback_data="ayuda")],
+])
+KB_CANCEL = InlineKeyboardMarkup([
+    [InlineKeyboardButton("❌ Cancelar solicitud", callback_data="cancel")],
+])
 
 def kb_admin(order_id: str, user_id: int, qty: int):
     return InlineKeyboardMarkup([
@@ -249,6 +1934,45 @@ def kb_admin(order_id: str, user_id: int, qty: int):
         ]
     ])
 
+HOME_TEXT = f"👋 Bienvenido a <b>{BRAND_NAME}</b>.\n\nSelecciona una opción:"
+HELP_TEXT = (
+    "1) Pulsa <b>Recargar</b> y escribe la cantidad de cuentas.\n"
+    "2) Paga el monto exacto usando el QR de Yape.\n"
+    "3) Envíame la <b>captura del pago</b> en este chat.\n"
+    "4) Un admin aprobará y se acreditarán tus créditos."
+)
+CANCELLED_TEXT = "✅ Solicitud cancelada. Vuelve a empezar con /start."
+ASK_QTY_TEXT = (
+    "Indica cuántas <b>cuentas</b> deseas comprar.\n"
+    "Precio por cuenta (según tus cuentas asignadas): <b>{price:.2f} PEN</b>."
+).format
+CREDITS_TEXT = "💼 Tus créditos: <b>{}</b>".format
+ORDER_CAPTION = (
+    "<b>Pedido {order_id}</b>\n"
+    "Precio por cuenta: <b>{price:.2f} PEN</b>\n"
+    "Créditos/Cuentas: <b>{qty}</b>\n"
+    "Importe total: <b>{amount:.2f} PEN</b>\n\n"
+    "1) Escanea o abre el QR de Yape.\n"
+    "2) Paga el monto exacto.\n"
+    "3) Envíame la <b>captura del pago</b> a este chat."
+).format
+ADMIN_CAPTION = (
+    "📥 <b>Pago recibido</b>\n"
+    "Usuario: <code>{user_id}</code> @{username}\n"
+    "Pedido: <code>{order_id}</code>\n"
+    "Precio unitario: <b>{price:.2f} PEN</b>\n"
+    "Importe: <b>{amount:.2f} PEN</b>\n"
+    "Créditos solicitados: <b>{qty}</b>"
+).format
+DUP_NOTE = (
+    "\n\n⚠️ <b>Comprobante duplicado</b>: es el mismo archivo que el del pedido "
+    "<code>{order_id}</code>"
+).format
+SIMILAR_NOTE = (
+    "\n\n⚠️ <b>Posible comprobante duplicado</b>: se parece al del pedido "
+    "<code>{order_id}</code> (distancia {distance})"
+).format
+
 # ===== NEW: util para borrar un mensaje con botón =====
 async def _delete_button_message(update_or_query):
     """Borra el mensaje que contiene el botón que se pulsó (si existe)."""
@@ -260,59 +1984,650 @@ async def _delete_button_message(update_or_query):
         if msg:
             await msg.delete()
     except Exception:
-        pass
+        count_error("delete_message")
+
+# Navegación: el siguiente paso de un menú reemplaza al mensaje del botón con un solo
+# editMessageText. UI_EDIT_IN_PLACE=0 vuelve a borrar el mensaje y mandar uno nuevo.
+UI_EDIT_IN_PLACE = os.getenv("UI_EDIT_IN_PLACE", "1") == "1"
+
+async def show_step(update: Update, text: str, reply_markup=None, parse_mode=None):
+    """Muestra `text` en lugar del mensaje cuyo botón se pulsó."""
+    q = update.callback_query
+    msg = q.message
+    # los mensajes con foto (el QR) no tienen texto que editar: ahí se borra y se manda
+    if UI_EDIT_IN_PLACE and msg is not None and msg.text is not None:
+        try:
+            await q.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+            return
+        except BadRequest:
+            count_error("edit_message")   # p. ej. el mensaje ya no existe
+    await _delete_button_message(update)
+    await update.effective_chat.send_message(text, reply_markup=reply_markup, parse_mode=parse_mode)
+
+# ========= QR de Yape =========
+# El QR se sube a Telegram una sola vez: el file_id que devuelve se guarda (también
+# en disco, sobrevive reinicios) y cada pedido lo reutiliza, sin que Telegram vuelva
+# a descargar la imagen del host externo.
+# Fuentes posibles:
+#   - YAPE_QR_URL = URL http(s) o ruta a un archivo local (png/jpg)
+#   - YAPE_QR_PAYLOAD = texto a codificar; si contiene {amount} se genera un QR por
+#     importe (con qrcode/Pillow) y se cachea el file_id de cada importe.
+QR_FILE_IDS_PATH = os.getenv("QR_FILE_IDS_PATH", os.path.join(DATA_DIR, "qr_file_ids.json"))
+QR_CACHE_SIZE    = int(os.getenv("QR_CACHE_SIZE", "256"))   # importes distintos recordados
+
+class QrPhotoCache:
+    """Envía el QR de pago reutilizando el file_id de Telegram por importe."""
+
+    def __init__(self, source: str, payload: str, path: str, maxsize: int):
+        self.source = source
+        self.payload = payload
+        self.path = path
+        self.maxsize = maxsize
+        self.per_amount = "{amount}" in payload
+        self._file_ids = OrderedDict()
+        self._upload_lock = asyncio.Lock()
+        self._load()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.payload) or self.source.lower().startswith(("http://", "https://")) \
+            or os.path.isfile(self.source)
+
+    def _key(self, amount: float) -> str:
+        # el file_id depende de la imagen: si cambia la fuente, no se reutiliza
+        if self.per_amount:
+            return f"{self.payload}|{amount:.2f}"
+        return self.payload or self.source
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self._file_ids.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(dict(self._file_ids), f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.warning("QR: no pude guardar file_ids: %s", e)
+
+    def _remember(self, key: str, file_id: str):
+        self._file_ids[key] = file_id
+        self._file_ids.move_to_end(key)
+        while len(self._file_ids) > self.maxsize:
+            self._file_ids.popitem(last=False)
+        self._save()
+
+    def _render(self, amount: float) -> bytes:
+        """Genera el PNG del QR (CPU: se llama en un hilo)."""
+        import qrcode
+        text = self.payload.format(amount=f"{amount:.2f}") if self.per_amount else self.payload
+        buf = io.BytesIO()
+        qrcode.make(text, box_size=8, border=2).save(buf, format="PNG")
+        return buf.getvalue()
+
+    def _read_file(self) -> bytes:
+        with open(self.source, "rb") as f:
+            return f.read()
+
+    async def _source_for(self, amount: float):
+        if self.payload:
+            return await asyncio.to_thread(self._render, amount)
+        if self.source.lower().startswith(("http://", "https://")):
+            return self.source
+        return await asyncio.to_thread(self._read_file)
+
+    async def reply(self, message, amount: float, **kwargs):
+        """Responde a `message` con el QR (file_id cacheado si existe)."""
+        key = self._key(amount)
+        file_id = self._file_ids.get(key)
+        if file_id:
+            try:
+                return await message.reply_photo(file_id, **kwargs)
+            except BadRequest as e:
+                log.warning("QR: file_id inválido, se vuelve a subir: %s", e)
+                self._file_ids.pop(key, None)
+
+        async with self._upload_lock:
+            file_id = self._file_ids.get(key)   # otro pedido pudo subirlo mientras esperábamos
+            photo = file_id or await self._source_for(amount)
+            sent = await message.reply_photo(photo, **kwargs)
+            if not file_id and sent.photo:
+                self._remember(key, sent.photo[-1].file_id)
+            return sent
+
+qr_photos = QrPhotoCache(YAPE_QR_URL, YAPE_QR_PAYLOAD, QR_FILE_IDS_PATH, QR_CACHE_SIZE)
+
+# ========= Comprobantes duplicados =========
+# Un comprobante se marca como duplicado cuando es el mismo archivo que uno anterior:
+# mismo file_unique_id de Telegram (reenviado) o mismos bytes (SHA-256, ya calculado
+# al descargarlo). Ninguna de las dos da falsos positivos entre pagos distintos.
+#
+# Las capturas de Yape salen de la misma plantilla y solo cambian el monto, el nombre
+# y el número de operación: en un hash perceptual (dHash de 64 bits) casi todas
+# quedan a distancia 0-2 entre sí, más cerca que una misma captura recomprimida o
+# recortada (ver bench/bench_phash.py). Por eso el parecido perceptual es opcional
+# (PROOF_PHASH=1, útil cuando los comprobantes no comparten plantilla) y solo se
+# avisa si es poco ambiguo: si los buckets del índice juntan más de
+# PROOF_DUP_MAX_CANDIDATES capturas, o hay más de PROOF_DUP_MAX_MATCHES parecidas,
+# el hash no distingue esa imagen y no se reporta nada. El tope también acota el
+# costo de cada búsqueda, que corre en el event loop.
+#
+# Índice multi-hash (4 bloques de 16 bits): por el principio del palomar, una captura
+# a distancia de Hamming <= PROOF_DUP_DISTANCE coincide casi exactamente en al menos
+# un bloque. Todo se guarda en PROOF_INDEX_PATH, una línea por captura
+# ("dhash order_id sha256 file_unique_id"; las líneas viejas traen solo las dos
+# primeras). Con varias réplicas el archivo es compartido: cada una relee lo nuevo
+# antes de buscar.
+PROOF_INDEX_PATH         = os.getenv("PROOF_INDEX_PATH", os.path.join(DATA_DIR, "proof_hashes.txt"))
+PROOF_CHECK              = os.getenv("PROOF_CHECK", "1") == "1"
+PROOF_PHASH              = os.getenv("PROOF_PHASH", "0") == "1"                # también avisar capturas parecidas
+PROOF_DUP_DISTANCE       = int(os.getenv("PROOF_DUP_DISTANCE", "6"))          # bits distintos tolerados
+PROOF_DUP_MAX_CANDIDATES = int(os.getenv("PROOF_DUP_MAX_CANDIDATES", "256"))  # capturas revisadas por búsqueda
+PROOF_DUP_MAX_MATCHES    = int(os.getenv("PROOF_DUP_MAX_MATCHES", "2"))       # más parecidas = ambiguo
+
+def dhash(image_bytes: bytes) -> int:
+    """dHash 64 bits: gris 9x8 y compara cada píxel con su vecino derecho (CPU, usar en hilo)."""
+    from PIL import Image
+    with Image.open(io.BytesIO(image_bytes)) as im:
+        return dhash_image(im)
+
+class ProofHashIndex:
+    """
+    Comprobantes ya vistos: claves exactas (file_unique_id, SHA-256) -> order_id y,
+    con `similar`, índice multi-hash de dHash con búsqueda por distancia de Hamming.
+    """
+
+    BLOCKS = 4
+    BLOCK_BITS = 16
+    SHA_CHARS = 32   # 128 bits del SHA-256 bastan para identificar el archivo
+
+    def __init__(self, path: str, max_distance: int, similar: bool = False,
+                 max_candidates: int = 256, max_matches: int = 2):
+        self.path = path
+        self.max_distance = max_distance
+        self.similar = similar
+        self.max_candidates = max_candidates
+        self.max_matches = max_matches
+        self.radius = max_distance // self.BLOCKS   # bits a variar por bloque al buscar
+        self.exact = {}      # "u:<file_unique_id>" / "s:<sha256>" -> order_id
+        self.hashes = []     # posición -> hash
+        self.orders = []     # posición -> order_id
+        self._tables = [{} for _ in range(self.BLOCKS)]   # valor del bloque -> [posiciones]
+        self._file = None
+        self._offset = 0     # bytes del archivo ya indexados
+        self._own = set()    # entradas escritas aquí y aún no releídas por refresh()
+        mask = (1 << self.BLOCK_BITS) - 1
+        self._masks = [(i * self.BLOCK_BITS, mask) for i in range(self.BLOCKS)]
+        self._flips = self._flip_masks(self.radius)
+
+    def _flip_masks(self, radius: int):
+        """Máscaras XOR de 16 bits con hasta `radius` bits encendidos."""
+        out = [0]
+        for _ in range(radius):
+            out = sorted(set(out) | {m | (1 << b) for m in out for b in range(self.BLOCK_BITS)})
+        return out
+
+    def __len__(self):
+        return len(self.orders) if self.similar else len(self.exact)
+
+    @staticmethod
+    def _keys(sha256: str, unique_id: str):
+        keys = []
+        if unique_id:
+            keys.append(f"u:{unique_id}")
+        if sha256:
+            keys.append(f"s:{sha256[:ProofHashIndex.SHA_CHARS]}")
+        return keys
+
+    def _index(self, h: int, order_id: str, sha256: str = "", unique_id: str = ""):
+        for key in self._keys(sha256, unique_id):
+            self.exact.setdefault(key, order_id)
+        if not self.similar or h is None:
+            return
+        pos = len(self.hashes)
+        self.hashes.append(h)
+        self.orders.append(order_id)
+        for table, (shift, mask) in zip(self._tables, self._masks):
+            table.setdefault((h >> shift) & mask, []).append(pos)
+
+    def _read_new(self):
+        """Líneas completas agregadas desde self._offset -> [(hash, order_id, sha256, file_unique_id)]."""
+        out = []
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(self._offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break   # otra réplica la está escribiendo
+                    self._offset += len(line)
+                    parts = line.decode(errors="replace").split()
+                    if len(parts) < 2:
+                        continue
+                    sha, uid = (parts[2:4] + ["-", "-"])[:2]
+                    try:
+                        h = None if parts[0] == "-" else int(parts[0], 16)
+                    except ValueError:
+                        continue
+                    out.append((h, parts[1], "" if sha == "-" else sha, "" if uid == "-" else uid))
+        except OSError:
+            pass
+        return out
+
+    def load(self):
+        for entry in self._read_new():
+            self._index(*entry)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+        log.info("Comprobantes: %d capturas en el índice", len(self))
+
+    def refresh(self):
+        """Incorpora lo que otras réplicas agregaron al archivo compartido."""
+        for entry in self._read_new():
+            if entry in self._own:
+                self._own.discard(entry)
+            else:
+                self._index(*entry)
+
+    def add(self, h, order_id: str, sha256: str = "", unique_id: str = ""):
+        sha256 = sha256[:self.SHA_CHARS]
+        self._index(h, order_id, sha256, unique_id)
+        if self._file:
+            if REPLICA_COUNT > 1:
+                self._own.add((h, order_id, sha256, unique_id))
+            self._file.write(f"{'-' if h is None else format(h, '016x')} {order_id} {sha256 or '-'} {unique_id or '-'}\n")
+            self._file.flush()
+
+    def lookup_exact(self, order_id: str, sha256: str = "", unique_id: str = ""):
+        """order_id de otro pedido con el mismo archivo, o None."""
+        for key in self._keys(sha256, unique_id):
+            other = self.exact.get(key)
+            if other is not None and other != order_id:
+                return other
+        return None
+
+    def lookup(self, h: int, exclude_order: str = None):
+        """
+        Capturas previas parecidas: [(distancia, order_id)] ordenadas por distancia.
+        [] si no hay o si la búsqueda es ambigua (demasiados candidatos o parecidas).
+        """
+        if not self.similar or h is None:
+            return []
+        buckets = []
+        candidates = 0
+        for table, (shift, mask) in zip(self._tables, self._masks):
+            block = (h >> shift) & mask
+            for flip in self._flips:
+                bucket = table.get(block ^ flip)
+                if bucket:
+                    candidates += len(bucket)
+                    if candidates > self.max_candidates:
+                        return []
+                    buckets.append(bucket)
+        seen = set()
+        found = []
+        for bucket in buckets:
+            for pos in bucket:
+                if pos in seen:
+                    continue
+                seen.add(pos)
+                d = (self.hashes[pos] ^ h).bit_count()
+                if d <= self.max_distance and self.orders[pos] != exclude_order:
+                    found.append((d, self.orders[pos]))
+        if len(found) > self.max_matches:
+            return []
+        found.sort()
+        return found
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+proof_index = ProofHashIndex(
+    PROOF_INDEX_PATH, PROOF_DUP_DISTANCE, PROOF_PHASH, PROOF_DUP_MAX_CANDIDATES, PROOF_DUP_MAX_MATCHES,
+)
+
+async def check_duplicate_proof(photo, order_id: str, staged=None):
+    """
+    Indexa la captura y devuelve (order_id, distancia) del comprobante anterior que
+    coincide, o None; la distancia es None si es el mismo archivo. Con el archivo de
+    comprobantes activo, `staged` es la tarea de stage_proof() y se usan el SHA-256
+    y el dHash que ya calculó (una sola descarga).
+    """
+    unique_id = photo.file_unique_id or ""
+    if REPLICA_COUNT > 1:
+        proof_index.refresh()
+    other = proof_index.lookup_exact(order_id, unique_id=unique_id)
+    if other:
+        return other, None   # reenvío del mismo archivo: no hace falta descargarlo
+    try:
+        if staged is not None:
+            st = await asyncio.shield(staged)
+            if st is None:
+                return None
+            sha, h = st["sha256"], st["dhash"]
+        else:
+            tg_file = await photo.get_file()
+            data = bytes(await tg_file.download_as_bytearray())
+            sha = hashlib.sha256(data).hexdigest()
+            h = await asyncio.to_thread(dhash, data) if PROOF_PHASH else None
+    except Exception as e:
+        log.warning("Comprobantes: no pude calcular el hash del pedido %s: %s", order_id, e)
+        count_error("proof_hash")
+        return None
+    if REPLICA_COUNT > 1:
+        proof_index.refresh()
+    other = proof_index.lookup_exact(order_id, sha256=sha)
+    matches = [] if other else proof_index.lookup(h, exclude_order=order_id)
+    proof_index.add(h, order_id, sha, unique_id)
+    if other:
+        return other, None
+    return (matches[0][1], matches[0][0]) if matches else None
+
+# La marca de cada captura lleva valores propios (file_id, hora), así que no entra
+# en un PATCH in.(...): va por la función marcar_comprobantes (sql/pagos_comprobante.sql),
+# que el outbox llama con un lote de marcas. Si la función no está instalada se
+# manda un PATCH por pedido.
+_proof_mark_rpc = False   # lo fija check_proof_mark_rpc al arrancar
+
+async def check_proof_mark_rpc():
+    """¿Existe marcar_comprobantes? Se prueba con un lote vacío (no toca filas)."""
+    global _proof_mark_rpc
+    _proof_mark_rpc = False
+    try:
+        await _sb_request("POST", "rpc/marcar_comprobantes", json={"p_filas": []})
+        _proof_mark_rpc = True
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 404:
+            log.warning("Supabase: falta la función marcar_comprobantes (sql/pagos_comprobante.sql); "
+                        "las marcas de captura van de a una")
+        else:
+            log.warning("Supabase: no pude comprobar marcar_comprobantes (%s); las marcas van de a una",
+                        e.response.status_code)
+    except Exception as e:
+        log.warning("Supabase: no pude comprobar marcar_comprobantes (%s); las marcas van de a una", e)
+
+# sb_list_pending y las marcas de captura usan pagos.comprobante_at, que agrega
+# sql/pagos_comprobante.sql. Sin la migración PostgREST responde 400 a cualquier
+# consulta que la nombre: /pendientes lista entonces todos los pendientes y las
+# marcas no se mandan.
+_proof_column = True   # lo fija check_proof_column al arrancar
+
+async def check_proof_column():
+    global _proof_column
+    _proof_column = True   # ante la duda (Supabase caído) se asume migrado
+    try:
+        await _sb_request("GET", "pagos", params={"select": "comprobante_at", "limit": "1"})
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 400:   # 42703: la columna no existe
+            _proof_column = False
+            log.warning("Supabase: pagos no tiene comprobante_at (sql/pagos_comprobante.sql); "
+                        "/pendientes lista también los pedidos sin captura")
+    except Exception as e:
+        log.warning("Supabase: no pude comprobar pagos.comprobante_at (%s)", e)
+
+async def _mark_proof_received(order_id: str, file_id: str):
+    if not _proof_column:
+        return
+    # por el outbox: sale después del insert del pedido y se reintenta si Supabase
+    # falla (sin la marca, expire_stale_orders vencería un pedido con captura)
+    mark = {"comprobante_file_id": file_id, "comprobante_at": datetime.utcnow().isoformat()}
+    if _proof_mark_rpc:
+        queued = outbox.put("marcar_comprobantes", {"id": order_id, **mark}, op="rpc")
+    else:
+        queued = outbox.put("pagos", {"id": order_id, **mark}, on_conflict="id", op="patch")
+    if queued:
+        return
+    await outbox.drain(timeout=10)
+    await sb_patch("pagos", {"id": order_id}, mark)
+
+# ========= Archivo de comprobantes =========
+# Copia propia de cada captura para auditorías y reclamos sin depender de Telegram.
+# La descarga se transmite por partes a un archivo (la imagen nunca está entera en
+# memoria) mientras se calcula su SHA-256; un proceso del pool la abre una sola vez
+# para el dHash (lo reutiliza la detección de duplicados) y una miniatura WebP.
+# Después se mueve a PROOF_ARCHIVE_DIR o se sube a Supabase Storage, y la ubicación
+# queda en la fila de 'pagos' (ver sql/comprobantes_archivo.sql).
+PROOF_ARCHIVE             = os.getenv("PROOF_ARCHIVE", "").strip().lower()    # "" (apagado) | disk | bucket
+PROOF_ARCHIVE_DIR         = os.getenv("PROOF_ARCHIVE_DIR", os.path.join(DATA_DIR, "comprobantes"))
+PROOF_ARCHIVE_BUCKET      = os.getenv("PROOF_ARCHIVE_BUCKET", "comprobantes")   # bucket de Supabase Storage
+PROOF_ARCHIVE_CONCURRENCY = int(os.getenv("PROOF_ARCHIVE_CONCURRENCY", "4"))    # descargas/subidas a la vez
+PROOF_WORKERS             = int(os.getenv("PROOF_WORKERS", "2"))                # procesos para Pillow
+PROOF_THUMB_SIZE          = int(os.getenv("PROOF_THUMB_SIZE", "320"))           # px del lado mayor
+PROOF_THUMB_QUALITY       = int(os.getenv("PROOF_THUMB_QUALITY", "60"))         # calidad WebP (0-100)
+PROOF_CHUNK               = 64 * 1024
+
+if PROOF_ARCHIVE not in ("", "disk", "bucket"):
+    raise SystemExit(f"PROOF_ARCHIVE inválido: {PROOF_ARCHIVE!r} (usa disk o bucket)")
+
+_PROOF_TMP = os.path.join(PROOF_ARCHIVE_DIR, "tmp")
+
+_proof_pool = None
+_archive_client = None
+_archive_sem = None
+
+def _main_is_bot() -> bool:
+    """¿Se arrancó con `python recharge_bot.py` en lugar de main.py?"""
+    path = getattr(sys.modules["__main__"], "__file__", None)
+    return bool(path) and os.path.realpath(path) == os.path.realpath(__file__)
+
+def _proof_get_pool():
+    global _proof_pool
+    if _proof_pool is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        if _main_is_bot():
+            # cada proceso nuevo del pool importa el script principal como __mp_main__,
+            # y este no se importa sin efectos (logging, SQLite, outbox…)
+            log.warning("Comprobantes: arrancado como recharge_bot.py; Pillow corre en hilos "
+                        "(usa `python main.py` para procesos)")
+            _proof_pool = ThreadPoolExecutor(PROOF_WORKERS, thread_name_prefix="proof")
+            return _proof_pool
+        # nada de fork: este proceso ya tiene hilos (httpx, logging, persistencia) y un
+        # hijo podría nacer con un lock tomado. Los procesos solo importan proof_worker
+        # (precargado en el forkserver) y main.py, que no hace nada al importarse.
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            ctx = multiprocessing.get_context("forkserver")
+            ctx.set_forkserver_preload(["proof_worker"])
+        else:
+            ctx = multiprocessing.get_context("spawn")
+        _proof_pool = ProcessPoolExecutor(PROOF_WORKERS, mp_context=ctx)
+    return _proof_pool
+
+async def _proof_submit(fn, *args):
+    """
+    Corre fn(*args) en el pool. Si un proceso muere (p. ej. sin memoria con una imagen
+    enorme) el pool queda roto para siempre: se reemplaza por uno nuevo y el trabajo
+    se reintenta una vez.
+    """
+    from concurrent.futures.process import BrokenProcessPool
+    global _proof_pool
+    loop = asyncio.get_running_loop()
+    for attempt in (1, 2):
+        pool = _proof_get_pool()
+        try:
+            return await loop.run_in_executor(pool, fn, *args)
+        except BrokenProcessPool:
+            if pool is _proof_pool:   # el primero que lo nota lo reemplaza
+                _proof_pool = None
+                pool.shutdown(wait=False, cancel_futures=True)
+                log.warning("Comprobantes: un proceso del pool murió; lo recreo")
+                count_error("proof_pool")
+            if attempt == 2:
+                raise
+
+def _archive_get_client() -> httpx.AsyncClient:
+    """Cliente aparte del de PostgREST: baja archivos de Telegram y sube a Storage."""
+    global _archive_client, _archive_sem
+    if _archive_client is None:
+        _archive_client = httpx.AsyncClient(timeout=httpx.Timeout(30, connect=10))
+        _archive_sem = asyncio.Semaphore(PROOF_ARCHIVE_CONCURRENCY)
+    return _archive_client
+
+def _archive_error(e: Exception) -> str:
+    # el mensaje de httpx incluye la URL, y la de descarga de Telegram lleva el token
+    if isinstance(e, httpx.HTTPStatusError):
+        return f"HTTP {e.response.status_code}"
+    return type(e).__name__ if isinstance(e, httpx.HTTPError) else str(e)
+
+def _remove_quietly(*paths):
+    for p in paths:
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+async def stage_proof(photo, order_id: str):
+    """Descarga la captura a disco por partes y calcula dHash + miniatura -> dict o None."""
+    client = _archive_get_client()
+    # un pedido puede recibir varias capturas: cada una con su propio nombre
+    name = f"{order_id}-{photo.file_unique_id or uuid.uuid4().hex}"
+    src = os.path.join(_PROOF_TMP, f"{name}.jpg")
+    thumb = os.path.join(_PROOF_TMP, f"{name}.webp")
+    try:
+        os.makedirs(_PROOF_TMP, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        async with _archive_sem:
+            tg_file = await photo.get_file()
+            async with client.stream("GET", tg_file.file_path) as r:
+                r.raise_for_status()
+                with open(src, "wb") as f:
+                    async for chunk in r.aiter_bytes(PROOF_CHUNK):
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+        h = await _proof_submit(proof_digest, src, thumb, PROOF_THUMB_SIZE, PROOF_THUMB_QUALITY)
+    except Exception as e:
+        log.warning("Comprobantes: no pude descargar/procesar la captura del pedido %s: %s", order_id, _archive_error(e))
+        count_error("proof_archive")
+        _remove_quietly(src, thumb)
+        return None
+    return {"name": name, "path": src, "thumb": thumb, "size": size, "sha256": digest.hexdigest(), "dhash": h}
+
+async def _storage_upload(path: str, key: str, content_type: str):
+    """Sube un archivo a Supabase Storage leyendo del disco por partes."""
+    async def chunks():
+        # httpx.AsyncClient solo acepta iteradores async; la lectura va en un hilo
+        with open(path, "rb") as f:
+            while chunk := await asyncio.to_thread(f.read, PROOF_CHUNK):
+                yield chunk
+
+    r = await _archive_get_client().post(
+        f"{SUPABASE_URL}/storage/v1/object/{PROOF_ARCHIVE_BUCKET}/{key}",
+        content=chunks(),
+        headers={
+            "apikey": SUPABASE_KEY,
+            "Authorization": f"Bearer {SUPABASE_KEY}",
+            "Content-Type": content_type,
+            "Content-Length": str(os.path.getsize(path)),
+            "x-upsert": "true",
+        },
+    )
+    r.raise_for_status()
+
+async def archive_proof(order_id: str, staged: asyncio.Future) -> bool:
+    """Segundo plano: guarda la captura ya descargada y la enlaza a su fila en 'pagos'."""
+    st = await staged
+    if st is None:
+        return False
+    # AAAA/MM/<pedido>/<captura>: las capturas previas del mismo pedido no se pisan
+    key = f"{datetime.utcnow():%Y/%m}/{order_id}/{st['name']}"
+    try:
+        if PROOF_ARCHIVE == "disk":
+            dst = os.path.join(PROOF_ARCHIVE_DIR, key)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.replace(st["path"], dst + ".jpg")
+            os.replace(st["thumb"], dst + ".webp")
+            location = f"disk://{key}"
+        else:
+            async with _archive_sem:
+                await _storage_upload(st["path"], key + ".jpg", "image/jpeg")
+                await _storage_upload(st["thumb"], key + ".webp", "image/webp")
+            _remove_quietly(st["path"], st["thumb"])
+            location = f"storage://{PROOF_ARCHIVE_BUCKET}/{key}"
+    except Exception as e:
+        # los archivos quedan en PROOF_ARCHIVE_DIR/tmp para subirlos a mano
+        log.warning("Comprobantes: no pude archivar la captura del pedido %s: %s", order_id, _archive_error(e))
+        count_error("proof_archive")
+        return False
+    link = {
+        "comprobante_path": f"{location}.jpg",
+        "comprobante_thumb": f"{location}.webp",
+        "comprobante_bytes": st["size"],
+        "comprobante_sha256": st["sha256"],
+    }
+    # por el outbox, como la marca de captura: sale después del insert del pedido y
+    # se reintenta si Supabase falla
+    if outbox.put("pagos", {"id": order_id, **link}, on_conflict="id", op="patch"):
+        return True
+    await outbox.drain(timeout=10)
+    return await sb_patch("pagos", {"id": order_id}, link) is not None
+
+async def close_proof_archive():
+    global _archive_client, _proof_pool
+    if _archive_client is not None:
+        await _archive_client.aclose()
+        _archive_client = None
+    if _proof_pool is not None:
+        await asyncio.to_thread(_proof_pool.shutdown)
+        _proof_pool = None
 
 # ========= Handlers =========
 
+@instrument_handler
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = (
-        f"👋 Bienvenido a <b>{BRAND_NAME}</b>.\n\n"
-        "Selecciona una opción:"
-    )
-    await update.effective_chat.send_message(text, reply_markup=kb_home(), parse_mode="HTML")
+    await update.effective_chat.send_message(HOME_TEXT, reply_markup=KB_HOME, parse_mode="HTML")
 
+@instrument_handler
 async def on_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     data = q.data or ""
 
-    # NEW: borra el mensaje con el botón antes de mostrar el siguiente paso
-    await _delete_button_message(update)
-
+    # cada rama responde con show_step(): el siguiente paso reemplaza al mensaje del botón
     if data == "recargar":
         context.user_data[UD_AWAIT_QTY] = True
         context.user_data.pop(UD_ORDER, None)
         context.user_data.pop(UD_AWAIT_PROOF, None)
 
         user_id = update.effective_user.id
-        unit_price = get_price_for_user(user_id)
+        try:
+            unit_price, min_qty, version = await get_user_terms(user_id)
+        except SupabaseUnavailable:
+            context.user_data.pop(UD_AWAIT_QTY, None)
+            await show_step(update, SB_DOWN_TEXT, reply_markup=KB_HOME)
+            return
+        # el pedido usa este precio aunque los tramos cambien antes de que escriba la cantidad
+        context.user_data[UD_QUOTE] = {"price": unit_price, "min": min_qty, "v": version, "at": time.time()}
 
-        await q.message.chat.send_message(
-            "Indica cuántas <b>cuentas</b> deseas comprar.\n"
-            f"Precio por cuenta (según tus cuentas asignadas): <b>{unit_price:.2f} PEN</b>.",
-            parse_mode="HTML"
-        )
+        await show_step(update, ASK_QTY_TEXT(price=unit_price), parse_mode="HTML")
 
     elif data == "saldo":
-        # muestra créditos actuales (puedes dejarlo así o usar sb_get_user)
+        # muestra créditos actuales (desde el cache de perfiles)
         user_id = update.effective_user.id
-        user = sb_select_one("usuarios", {"telegram_id": str(user_id)}, "creditos")
+        try:
+            user = await sb_get_user(user_id)
+        except SupabaseUnavailable:
+            await show_step(update, SB_DOWN_TEXT, reply_markup=KB_HOME)
+            return
         cred = int(user["creditos"]) if (user and user.get("creditos") is not None) else 0
-        await q.message.chat.send_message(f"💼 Tus créditos: <b>{cred}</b>", parse_mode="HTML")
+        await show_step(update, CREDITS_TEXT(cred), parse_mode="HTML")
 
     elif data == "ayuda":
-        await q.message.chat.send_message(
-            "1) Pulsa <b>Recargar</b> y escribe la cantidad de cuentas.\n"
-            "2) Paga el monto exacto usando el QR de Yape.\n"
-            "3) Envíame la <b>captura del pago</b> en este chat.\n"
-            "4) Un admin aprobará y se acreditarán tus créditos.",
-            parse_mode="HTML"
-        )
+        await show_step(update, HELP_TEXT, parse_mode="HTML")
 
     elif data == "cancel":
         context.user_data.clear()
-        await q.message.chat.send_message("✅ Solicitud cancelada. Vuelve a empezar con /start.")
+        await show_step(update, CANCELLED_TEXT)
 
+@instrument_handler
 async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Capta la cantidad cuando el usuario está en modo 'await_qty'."""
     if not context.user_data.get(UD_AWAIT_QTY):
@@ -333,7 +2648,18 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # --- MÍNIMO DE COMPRA (dinámico) ---
     user_id = update.effective_user.id
-    min_qty = get_min_qty_for_user(user_id)   # calcula con MIN_QTY_TIERS (ej: "0:2,15:5")
+    # se respeta el precio mostrado al pulsar Recargar; si ya venció, se cotiza de nuevo
+    # (precio y mínimo salen de la misma fila de 'usuarios', una sola consulta)
+    quote = context.user_data.get(UD_QUOTE)
+    if quote and time.time() - quote["at"] < QUOTE_TTL:
+        unit_price, min_qty, tier_version = quote["price"], quote["min"], quote["v"]
+    else:
+        try:
+            unit_price, min_qty, tier_version = await get_user_terms(user_id)
+        except SupabaseUnavailable:
+            # seguimos en modo cantidad: que reintente con el mismo número
+            await update.message.reply_text(SB_DOWN_TEXT)
+            return
 
     if qty < min_qty:
         await update.message.reply_text(
@@ -346,11 +2672,11 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     #     await update.message.reply_text(f"El máximo permitido es {MAX_QTY} cuentas.")
     #     return
 
-    user_id = update.effective_user.id
-    unit_price = get_price_for_user(user_id)
     amount = qty * unit_price
 
     order_id = str(uuid.uuid4())[:8]
+    bind_log(order_id=order_id)
+    created_at = datetime.utcnow().isoformat()
 
     # Guarda orden en memoria y en DB (no bloqueante)
     context.user_data[UD_ORDER] = {
@@ -358,46 +2684,46 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     "qty": qty,
     "amount": amount,
     "unit_price": unit_price,   # <-- guardamos el precio aplicado
+    "tier_version": tier_version,
+    "created_at": created_at,   # para vencerlo aquí mismo (ver order_expired)
 }
+    context.user_data.pop(UD_QUOTE, None)
 
     context.user_data[UD_AWAIT_PROOF] = True
     context.user_data[UD_AWAIT_QTY] = False
 
-    try:
-        sb_insert("pagos", {
-            "id": order_id,
-            "user_id": str(update.effective_user.id),
-            "username": update.effective_user.username or "",
-            "amount": float(amount),
-            "qty": int(qty),
-            "status": "pendiente",
-            "created_at": datetime.utcnow().isoformat()
-        })
-    except Exception:
-        pass
-
-    caption = (
-    f"<b>Pedido {order_id}</b>\n"
-    f"Precio por cuenta: <b>{unit_price:.2f} PEN</b>\n"
-    f"Créditos/Cuentas: <b>{qty}</b>\n"
-    f"Importe total: <b>{amount:.2f} PEN</b>\n\n"
-    "1) Escanea o abre el QR de Yape.\n"
-    "2) Paga el monto exacto.\n"
-    "3) Envíame la <b>captura del pago</b> a este chat."
-)
+    # El pedido se guarda en segundo plano (outbox); el usuario no espera a Supabase
+    row = {
+        "id": order_id,
+        "user_id": str(update.effective_user.id),
+        "username": update.effective_user.username or "",
+        "amount": float(amount),
+        "qty": int(qty),
+        "status": "pendiente",
+        "created_at": created_at
+    }
+    if tier_version:
+        row["tier_version"] = tier_version   # columna de sql/tramos.sql (solo con tramos de la tabla)
+    if not outbox.put("pagos", row, on_conflict="id"):
+        await sb_insert("pagos", row)
+    count_order("pendiente")
+
+    caption = ORDER_CAPTION(order_id=order_id, price=unit_price, qty=qty, amount=amount)
 
 
     # NEW: como aquí no hay botón, no borramos nada.
-    if YAPE_QR_URL.lower().startswith(("http://", "https://")):
-        await update.message.reply_photo(
-            YAPE_QR_URL,
+    if qr_photos.enabled:
+        await qr_photos.reply(
+            update.message,
+            amount,
             caption=caption,
             parse_mode="HTML",
-            reply_markup=kb_cancel()
+            reply_markup=KB_CANCEL
         )
     else:
-        await update.message.reply_text(caption, parse_mode="HTML", reply_markup=kb_cancel())
+        await update.message.reply_text(caption, parse_mode="HTML", reply_markup=KB_CANCEL)
 
+@instrument_handler
 async def on_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Recibe la captura y la manda al admin con botones de aprobar/rechazar."""
     if not context.user_data.get(UD_AWAIT_PROOF) or not context.user_data.get(UD_ORDER):
@@ -405,6 +2731,13 @@ async def on_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     order = context.user_data[UD_ORDER]
+    if order_expired(order):
+        await expire_own_order(context, order["id"])
+        await update.message.reply_text(
+            f"⌛ Tu pedido <code>{order['id']}</code> venció sin comprobante. Usa /start para crear uno nuevo.",
+            parse_mode="HTML",
+        )
+        return
     unit_price = order.get("unit_price")
     user = update.effective_user
     photo = update.message.photo[-1]  # mejor calidad
@@ -413,16 +2746,27 @@ async def on_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     amount = order["amount"]
     qty = order["qty"]
     order_id = order["id"]
+    bind_log(order_id=order_id)
 
     # Notifica al admin
-    cap_admin = (
-    f"📥 <b>Pago recibido</b>\n"
-    f"Usuario: <code>{user.id}</code> @{user.username}\n"
-    f"Pedido: <code>{order_id}</code>\n"
-    f"Precio unitario: <b>{unit_price:.2f} PEN</b>\n"  # <-- nueva línea
-    f"Importe: <b>{amount:.2f} PEN</b>\n"
-    f"Créditos solicitados: <b>{qty}</b>"
-)
+    cap_admin = ADMIN_CAPTION(
+        user_id=user.id, username=user.username, order_id=order_id,
+        price=unit_price, amount=amount, qty=qty,
+    )
+    if order.get("tier_version"):
+        cap_admin += f"\nTramos: v{order['tier_version']}"
+
+    staged = None
+    if PROOF_ARCHIVE:
+        staged = asyncio.ensure_future(stage_proof(photo, order_id))
+        context.application.create_task(archive_proof(order_id, staged))
+    dup = await check_duplicate_proof(photo, order_id, staged) if PROOF_CHECK else None
+    if dup:
+        dup_order, distance = dup
+        if distance is None:
+            cap_admin += DUP_NOTE(order_id=dup_order)
+        else:
+            cap_admin += SIMILAR_NOTE(order_id=dup_order, distance=distance)
 
     await context.bot.send_photo(
         chat_id=ADMIN_CHAT_ID,
@@ -435,25 +2779,41 @@ async def on_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "✅ Captura recibida. Un administrador revisará tu pago en breve."
     )
+    # con comprobante el pedido ya no vence (ver expire_stale_orders)
+    context.application.create_task(_mark_proof_received(order_id, file_id))
     # opcional: context.user_data.clear()
 
+@instrument_handler
 async def on_admin_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Approve/Reject desde el admin."""
     q = update.callback_query
     await q.answer()
     data = q.data or ""
 
+    # el pedido pudo quedar en el outbox: que llegue a 'pagos' antes de tocarlo
+    await outbox.drain(timeout=3)
+
     if data.startswith("approve:"):
         _, order_id, user_id_str, qty_str = data.split(":")
         user_id = int(user_id_str)
         qty = int(qty_str)
-
-        try:
-            sb_patch("pagos", {"id": order_id}, {"status": "aprobado", "updated_at": datetime.utcnow().isoformat()})
-        except Exception:
-            pass
-
-        new_total = sb_add_credits(user_id, qty)
+        bind_log(order_id=order_id, user_id=user_id)
+
+        res = await sb_approve_order(order_id, user_id, qty)
+        if res is None:
+            # no tocamos los botones: el admin puede reintentar
+            await q.message.reply_text(f"⚠️ No se pudo aprobar el pedido {order_id}. Intenta de nuevo.")
+            return
+        if not res.get("aplicado"):
+            # doble toque, o el pedido ya fue rechazado o venció: no se acredita
+            status = res.get("status") or "aprobado"
+            await q.edit_message_caption(
+                caption=q.message.caption + f"\n\nℹ️ Este pedido ya no estaba pendiente ({status})."
+            )
+            return
+        qty = int(res.get("qty") or qty)
+        new_total = int(res.get("creditos") or 0)
+        count_order("aprobado")
 
         try:
             await context.bot.send_message(
@@ -465,8 +2825,9 @@ async def on_admin_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 ),
                 parse_mode="HTML"
             )
-        except Exception:
-            log.warning("No pude notificar al usuario %s", user_id)
+        except Exception as e:
+            log.warning("No pude notificar al usuario %s: %s", user_id, e)
+            count_error("notify")
 
         await q.edit_message_caption(
             caption=q.message.caption + "\n\n✅ Aprobado y créditos acreditados."
@@ -475,39 +2836,964 @@ async def on_admin_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data.startswith("reject:"):
         _, order_id, user_id_str = data.split(":")
         user_id = int(user_id_str)
-
-        try:
-            sb_patch("pagos", {"id": order_id}, {"status": "rechazado", "updated_at": datetime.utcnow().isoformat()})
-        except Exception:
-            pass
+        bind_log(order_id=order_id, user_id=user_id)
+
+        res = await sb_patch("pagos", {"id": order_id, "status": "pendiente"}, {"status": "rechazado", "updated_at": datetime.utcnow().isoformat()})
+        if res is None:
+            # no tocamos los botones: el admin puede reintentar
+            await q.message.reply_text(f"⚠️ No se pudo rechazar el pedido {order_id}. Intenta de nuevo.")
+            return
+        if not res:
+            # ya aprobado, vencido o rechazado antes: al usuario no se le avisa de nuevo
+            await q.edit_message_caption(
+                caption=q.message.caption + "\n\nℹ️ Este pedido ya no estaba pendiente."
+            )
+            return
+        count_order("rechazado")
 
         try:
             await context.bot.send_message(
                 chat_id=user_id,
                 text="⛔ Tu pago fue rechazado. Si crees que es un error, contáctanos."
             )
-        except Exception:
-            pass
+        except Exception as e:
+            log.warning("No pude notificar al usuario %s: %s", user_id, e)
+            count_error("notify")
 
         await q.edit_message_caption(
             caption=q.message.caption + "\n\n⛔ Rechazado por el admin."
         )
 
-# ============ Flask (health) ============
+# ========= Aprobación en lote (/pendientes) =========
+# El admin lista los pagos pendientes por páginas, marca varios y los aprueba con
+# una sola llamada (RPC aprobar_pagos). La selección vive en su user_data y queda
+# atada al mensaje de su último /pendientes: los botones de otra lista (de otro admin
+# o una vieja) no la tocan. Así todo lo que la modifica pasa por ese mensaje, y
+# LaneUpdateProcessor atiende los botones de un mismo mensaje de a uno.
+PENDING_PAGE_SIZE   = int(os.getenv("PENDING_PAGE_SIZE", "8"))
+BULK_MAX_IDS        = 100   # pedidos por llamada a aprobar_pagos
+NOTIFY_CONCURRENCY  = int(os.getenv("NOTIFY_CONCURRENCY", "20"))
+UD_BULK             = "bulk"   # {"msg": message_id, "sel": [order_id, ...], "cursors": [...], "page": n, "rows": [...]}
+
+def _is_admin_chat(update: Update) -> bool:
+    return bool(update.effective_chat) and update.effective_chat.id == ADMIN_CHAT_ID
+
+def _after_filter(after) -> str:
+    """Filtro PostgREST 'or' para keyset sobre (created_at, id)."""
+    ts, oid = after
+    return f'(created_at.gt."{ts}",and(created_at.eq."{ts}",id.gt."{oid}"))'
+
+async def sb_list_pending(after=None, limit: int = PENDING_PAGE_SIZE):
+    """
+    Página de pagos pendientes con captura recibida, ordenada por (created_at, id) y
+    paginada por keyset. Las cotizaciones abandonadas (sin captura) no se listan: las
+    vence expire_stale_orders. Sin la columna comprobante_at (check_proof_column) se
+    listan todos los pendientes.
+    """
+    params = {
+        "select": "id,user_id,username,qty,amount,created_at",
+        "status": "eq.pendiente",
+        "order": "created_at.asc,id.asc",
+        "limit": str(limit),
+    }
+    if _proof_column:
+        params["comprobante_at"] = "not.is.null"
+    if after:
+        params["or"] = _after_filter(after)
+    return await sb_select("pagos", params)
+
+async def sb_approve_orders(order_ids: list):
+    """
+    Aprueba varios pedidos (RPC aprobar_pagos, de a BULK_MAX_IDS).
+    -> ([{order_id, user_id, qty, creditos}] aprobados, [ids de los tramos que fallaron])
+    """
+    done, failed = [], []
+    for i in range(0, len(order_ids), BULK_MAX_IDS):
+        chunk = order_ids[i:i + BULK_MAX_IDS]
+        res = await sb_rpc("aprobar_pagos", {"p_order_ids": chunk})
+        if res is None:
+            failed.extend(chunk)   # no sabemos si quedaron pendientes: se pueden reintentar
+            continue
+        done.extend(res)
+    await invalidate_users(r["user_id"] for r in done)
+    return done, failed
+
+async def notify_many(bot, messages):
+    """Envía [(chat_id, texto)] en paralelo, con tope de envíos simultáneos."""
+    sem = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+
+    async def one(chat_id, text):
+        async with sem:
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML")
+                return True
+            except Exception as e:
+                log.warning("No pude notificar al usuario %s: %s", chat_id, e)
+                count_error("notify")
+                return False
+
+    results = await asyncio.gather(*(one(c, t) for c, t in messages))
+    return sum(results)
+
+def _bulk_state(context, message_id: int):
+    """Selección del admin si `message_id` es su lista vigente; None si no."""
+    st = context.user_data.get(UD_BULK)
+    if not st or st.get("msg") != message_id:
+        return None
+    return st
+
+def kb_pending(rows, st):
+    sel = st["sel"]
+    buttons = []
+    for r in rows:
+        mark = "☑" if r["id"] in sel else "☐"
+        buttons.append([InlineKeyboardButton(
+            f"{mark} {r['id']} · {r['qty']} cu · {r['amount']:.2f}",
+            callback_data=f"bsel:{r['id']}",
+        )])
+    nav = []
+    if st["page"] > 0:
+        nav.append(InlineKeyboardButton("⬅️", callback_data="bpage:prev"))
+    nav.append(InlineKeyboardButton("🔄", callback_data="bpage:here"))
+    if len(rows) == PENDING_PAGE_SIZE and len(st["cursors"]) > st["page"] + 1:
+        nav.append(InlineKeyboardButton("➡️", callback_data="bpage:next"))
+    buttons.append(nav)
+    if sel:
+        buttons.append([
+            InlineKeyboardButton(f"✅ Aprobar seleccionados ({len(sel)})", callback_data="bapprove"),
+            InlineKeyboardButton("✖️ Limpiar", callback_data="bclear"),
+        ])
+    return InlineKeyboardMarkup(buttons)
+
+def _pending_text(rows, st) -> str:
+    if not rows:
+        return "📋 No hay pagos pendientes."
+    lines = [f"📋 <b>Pagos pendientes</b> (página {st['page'] + 1})"]
+    for r in rows:
+        lines.append(f"<code>{r['id']}</code> @{r['username'] or '-'} · {r['qty']} cu · "
+                     f"{r['amount']:.2f} PEN")
+    lines.append(f"\nSeleccionados: <b>{len(st['sel'])}</b>")
+    return "\n".join(lines)
+
+async def _load_pending(st) -> bool:
+    """Trae la página actual y guarda el cursor de la siguiente. False si Supabase falló."""
+    rows = await sb_list_pending(st["cursors"][st["page"]])
+    if rows is None:
+        return False
+    st["rows"] = [
+        {"id": r["id"], "user_id": int(r["user_id"]), "username": r.get("username"),
+         "qty": int(r.get("qty") or 0), "amount": float(r.get("amount") or 0)}
+        for r in rows
+    ]
+    del st["cursors"][st["page"] + 1:]
+    if rows:
+        st["cursors"].append([rows[-1]["created_at"], rows[-1]["id"]])
+    return True
+
+async def _show_pending(update: Update, st, edit: bool):
+    rows = st.get("rows", [])
+    text, kb = _pending_text(rows, st), kb_pending(rows, st)
+    if edit:
+        try:
+            await update.callback_query.edit_message_text(text, parse_mode="HTML", reply_markup=kb)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():   # 🔄 sin cambios no es un error
+                raise
+        return update.callback_query.message
+    return await update.effective_chat.send_message(text, parse_mode="HTML", reply_markup=kb)
+
+@instrument_handler
+async def cmd_pendientes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/pendientes (solo admin): lista paginada con selección múltiple."""
+    if not _is_admin_chat(update):
+        await cmd_start(update, context)
+        return
+    st = {"sel": [], "cursors": [None], "page": 0}
+    if not await _load_pending(st):
+        await update.effective_chat.send_message("⚠️ No pude leer los pagos pendientes.")
+        return
+    msg = await _show_pending(update, st, edit=False)
+    st["msg"] = msg.message_id
+    context.user_data[UD_BULK] = st   # reemplaza la lista anterior de este admin
 
-app_flask = Flask(__name__)
+@instrument_handler
+async def on_bulk_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if not _is_admin_chat(update):
+        await q.answer()
+        return
+    data = q.data or ""
+    st = _bulk_state(context, q.message.message_id if q.message else None)
+    if st is None:
+        await q.answer("Esta lista no es tuya o ya no está vigente: usa /pendientes.", show_alert=True)
+        return
+
+    if data.startswith("bsel:"):
+        oid = data[5:]
+        if oid in st["sel"]:
+            st["sel"].remove(oid)
+        elif any(r["id"] == oid for r in st.get("rows", [])):
+            st["sel"].append(oid)
+        await q.answer()
+        await _show_pending(update, st, edit=True)   # sin volver a consultar Supabase
+
+    elif data.startswith("bpage:"):
+        await q.answer()
+        move = data[6:]
+        if move == "next" and len(st["cursors"]) > st["page"] + 1:
+            st["page"] += 1
+        elif move == "prev" and st["page"] > 0:
+            st["page"] -= 1
+        if not await _load_pending(st):
+            await q.message.reply_text("⚠️ No pude leer los pagos pendientes.")
+            return
+        await _show_pending(update, st, edit=True)
+
+    elif data == "bclear":
+        await q.answer("Selección vacía")
+        st["sel"] = []
+        await _show_pending(update, st, edit=True)
+
+    elif data == "bapprove":
+        sel = st["sel"]
+        if not sel:
+            await q.answer("No hay nada seleccionado")
+            return
+        await q.answer("Aprobando…")
+        await outbox.drain(timeout=3)
+        done, failed = await sb_approve_orders(sel)
+        if failed and not done:
+            await q.message.reply_text("⚠️ No se pudo aprobar el lote. Intenta de nuevo.")
+            return
+
+        # un mensaje por usuario con el total de sus pedidos aprobados
+        per_user = {}
+        for r in done:
+            uid = int(r["user_id"])
+            qty_sum, _ = per_user.get(uid, (0, 0))
+            per_user[uid] = (qty_sum + int(r["qty"]), int(r["creditos"]))
+        sent = await notify_many(context.bot, [
+            (uid, "✅ <b>Pago verificado</b>.\n"
+                  f"Se añadieron <b>{qty_sum}</b> créditos.\n"
+                  f"Saldo actual: <b>{total}</b>")
+            for uid, (qty_sum, total) in per_user.items()
+        ])
+        skipped = len(sel) - len(done) - len(failed)
+        count_order("aprobado", len(done))
+        st["sel"] = failed   # los que fallaron quedan marcados para reintentar
+        st["cursors"], st["page"] = [None], 0
+        await q.message.reply_text(
+            f"✅ Aprobados {len(done)} pedidos de {len(per_user)} usuarios "
+            f"({sent} notificados)."
+            + (f"\nℹ️ {skipped} ya no estaban pendientes." if skipped else "")
+            + (f"\n⚠️ {len(failed)} no se pudieron aprobar; siguen seleccionados, intenta de nuevo."
+               if failed else "")
+        )
+        if await _load_pending(st):
+            await _show_pending(update, st, edit=True)
+
+# ========= Vencimiento y conciliación (JobQueue) =========
+# Los pedidos 'pendiente' sin comprobante más viejos que PAGO_TTL pasan a 'expirado'
+# en lotes (keyset por created_at, id), se limpia UD_ORDER del usuario y se le avisa.
+# El barrido corre solo en el líder y solo toca las sesiones de su réplica; en las
+# demás, on_photo vence el pedido al recibir la captura (order_expired).
+# "Sin comprobante" es comprobante_at nulo, que solo se escribe desde que existe esa
+# columna: los pedidos anteriores podrían estar esperando revisión. Por eso solo
+# vencen los creados desde EXPIRY_SINCE (el despliegue, o cualquier fecha vieja tras
+# correr el backfill de sql/pagos_comprobante.sql); sin EXPIRY_SINCE no vence nada.
+# La conciliación compara, por usuario, los créditos de 'pagos' aprobados contra
+# los deltas de 'creditos_historial', leyendo ambas tablas por páginas.
+PAGO_TTL              = float(os.getenv("PAGO_TTL", str(24 * 3600)))     # segundos
+EXPIRY_SINCE          = os.getenv("EXPIRY_SINCE", "").strip()            # UTC ISO, ej: 2026-10-17T00:00
+EXPIRY_SWEEP_INTERVAL = float(os.getenv("EXPIRY_SWEEP_INTERVAL", "900"))  # segundos
+EXPIRY_BATCH          = int(os.getenv("EXPIRY_BATCH", "200"))
+RECONCILE_INTERVAL    = float(os.getenv("RECONCILE_INTERVAL", str(24 * 3600)))
+RECONCILE_PAGE        = int(os.getenv("RECONCILE_PAGE", "1000"))
+
+if EXPIRY_SINCE:
+    try:
+        EXPIRY_SINCE = datetime.fromisoformat(EXPIRY_SINCE).isoformat()
+    except ValueError:
+        raise SystemExit(f"EXPIRY_SINCE inválido: {EXPIRY_SINCE!r} (usa una fecha ISO, ej: 2026-10-17T00:00)")
+
+@leader_only
+async def expire_stale_orders(context: ContextTypes.DEFAULT_TYPE):
+    """Job: vence pedidos pendientes sin comprobante y avisa a sus usuarios."""
+    app = context.application
+    cutoff = (datetime.utcnow() - timedelta(seconds=PAGO_TTL)).isoformat()
+    after = None
+    expired = 0
+    while True:
+        params = {
+            "select": "id,user_id,created_at",
+            "status": "eq.pendiente",
+            "comprobante_at": "is.null",
+            "and": f"(created_at.gte.{EXPIRY_SINCE},created_at.lt.{cutoff})",
+            "order": "created_at.asc,id.asc",
+            "limit": str(EXPIRY_BATCH),
+        }
+        if after:
+            params["or"] = _after_filter(after)
+        rows = await sb_select("pagos", params)
+        if not rows:
+            break
+        after = (rows[-1]["created_at"], rows[-1]["id"])
+
+        # el filtro status=pendiente evita pisar un pedido aprobado entre medio
+        done = await sb_patch(
+            "pagos",
+            {"id": [r["id"] for r in rows], "status": "pendiente"},
+            {"status": "expirado", "updated_at": datetime.utcnow().isoformat()},
+        ) or []
+        expired += len(done)
+
+        touched = set()
+        for r in done:
+            uid = int(r["user_id"])
+            if replica_for(uid) != REPLICA_INDEX:
+                # su sesión es de otra réplica: si manda la captura igual, on_photo
+                # de la dueña la rechaza (order_expired) y aprobar_pago no acredita
+                # pedidos que no estén pendientes
+                continue
+            ud = app.user_data.get(uid)
+            if ud and (ud.get(UD_ORDER) or {}).get("id") == r["id"]:
+                ud.pop(UD_ORDER, None)
+                ud.pop(UD_AWAIT_PROOF, None)
+                touched.add(uid)
+        if touched:
+            app.mark_data_for_update_persistence(user_ids=touched)
+        await notify_many(app.bot, [
+            (int(r["user_id"]),
+             f"⌛ Tu pedido <code>{r['id']}</code> venció sin comprobante. Usa /start para crear uno nuevo.")
+            for r in done
+        ])
+        if len(rows) < EXPIRY_BATCH:
+            break
+    if expired:
+        count_order("expirado", expired)
+        log.info("Vencimiento: %d pedidos expirados", expired)
+
+def order_expired(order: dict) -> bool:
+    """True si el pedido de UD_ORDER ya cumple las condiciones del barrido (PAGO_TTL desde EXPIRY_SINCE)."""
+    created = order.get("created_at")
+    if not EXPIRY_SINCE or not created or created < EXPIRY_SINCE:
+        return False
+    return created < (datetime.utcnow() - timedelta(seconds=PAGO_TTL)).isoformat()
+
+async def expire_own_order(context: ContextTypes.DEFAULT_TYPE, order_id: str):
+    """Vence el pedido del usuario del update sin esperar al barrido del líder."""
+    context.user_data.pop(UD_ORDER, None)
+    context.user_data.pop(UD_AWAIT_PROOF, None)
+    await outbox.drain(timeout=3)   # que el insert del pedido no llegue después
+    done = await sb_patch(
+        "pagos",
+        {"id": order_id, "status": "pendiente"},
+        {"status": "expirado", "updated_at": datetime.utcnow().isoformat()},
+    )
+    if done:
+        count_order("expirado", len(done))
+
+async def _sum_by_user(table: str, params: dict, user_col: str, value_col: str) -> dict:
+    totals = {}
+    async for row in sb_iter(table, params, page=RECONCILE_PAGE):
+        uid = str(row.get(user_col))
+        totals[uid] = totals.get(uid, 0) + int(row.get(value_col) or 0)
+    return totals
+
+@leader_only
+async def reconcile(context: ContextTypes.DEFAULT_TYPE):
+    """Job: créditos aprobados en 'pagos' vs. 'creditos_historial' (recarga_aprobada)."""
+    try:
+        pagos = await _sum_by_user(
+            "pagos", {"select": "id,user_id,qty", "status": "eq.aprobado"}, "user_id", "qty")
+        hist = await _sum_by_user(
+            "creditos_historial", {"select": "id,usuario_id,delta", "motivo": "eq.recarga_aprobada"},
+            "usuario_id", "delta")
+    except Exception as e:
+        log.warning("Conciliación: no pude leer las tablas: %s", e)
+        count_error("reconcile")
+        return
+
+    diffs = sorted(
+        ((uid, pagos.get(uid, 0), hist.get(uid, 0)) for uid in pagos.keys() | hist.keys()
+         if pagos.get(uid, 0) != hist.get(uid, 0)),
+        key=lambda d: -abs(d[1] - d[2]),
+    )
+    lines = [
+        "🧮 <b>Conciliación</b>",
+        f"Créditos aprobados (pagos): <b>{sum(pagos.values())}</b>",
+        f"Créditos en historial: <b>{sum(hist.values())}</b>",
+        f"Usuarios con diferencias: <b>{len(diffs)}</b>",
+    ]
+    for uid, p, h in diffs[:10]:
+        lines.append(f"<code>{uid}</code>: pagos {p} · historial {h}")
+    log.info("Conciliación: %d usuarios con diferencias", len(diffs))
+    try:
+        await context.bot.send_message(ADMIN_CHAT_ID, "\n".join(lines), parse_mode="HTML")
+    except Exception as e:
+        log.warning("Conciliación: no pude enviar el reporte: %s", e)
+        count_error("reconcile")
+
+# ========= Difusión (/broadcast) =========
+# Envía un anuncio a todos los 'usuarios', leyendo la tabla por páginas (keyset por
+# telegram_id) y enviando con prioridad baja en el limitador. El avance se guarda en
+# BROADCAST_STATE_PATH después de cada página: si el proceso se reinicia, la difusión
+# continúa desde la última página completa (a lo sumo se repite esa página).
+BROADCAST_STATE_PATH  = os.getenv("BROADCAST_STATE_PATH", replica_path(os.path.join(DATA_DIR, "broadcast.json")))
+BROADCAST_PAGE_SIZE   = int(os.getenv("BROADCAST_PAGE_SIZE", "200"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "30"))
+
+class Broadcaster:
+    """Una difusión a la vez; estado {text, cursor, sent, failed, chat_id, message_id}."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.state = None
+        self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.state, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.warning("Difusión: no pude guardar el avance: %s", e)
+
+    def _clear(self):
+        self.state = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
 
-@app_flask.route("/health", methods=["GET"])
-def health():
-    return "ok", 200
+    def start(self, bot, text: str, chat_id: int, message_id: int):
+        self.state = {"text": text, "cursor": None, "sent": 0, "failed": 0,
+                      "chat_id": chat_id, "message_id": message_id}
+        self._save()
+        self._task = asyncio.get_running_loop().create_task(self._run(bot))
+
+    def resume(self, bot) -> bool:
+        """Retoma una difusión que quedó a medias (al arrancar)."""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        log.info("Difusión: retomando desde telegram_id > %s", self.state.get("cursor"))
+        self._task = asyncio.get_running_loop().create_task(self._run(bot))
+        return True
+
+    async def stop(self):
+        """Detiene la tarea sin borrar el avance (apagado del proceso)."""
+        if self.running:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def cancel(self):
+        await self.stop()
+        self._clear()
+
+    def progress_text(self, done: bool = False) -> str:
+        st = self.state or {}
+        head = "📣 <b>Difusión terminada</b>" if done else "📣 <b>Difusión en curso…</b>"
+        return f"{head}\nEnviados: <b>{st.get('sent', 0)}</b> · Fallidos: <b>{st.get('failed', 0)}</b>"
+
+    async def _report(self, bot, done: bool = False):
+        try:
+            await bot.edit_message_text(
+                self.progress_text(done), chat_id=self.state["chat_id"],
+                message_id=self.state["message_id"], parse_mode="HTML",
+            )
+        except Exception as e:
+            log.warning("Difusión: no pude actualizar el progreso: %s", e)
+            count_error("broadcast")
+
+    async def _send_one(self, bot, sem, telegram_id) -> bool:
+        async with sem:
+            try:
+                await bot.send_message(
+                    chat_id=int(telegram_id), text=self.state["text"], parse_mode="HTML",
+                    rate_limit_args={"priority": "low"},
+                )
+                return True
+            except Forbidden:
+                return False   # el usuario bloqueó al bot
+            except Exception as e:
+                log.warning("Difusión: fallo con %s: %s", telegram_id, e)
+                count_error("broadcast")
+                return False
+
+    async def _run(self, bot):
+        st = self.state
+        sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        while True:
+            params = {"select": "telegram_id", "order": "telegram_id.asc", "limit": str(BROADCAST_PAGE_SIZE)}
+            if st["cursor"] is not None:
+                params["telegram_id"] = f"gt.{st['cursor']}"
+            rows = await sb_select("usuarios", params)
+            if rows is None:
+                await asyncio.sleep(10)   # Supabase caído: reintentar la misma página
+                continue
+            if not rows:
+                break
+            ids = [r["telegram_id"] for r in rows if str(r.get("telegram_id") or "").lstrip("-").isdigit()]
+            results = await asyncio.gather(*(self._send_one(bot, sem, t) for t in ids))
+            st["sent"] += sum(results)
+            st["failed"] += len(rows) - sum(results)
+            st["cursor"] = rows[-1]["telegram_id"]
+            self._save()
+            await self._report(bot)
+        await self._report(bot, done=True)
+        log.info("Difusión terminada: %s enviados, %s fallidos", st["sent"], st["failed"])
+        self._clear()
+
+broadcaster = Broadcaster(BROADCAST_STATE_PATH)
+
+@instrument_handler
+async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/broadcast <texto> | /broadcast cancelar | /broadcast (estado). Solo admin."""
+    if not _is_admin_chat(update):
+        await cmd_start(update, context)
+        return
+    parts = (update.message.text_html or "").split(None, 1)
+    arg = parts[1].strip() if len(parts) > 1 else ""
+
+    if not arg:
+        if broadcaster.running:
+            await update.message.reply_text(broadcaster.progress_text(), parse_mode="HTML")
+        else:
+            await update.message.reply_text("Uso: /broadcast <texto>  ·  /broadcast cancelar")
+        return
+    if arg.lower() == "cancelar":
+        was_running = broadcaster.running
+        await broadcaster.cancel()
+        await update.message.reply_text("🛑 Difusión cancelada." if was_running else "No hay difusión en curso.")
+        return
+    if broadcaster.running:
+        await update.message.reply_text("Ya hay una difusión en curso. Usa /broadcast cancelar primero.")
+        return
+
+    status = await update.message.reply_text("📣 <b>Difusión en curso…</b>", parse_mode="HTML")
+    broadcaster.start(context.bot, arg, status.chat_id, status.message_id)
+
+# ========= Reporte de ventas (/reporte) =========
+
+async def sales_report(desde: str, hasta: str) -> dict:
+    """Agrega pagos aprobados del rango en una sola pasada (streaming)."""
+    params = {"select": "id,amount,qty", "status": "eq.aprobado"}
+    rango = _date_range_filter(desde, hasta)
+    if rango:
+        params["and"] = rango
+    rep = {"orders": 0, "units": 0, "revenue": 0.0, "tiers": {}}
+    async for row in sb_iter("pagos", params, page=EXPORT_PAGE):
+        qty = int(row.get("qty") or 0)
+        amount = float(row.get("amount") or 0)
+        rep["orders"] += 1
+        rep["units"] += qty
+        rep["revenue"] += amount
+        unit = round(amount / qty, 2) if qty else 0.0
+        t = rep["tiers"].setdefault(unit, [0, 0, 0.0])
+        t[0] += 1
+        t[1] += qty
+        t[2] += amount
+    return rep
+
+@instrument_handler
+async def cmd_reporte(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/reporte [desde] [hasta] (YYYY-MM-DD, por defecto el mes en curso). Solo admin."""
+    if not _is_admin_chat(update):
+        await cmd_start(update, context)
+        return
+    args = context.args or []
+    today = datetime.utcnow().date()
+    desde = args[0] if len(args) > 0 else today.replace(day=1).isoformat()
+    hasta = args[1] if len(args) > 1 else today.isoformat()
+    try:
+        rep = await sales_report(desde, hasta)
+    except ValueError:
+        await update.message.reply_text("Uso: /reporte 2025-01-01 2025-01-31")
+        return
+    except Exception as e:
+        log.warning("Reporte: error leyendo pagos: %s", e)
+        count_error("report")
+        await update.message.reply_text("⚠️ No pude generar el reporte. Intenta de nuevo.")
+        return
+
+    lines = [
+        f"📊 <b>Ventas {desde} → {hasta}</b>",
+        f"Pedidos aprobados: <b>{rep['orders']}</b>",
+        f"Cuentas vendidas: <b>{rep['units']}</b>",
+        f"Ingresos: <b>{rep['revenue']:.2f} PEN</b>",
+    ]
+    if rep["tiers"]:
+        lines.append("\n<b>Por precio unitario</b>")
+        for unit, (orders, units, revenue) in sorted(rep["tiers"].items()):
+            lines.append(f"{unit:.2f} PEN: {orders} pedidos · {units} cuentas · {revenue:.2f} PEN")
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
+# ============ HTTP (health, métricas, webhook, exportaciones) ============
+# Los endpoints están escritos una sola vez, sin framework: cada uno devuelve
+# (status, cuerpo, cabeceras) y corre en el loop del bot. El cuerpo puede ser un
+# generador async (exportaciones), que se manda por partes.
+# HTTP_SERVER=asyncio (por defecto) los sirve con un servidor mínimo sobre el mismo
+# loop: un solo proceso, un solo hilo, sin importar Flask. HTTP_SERVER=flask mantiene
+# el esquema anterior (Flask + waitress en su propio hilo).
+HTTP_SERVER       = os.getenv("HTTP_SERVER", "asyncio").strip().lower()
+HTTP_MAX_BODY     = int(os.getenv("HTTP_MAX_BODY", str(1 << 20)))   # bytes por request
+HTTP_IDLE_TIMEOUT = float(os.getenv("HTTP_IDLE_TIMEOUT", "75"))     # segundos de keep-alive
+HTTP_BODY_TIMEOUT = float(os.getenv("HTTP_BODY_TIMEOUT", "15"))     # segundos para recibir el cuerpo
+
+# Loop del bot; lo fija _post_init. Con HTTP_SERVER=flask los hilos de waitress lo
+# usan para llegar a los endpoints.
+_bot_loop = None
+
+def http_health():
+    return 200, "ok", {}
+
+def secret_matches(given: str, expected: str) -> bool:
+    """
+    Compara un secreto recibido en una cabecera sin filtrar tiempos. Va en bytes:
+    hmac.compare_digest con str lanza TypeError si la cabecera trae algo no ASCII.
+    """
+    return hmac.compare_digest(
+        (given or "").encode("utf-8", "surrogateescape"),
+        expected.encode("utf-8", "surrogateescape"),
+    )
+
+def http_metrics(headers):
+    if not METRICS_ENABLED:
+        return 404, "metrics disabled", {}
+    if METRICS_TOKEN and not secret_matches(headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        return 403, "forbidden", {}
+    return 200, prom.generate_latest(), {"Content-Type": prom.CONTENT_TYPE_LATEST}
+
+async def _enqueue_update(data: dict) -> bool:
+    """Convierte el JSON en Update y lo encola; False si ya hay demasiados pendientes."""
+    processor = app_tg.update_processor
+    update_id = data.get("update_id")
+    claimed = REPLICA_COUNT > 1 and update_id is not None
+    if claimed and not await coordinator.claim_update(update_id):
+        return True   # ya lo tomó alguna réplica: reintento de Telegram o reenvío repetido
+    if processor.pending >= processor.max_pending:
+        if claimed:
+            await coordinator.release_update(update_id)   # que el reintento sí entre
+        return False
+    app_tg.update_queue.put_nowait(Update.de_json(data, app_tg.bot))
+    return True
+
+async def http_webhook(headers, body: bytes):
+    if BOT_MODE != "webhook":
+        return 404, "not found", {}
+    token = headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not secret_matches(token, WEBHOOK_SECRET):
+        return 403, "forbidden", {}
+    if _bot_loop is None:
+        return 503, "starting", {}
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return 400, "bad request", {}
+    if REPLICA_COUNT > 1 and not headers.get(REPLICA_HEADER):
+        owner = replica_for(update_user_id(data))
+        if owner != REPLICA_INDEX:
+            try:
+                status = await forward_update(data, owner)
+            except Exception as e:
+                log.warning("Webhook: no pude reenviar a la réplica %d: %s", owner, e)
+                count_error("forward")
+                status = 503
+            return (200, "ok", {}) if status == 200 else (503, "busy", {})
+    try:
+        ok = await _enqueue_update(data)
+    except Exception as e:
+        log.warning("Webhook: no pude encolar el update: %s", e)
+        count_error("webhook")
+        ok = False
+    # con 503 Telegram reintenta más tarde; no perdemos el update
+    return (200, "ok", {}) if ok else (503, "busy", {})
+
+def http_invalidate(headers, body: bytes):
+    """Aviso de otra réplica: soltar filas de user_cache (ver invalidate_users)."""
+    if REPLICA_COUNT == 1 or not headers.get(REPLICA_HEADER):
+        return 404, "not found", {}
+    token = headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not secret_matches(token, WEBHOOK_SECRET):
+        return 403, "forbidden", {}
+    try:
+        user_ids = json.loads(body)["user_ids"]
+    except (ValueError, KeyError, TypeError):
+        return 400, "bad request", {}
+    for uid in user_ids if isinstance(user_ids, list) else ():
+        user_cache.invalidate(str(uid))
+    return 200, "ok", {}
+
+# ========= Exportaciones =========
+# GET /export/<tabla>.<csv|ndjson>?desde=YYYY-MM-DD&hasta=YYYY-MM-DD
+# Autenticado con "Authorization: Bearer EXPORT_TOKEN" (sin token, deshabilitado).
+# Se transmite página a página (keyset + cabecera Range de PostgREST): la memoria no
+# crece con el tamaño de la tabla.
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN", "")
+EXPORT_PAGE  = int(os.getenv("EXPORT_PAGE", "1000"))
+EXPORT_TABLES = {
+    "pagos": ["id", "user_id", "username", "amount", "qty", "status", "created_at", "updated_at"],
+    "creditos_historial": ["id", "usuario_id", "delta", "motivo", "hecho_por", "created_at"],
+}
+
+def _date_range_filter(desde: str, hasta: str):
+    """'and' de PostgREST sobre created_at para [desde, hasta] (fechas YYYY-MM-DD)."""
+    conds = []
+    if desde:
+        conds.append(f"created_at.gte.{datetime.strptime(desde, '%Y-%m-%d').date().isoformat()}")
+    if hasta:
+        end = datetime.strptime(hasta, "%Y-%m-%d").date() + timedelta(days=1)
+        conds.append(f"created_at.lt.{end.isoformat()}")
+    return f"({','.join(conds)})" if conds else None
+
+async def _export_chunks(table: str, fmt: str, params: dict):
+    cols = EXPORT_TABLES[table]
+    buf = io.StringIO()
+    writer = csv.writer(buf) if fmt == "csv" else None
+    if writer:
+        writer.writerow(cols)
+    n = 0
+    try:
+        async for row in sb_iter(table, params, page=EXPORT_PAGE):
+            if writer:
+                writer.writerow([row.get(c) for c in cols])
+            else:
+                buf.write(json.dumps(row, ensure_ascii=False, separators=(",", ":")))
+                buf.write("\n")
+            n += 1
+            if n % EXPORT_PAGE == 0:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+    except Exception as e:
+        # las cabeceras ya se enviaron: cortamos el stream y queda en el log
+        log.warning("Export %s: cortado tras %d filas: %s", table, n, e)
+        count_error("export")
+        return
+    yield buf.getvalue()
+
+def http_export(table: str, fmt: str, headers, args):
+    if not EXPORT_TOKEN:
+        return 404, "not found", {}
+    if not secret_matches(headers.get("Authorization", ""), f"Bearer {EXPORT_TOKEN}"):
+        return 403, "forbidden", {}
+    if table not in EXPORT_TABLES or fmt not in ("csv", "ndjson"):
+        return 404, "not found", {}
+    if _bot_loop is None:
+        return 503, "starting", {}
+    try:
+        rango = _date_range_filter(args.get("desde", ""), args.get("hasta", ""))
+    except ValueError:
+        return 400, "fechas inválidas (YYYY-MM-DD)", {}
+    params = {"select": ",".join(EXPORT_TABLES[table])}
+    if rango:
+        params["and"] = rango
+    return 200, _export_chunks(table, fmt, params), {
+        "Content-Type": "text/csv" if fmt == "csv" else "application/x-ndjson",
+        "Content-Disposition": f'attachment; filename="{table}.{fmt}"',
+    }
+
+async def http_dispatch(method: str, path: str, args: dict, headers, body: bytes):
+    """Ruteo común a los dos servidores -> (status, cuerpo, cabeceras)."""
+    if path == "/health" and method in ("GET", "HEAD"):
+        return http_health()
+    if path == "/metrics" and method == "GET":
+        return http_metrics(headers)
+    if path == WEBHOOK_PATH and method == "POST":
+        return await http_webhook(headers, body)
+    if path == INVALIDATE_PATH and method == "POST":
+        return http_invalidate(headers, body)
+    if path.startswith("/export/") and method == "GET":
+        table, _, fmt = path[len("/export/"):].rpartition(".")
+        return http_export(table, fmt, headers, args)
+    return 404, "not found", {}
+
+# ========= Servidor asyncio =========
+
+class _Headers(dict):
+    """Cabeceras con claves en minúsculas; get() no distingue mayúsculas."""
+
+    def get(self, key, default=None):
+        return super().get(key.lower(), default)
+
+async def _http_write(writer, status: int, payload, headers: dict, keep_alive: bool, head_only: bool = False):
+    out = {"Content-Type": "text/plain; charset=utf-8", **headers,
+           "Connection": "keep-alive" if keep_alive else "close"}
+    streaming = hasattr(payload, "__anext__")
+    if streaming:
+        out["Transfer-Encoding"] = "chunked"
+    else:
+        if isinstance(payload, str):
+            payload = payload.encode()
+        out["Content-Length"] = str(len(payload))
+    head = f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+    head += "".join(f"{k}: {v}\r\n" for k, v in out.items()) + "\r\n"
+    writer.write(head.encode("latin-1"))
+    if streaming:
+        async for chunk in payload:
+            data = chunk.encode() if isinstance(chunk, str) else chunk
+            if data:
+                writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+                await writer.drain()   # respeta al cliente lento: no acumulamos en memoria
+        writer.write(b"0\r\n\r\n")
+    elif not head_only:
+        writer.write(payload)
+    await writer.drain()
+
+async def _http_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Una conexión HTTP/1.1 (con keep-alive); solo cuerpos con Content-Length (chunked -> 411)."""
+    try:
+        while True:
+            try:
+                raw = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HTTP_IDLE_TIMEOUT)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                return
+            lines = raw.decode("latin-1").split("\r\n")
+            try:
+                method, target, version = lines[0].split(" ", 2)
+            except ValueError:
+                await _http_write(writer, 400, "bad request", {}, keep_alive=False)
+                return
+            headers = _Headers()
+            for line in lines[1:]:
+                name, sep, value = line.partition(":")
+                if sep:
+                    headers[name.strip().lower()] = value.strip()
+            raw_length = headers.get("content-length") or "0"
+            if not (raw_length.isascii() and raw_length.isdigit()):   # "-1", "abc", "1e3", "٣"
+                await _http_write(writer, 400, "bad request", {}, keep_alive=False)
+                return
+            coding = headers.get("transfer-encoding", "").lower()
+            if coding:
+                # chunked: que el cliente mande Content-Length; otra codificación no la entendemos
+                if coding.rsplit(",", 1)[-1].strip() == "chunked":
+                    await _http_write(writer, 411, "length required", {}, keep_alive=False)
+                else:
+                    await _http_write(writer, 501, "not implemented", {}, keep_alive=False)
+                return
+            length = int(raw_length)
+            if length > HTTP_MAX_BODY:
+                await _http_write(writer, 413, "payload too large", {}, keep_alive=False)
+                return
+            try:
+                body = await asyncio.wait_for(reader.readexactly(length), HTTP_BODY_TIMEOUT) if length else b""
+            except asyncio.TimeoutError:
+                await _http_write(writer, 408, "request timeout", {}, keep_alive=False)
+                return
+            keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+            url = urlsplit(target)
+            try:
+                status, payload, extra = await http_dispatch(
+                    method, url.path, dict(parse_qsl(url.query)), headers, body)
+            except Exception:
+                log.exception("HTTP: error atendiendo %s %s", method, url.path)
+                count_error("http")
+                status, payload, extra = 500, "error", {}
+            await _http_write(writer, status, payload, extra, keep_alive, head_only=method == "HEAD")
+            if not keep_alive:
+                return
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def start_http_server(port: int):
+    server = await asyncio.start_server(_http_connection, "0.0.0.0", port)
+    log.info("HTTP escuchando en 0.0.0.0:%s (asyncio)", port)
+    return server
+
+# ========= Flask (HTTP_SERVER=flask) =========
+
+def _iter_threadsafe(agen, timeout: float):
+    """Consume un generador async del loop del bot desde un hilo de waitress."""
+    while True:
+        fut = asyncio.run_coroutine_threadsafe(agen.__anext__(), _bot_loop)
+        try:
+            yield fut.result(timeout=timeout)
+        except StopAsyncIteration:
+            return
+
+def build_flask_app():
+    """La misma API sobre Flask; cada request salta al loop del bot."""
+    from flask import Flask, Response, request
+
+    app = Flask(__name__)
+
+    @app.route("/health", methods=["GET"])
+    @app.route("/metrics", methods=["GET"])
+    @app.route(WEBHOOK_PATH, methods=["POST"])
+    @app.route(INVALIDATE_PATH, methods=["POST"])
+    @app.route("/export/<path:name>", methods=["GET"])
+    def endpoint(name=None):
+        if _bot_loop is None:
+            status, payload, headers = (200, "ok", {}) if request.path == "/health" else (503, "starting", {})
+        else:
+            fut = asyncio.run_coroutine_threadsafe(
+                http_dispatch(request.method, request.path, request.args.to_dict(),
+                              request.headers, request.get_data()),
+                _bot_loop,
+            )
+            status, payload, headers = fut.result(timeout=15)
+        if hasattr(payload, "__anext__"):
+            payload = _iter_threadsafe(payload, timeout=SB_TIMEOUT + 5)
+        return Response(payload, status=status, headers=headers)
+
+    return app
 
 # ============ Arranque ============
 
 def run_http():
+    """HTTP_SERVER=flask: Flask + waitress en su propio hilo."""
     from waitress import serve
     port = int(os.getenv("PORT", "8080"))
-    log.info("HTTP escuchando en 0.0.0.0:%s", port)
-    serve(app_flask, host="0.0.0.0", port=port)
+    log.info("HTTP escuchando en 0.0.0.0:%s (flask)", port)
+    serve(build_flask_app(), host="0.0.0.0", port=port)
+
+async def _start_bot():
+    """initialize + post_init + webhook o polling + start."""
+    await app_tg.initialize()
+    if app_tg.post_init:
+        await app_tg.post_init(app_tg)
+    if BOT_MODE == "webhook":
+        await app_tg.bot.set_webhook(
+            url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=40,
+        )
+    else:
+        await app_tg.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    await app_tg.start()
+    if BOT_MODE == "webhook":
+        log.info("Webhook activo en %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+
+async def _stop_bot():
+    if app_tg.updater and app_tg.updater.running:
+        await app_tg.updater.stop()
+    if app_tg.running:
+        await app_tg.stop()
+    await app_tg.shutdown()
+    if app_tg.post_shutdown:
+        await app_tg.post_shutdown(app_tg)
+
+async def _run_webhook():
+    """Modo webhook con HTTP_SERVER=flask: los updates llegan por los hilos de waitress."""
+    await _start_bot()
+    try:
+        await asyncio.Event().wait()   # hasta que el proceso termine
+    finally:
+        await _stop_bot()
 
 def run_bot():
     """
@@ -516,13 +3802,68 @@ def run_bot():
     """
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
+    if BOT_MODE == "webhook":
+        task = loop.create_task(_run_webhook())
+        try:
+            loop.run_until_complete(task)
+        except KeyboardInterrupt:
+            task.cancel()
+            loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+        finally:
+            loop.close()
+        return
     app_tg.run_polling(
         allowed_updates=Update.ALL_TYPES,
         close_loop=True,
         stop_signals=None
     )
 
+async def serve_asyncio():
+    """
+    HTTP_SERVER=asyncio: un proceso, un loop. El servidor HTTP arranca primero (el
+    health check responde mientras se construye la Application) y SIGTERM/SIGINT
+    apagan el bot ordenadamente (outbox, lease, sesiones).
+    """
+    t_import = time.perf_counter() - _T_START
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass   # Windows o fuera del hilo principal
+    server = await start_http_server(int(os.getenv("PORT", "8080")))
+    try:
+        t_http = time.perf_counter() - _T_START
+        build_app()
+        t_app = time.perf_counter() - _T_START
+        await _start_bot()
+        t_ready = time.perf_counter() - _T_START
+        log.info("Arranque: imports %.0f ms, HTTP %.0f ms, Application %.0f ms, bot listo %.0f ms (RSS %.1f MB)",
+                 t_import * 1000, t_http * 1000, t_app * 1000, t_ready * 1000, _rss_mb())
+        await stop.wait()
+    finally:
+        # también si el arranque falla: el puerto no queda tomado por un servidor huérfano
+        log.info("Apagando…")
+        server.close()
+        try:
+            # desde 3.12 también espera a las conexiones keep-alive abiertas
+            await asyncio.wait_for(server.wait_closed(), 5)
+        except asyncio.TimeoutError:
+            pass
+        if app_tg is not None:
+            await _stop_bot()
+
+def _rss_mb() -> float:
+    """Memoria residual actual (Linux); 0 si no se puede leer."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
 # Fallback: si envían stickers, audios, documentos, contactos, etc.
+@instrument_handler
 async def on_anything_else(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.user_data.get(UD_AWAIT_QTY) and not context.user_data.get(UD_AWAIT_PROOF):
         await cmd_start(update, context)
@@ -533,18 +3874,39 @@ def register_handlers():
     app_tg.add_handler(CallbackQueryHandler(on_buttons, pattern="^(recargar|saldo|ayuda|cancel)$"))
     app_tg.add_handler(MessageHandler(filters.PHOTO, on_photo))
     app_tg.add_handler(CallbackQueryHandler(on_admin_actions, pattern="^(approve:|reject:)"))
+    app_tg.add_handler(CommandHandler("pendientes", cmd_pendientes))
+    app_tg.add_handler(CommandHandler("broadcast", cmd_broadcast))
+    app_tg.add_handler(CommandHandler("reporte", cmd_reporte))
+    app_tg.add_handler(CallbackQueryHandler(on_bulk_actions, pattern="^(bsel:|bpage:|bapprove$|bclear$)"))
     # textos (cantidad) cuando está esperando o menú si no
     app_tg.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
     # NUEVO: fallback para cualquier otro tipo de mensaje
     app_tg.add_handler(MessageHandler(~filters.COMMAND & ~filters.TEXT & ~filters.PHOTO, on_anything_else))
 
-register_handlers()
+def register_jobs():
+    app_tg.job_queue.run_repeating(evict_idle_sessions, interval=SESSION_SWEEP_INTERVAL, first=SESSION_SWEEP_INTERVAL)
+    if EXPIRY_SINCE:
+        app_tg.job_queue.run_repeating(expire_stale_orders, interval=EXPIRY_SWEEP_INTERVAL, first=60)
+    else:
+        log.warning("Vencimiento apagado: define EXPIRY_SINCE (ver sql/pagos_comprobante.sql)")
+    app_tg.job_queue.run_repeating(reconcile, interval=RECONCILE_INTERVAL, first=RECONCILE_INTERVAL)
+    if TIERS_FROM_DB:
+        app_tg.job_queue.run_repeating(refresh_tiers_job, interval=TIERS_CHECK_INTERVAL, first=TIERS_CHECK_INTERVAL)
+    if REPLICA_COUNT > 1:
+        app_tg.job_queue.run_repeating(leader.tick, interval=LEADER_LEASE_TTL / 3, first=0)
+        app_tg.job_queue.run_repeating(prune_processed_updates, interval=3600, first=3600)
+
+def main():
+    if HTTP_SERVER == "flask":
+        build_app()
+        # HTTP en un hilo
+        th = threading.Thread(target=run_http, name="http", daemon=True)
+        th.start()
+
+        # Bot en otro hilo (con su propio event loop)
+        run_bot()
+    else:
+        asyncio.run(serve_asyncio())
 
 if __name__ == "__main__":
-    # HTTP en un hilo
-    th = threading.Thread(target=run_http, name="http", daemon=True)
-    th.start()
-
-    # Bot en otro hilo (con su propio event loop)
-    run_bot()
-
+    main()
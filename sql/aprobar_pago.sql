@@ -0,0 +1,81 @@
+-- sql/aprobar_pago.sql
+-- Aprobación atómica de un pedido (se llama vía PostgREST: POST /rest/v1/rpc/aprobar_pago).
+--
+-- En una sola transacción:
+--   1) marca pagos.status = 'aprobado' (solo si estaba 'pendiente'),
+--   2) suma qty a usuarios.creditos (upsert con incremento, sin leer antes),
+--   3) agrega la fila a creditos_historial,
+--   4) devuelve el saldo nuevo.
+-- Es idempotente por order_id: si el pedido ya no estaba pendiente (aprobado,
+-- rechazado o vencido) no suma nada y devuelve aplicado = false con su status y
+-- el saldo actual. Un pedido rechazado o vencido no se acredita nunca por aquí.
+--
+-- Ejecutar una vez en el SQL editor de Supabase.
+
+create unique index if not exists usuarios_telegram_id_key on usuarios (telegram_id);
+
+create or replace function aprobar_pago(
+    p_order_id  text,
+    p_user_id   text,
+    p_qty       integer,
+    p_hecho_por text default 'admin'
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_user   text;
+    v_qty    integer;
+    v_total  integer;
+    v_status text;
+begin
+    -- El UPDATE bloquea la fila del pedido: una aprobación y un rechazo (o dos
+    -- aprobaciones) simultáneos del mismo order_id se serializan, y el segundo ya
+    -- no encuentra status = 'pendiente'.
+    update pagos
+       set status = 'aprobado', updated_at = now()
+     where id = p_order_id
+       and status = 'pendiente'
+    returning user_id, qty into v_user, v_qty;
+
+    if not found then
+        select status into v_status from pagos where id = p_order_id;
+        if found then
+            select coalesce(creditos, 0) into v_total from usuarios where telegram_id = p_user_id;
+            return jsonb_build_object(
+                'aplicado', false, 'order_id', p_order_id, 'user_id', p_user_id,
+                'qty', 0, 'creditos', coalesce(v_total, 0), 'status', v_status
+            );
+        end if;
+        -- El insert "no bloqueante" del pedido pudo fallar: lo registramos ya aprobado.
+        insert into pagos (id, user_id, qty, status, created_at, updated_at)
+        values (p_order_id, p_user_id, p_qty, 'aprobado', now(), now())
+        on conflict (id) do nothing;
+        if not found then
+            -- otra transacción lo insertó primero: ella se encarga de acreditar
+            select status into v_status from pagos where id = p_order_id;
+            select coalesce(creditos, 0) into v_total from usuarios where telegram_id = p_user_id;
+            return jsonb_build_object(
+                'aplicado', false, 'order_id', p_order_id, 'user_id', p_user_id,
+                'qty', 0, 'creditos', coalesce(v_total, 0), 'status', v_status
+            );
+        end if;
+        v_user := p_user_id;
+        v_qty  := p_qty;
+    end if;
+
+    insert into usuarios (telegram_id, creditos)
+    values (v_user, v_qty)
+    on conflict (telegram_id)
+    do update set creditos = coalesce(usuarios.creditos, 0) + excluded.creditos
+    returning creditos into v_total;
+
+    insert into creditos_historial (usuario_id, delta, motivo, hecho_por)
+    values (v_user, v_qty, 'recarga_aprobada', p_hecho_por);
+
+    return jsonb_build_object(
+        'aplicado', true, 'order_id', p_order_id, 'user_id', v_user,
+        'qty', v_qty, 'creditos', v_total, 'status', 'aprobado'
+    );
+end;
+$$;
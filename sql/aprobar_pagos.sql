@@ -0,0 +1,51 @@
+-- sql/aprobar_pagos.sql
+-- Aprobación en lote desde /pendientes (POST /rest/v1/rpc/aprobar_pagos).
+--
+-- Una sola transacción para N pedidos:
+--   1) UPDATE pagos ... WHERE id = any(p_order_ids) AND status = 'pendiente'
+--   2) un upsert de créditos por usuario (suma de qty de sus pedidos)
+--   3) una fila de creditos_historial por pedido
+-- Devuelve un array [{order_id, user_id, qty, creditos}] solo con los pedidos que se
+-- aprobaron ahora; los que ya no estaban pendientes se ignoran (idempotente).
+--
+-- Requiere el índice único de sql/aprobar_pago.sql.
+
+create or replace function aprobar_pagos(
+    p_order_ids text[],
+    p_hecho_por text default 'admin'
+)
+returns jsonb
+language sql
+as $$
+    with aprobados as (
+        update pagos
+           set status = 'aprobado', updated_at = now()
+         where id = any(p_order_ids)
+           and status = 'pendiente'
+        returning id, user_id, qty
+    ),
+    por_usuario as (
+        select user_id, sum(qty)::integer as qty
+          from aprobados
+         group by user_id
+    ),
+    saldos as (
+        insert into usuarios (telegram_id, creditos)
+        select user_id, qty from por_usuario
+        on conflict (telegram_id)
+        do update set creditos = coalesce(usuarios.creditos, 0) + excluded.creditos
+        returning telegram_id, creditos
+    ),
+    historial as (
+        insert into creditos_historial (usuario_id, delta, motivo, hecho_por)
+        select user_id, qty, 'recarga_aprobada', p_hecho_por from aprobados
+    )
+    select coalesce(
+        jsonb_agg(jsonb_build_object(
+            'order_id', a.id, 'user_id', a.user_id, 'qty', a.qty, 'creditos', s.creditos
+        )),
+        '[]'::jsonb
+    )
+      from aprobados a
+      join saldos s on s.telegram_id = a.user_id;
+$$;
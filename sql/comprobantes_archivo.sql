@@ -0,0 +1,23 @@
+-- sql/comprobantes_archivo.sql
+-- Copia propia de las capturas de pago (PROOF_ARCHIVE=disk|bucket). El bot guarda
+-- en cada pedido dónde quedó la captura y su miniatura WebP:
+--
+--   comprobante_path:   disk://AAAA/MM/<pedido>/<captura>.jpg (relativo a PROOF_ARCHIVE_DIR)
+--                       o storage://<bucket>/AAAA/MM/<pedido>/<captura>.jpg
+--   comprobante_thumb:  igual, con .webp
+--
+-- <captura> es <pedido>-<file_unique_id de Telegram>. Si el cliente manda varias
+-- capturas para un pedido, todas quedan en la carpeta del pedido y la fila apunta
+-- a la última.
+--   comprobante_bytes / comprobante_sha256: tamaño y hash del original, para
+--                       verificar la copia en una auditoría.
+--
+-- Con PROOF_ARCHIVE=bucket, crear antes el bucket (privado) en Supabase Storage con
+-- el nombre de PROOF_ARCHIVE_BUCKET (por defecto 'comprobantes').
+--
+-- Ejecutar una vez en el SQL editor de Supabase.
+
+alter table pagos add column if not exists comprobante_path text;
+alter table pagos add column if not exists comprobante_thumb text;
+alter table pagos add column if not exists comprobante_bytes integer;
+alter table pagos add column if not exists comprobante_sha256 text;
@@ -0,0 +1,65 @@
+-- sql/coordinacion.sql
+-- Coordinación entre réplicas cuando COORD_BACKEND=supabase (varios hosts).
+--
+--   bot_updates: claves de idempotencia; cada update_id de Telegram se procesa una
+--                sola vez aunque Telegram reintente o una réplica lo reenvíe dos veces.
+--   bot_leases:  lease con vencimiento; la réplica que lo tiene corre los jobs
+--                globales (vencimientos, conciliación, limpieza de bot_updates).
+--   bot_sesiones: estado de conversación (user_data) de cada usuario; `replica` es
+--                la réplica dueña al escribirla, para que cada una cargue las suyas.
+--
+-- Ejecutar una vez en el SQL editor de Supabase.
+
+create table if not exists bot_updates (
+    update_id  bigint primary key,
+    replica    text not null,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists bot_updates_created_at_idx on bot_updates (created_at);
+
+create table if not exists bot_sesiones (
+    user_id    bigint primary key,
+    data       jsonb not null,
+    replica    integer not null,
+    updated_at timestamptz not null default now()
+);
+
+create index if not exists bot_sesiones_replica_idx on bot_sesiones (replica, user_id);
+
+create table if not exists bot_leases (
+    nombre text primary key,
+    holder text not null,
+    expira timestamptz not null
+);
+
+-- Toma o renueva el lease: solo si está libre, vencido o ya es de p_holder.
+-- Devuelve true si p_holder quedó como dueño.
+create or replace function tomar_lease(
+    p_nombre text,
+    p_holder text,
+    p_ttl    double precision
+)
+returns boolean
+language sql
+as $$
+    with t as (
+        insert into bot_leases (nombre, holder, expira)
+        values (p_nombre, p_holder, now() + make_interval(secs => p_ttl))
+        on conflict (nombre) do update
+            set holder = excluded.holder,
+                expira = excluded.expira
+            where bot_leases.holder = excluded.holder
+               or bot_leases.expira < now()
+        returning 1
+    )
+    select exists (select 1 from t);
+$$;
+
+-- Suelta el lease al apagar la réplica para que otra lo tome sin esperar el TTL.
+create or replace function soltar_lease(p_nombre text, p_holder text)
+returns void
+language sql
+as $$
+    delete from bot_leases where nombre = p_nombre and holder = p_holder;
+$$;
@@ -0,0 +1,36 @@
+-- sql/pagos_comprobante.sql
+-- Marca en 'pagos' cuándo llegó la captura del pago. El barrido de pedidos vencidos
+-- solo expira los que siguen sin comprobante (los que esperan revisión del admin no),
+-- y /pendientes solo lista los que tienen captura.
+-- El bot escribe las marcas en lote con marcar_comprobantes (una llamada por lote
+-- del outbox); sin la función las manda de a una con PATCH.
+--
+-- Los pedidos creados antes de esta columna no tienen la marca aunque el cliente
+-- haya mandado la captura. Dos opciones al desplegar:
+--   a) EXPIRY_SINCE = fecha/hora UTC del despliegue: los anteriores nunca vencen
+--      solos (y no salen en /pendientes; se aprueban desde su mensaje).
+--   b) correr el backfill de abajo (los pendientes anteriores quedan como "con
+--      captura": salen en /pendientes para aprobarlos o rechazarlos) y poner en
+--      EXPIRY_SINCE cualquier fecha anterior, ej: 2000-01-01.
+-- Sin EXPIRY_SINCE el barrido no corre.
+
+alter table pagos add column if not exists comprobante_file_id text;
+alter table pagos add column if not exists comprobante_at timestamptz;
+
+create index if not exists pagos_pendientes_idx on pagos (created_at, id) where status = 'pendiente';
+
+-- p_filas: [{"id", "comprobante_file_id", "comprobante_at"}, ...]
+create or replace function marcar_comprobantes(p_filas jsonb)
+returns void
+language sql
+as $$
+    update pagos p
+       set comprobante_file_id = f.comprobante_file_id,
+           comprobante_at      = f.comprobante_at
+      from jsonb_to_recordset(p_filas) as f(id text, comprobante_file_id text, comprobante_at timestamptz)
+     where p.id = f.id;
+$$;
+
+-- Backfill (opción b), una sola vez al desplegar:
+-- update pagos set comprobante_at = created_at
+--  where status = 'pendiente' and comprobante_at is null;
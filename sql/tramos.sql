@@ -0,0 +1,46 @@
+-- sql/tramos.sql
+-- Tramos de precio y compra mínima editables sin redeploy (reemplazan a las
+-- variables PRICE_TIERS / MIN_QTY_TIERS cuando la tabla tiene filas).
+--
+--   tramos:         una fila por tramo; 'desde' son cuentas_asignadas. precio o
+--                   minimo en null = se mantiene el del tramo anterior.
+--   tramos_version: una sola fila; el trigger la sube en cada cambio de 'tramos'.
+--                   El bot consulta solo la versión cada TIERS_CHECK_INTERVAL y
+--                   recarga la tabla cuando cambia.
+--   pagos.tier_version: versión de tramos con la que se cotizó el pedido.
+--
+-- Ejecutar una vez en el SQL editor de Supabase.
+
+create table if not exists tramos (
+    desde  integer primary key check (desde >= 0),
+    precio numeric(10, 2) check (precio > 0),
+    minimo integer check (minimo >= 1)
+);
+
+create table if not exists tramos_version (
+    id          boolean primary key default true check (id),
+    version     bigint not null default 1,
+    actualizado timestamptz not null default now()
+);
+
+insert into tramos_version default values on conflict do nothing;
+
+create or replace function tramos_bump_version()
+returns trigger
+language plpgsql
+as $$
+begin
+    update tramos_version set version = version + 1, actualizado = now();
+    return null;
+end;
+$$;
+
+drop trigger if exists tramos_bump_version on tramos;
+create trigger tramos_bump_version
+    after insert or update or delete or truncate on tramos
+    for each statement execute function tramos_bump_version();
+
+alter table pagos add column if not exists tier_version bigint;
+
+-- Ejemplo equivalente a PRICE_TIERS="0:23,10:21" y MIN_QTY_TIERS="0:2":
+-- insert into tramos (desde, precio, minimo) values (0, 23, 2), (10, 21, null);